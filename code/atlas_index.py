@@ -0,0 +1,227 @@
+from __future__ import division
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import logging
+import numpy as np
+import nibabel as nib
+
+from extract_roi import most_likely_roi_network, roi_voxel_index
+
+
+# Arrays that make up an atlas index. Each one is saved as a separate .npy file
+# so that it can be memory-mapped when loaded.
+ATLAS_INDEX_ARRAYS = ['shape', 'region_names', 'voxels', 'offsets', 'mask',
+                      'network_regions', 'network_offsets',
+                      'within_voxels', 'within_offsets',
+                      'between_voxels', 'between_offsets']
+
+
+def file_hash(filename, block_size=2 ** 20):
+    """ Compute the sha1 of the content of a file """
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def cached_file_hash(filename, cache_dir=None):
+    """ Return the sha1 of a file (see file_hash). If cache_dir is passed, the
+    hashes are stored in its file_hashes.json, keyed by the absolute path of
+    the file, together with its size and modification time: the file is only
+    hashed again when one of them changed. """
+    if cache_dir is None:
+        return file_hash(filename)
+    filename = os.path.abspath(filename)
+    stat = os.stat(filename)
+    signature = [stat.st_size, stat.st_mtime]
+    hashes_filename = os.path.join(cache_dir, 'file_hashes.json')
+    hashes = {}
+    if os.path.exists(hashes_filename):
+        try:
+            with open(hashes_filename) as f:
+                hashes = json.load(f)
+        except ValueError:
+            logging.warning('Ignoring the corrupted file hashes: %s' % (hashes_filename))
+    entry = hashes.get(filename)
+    if entry is not None and entry['signature'] == signature:
+        return entry['sha1']
+
+    sha1 = file_hash(filename)
+    hashes[filename] = {'signature': signature, 'sha1': sha1}
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # Concurrent jobs may drop each other's entries, which are then computed
+    # again, but never see a partially written file.
+    handle, tmp_filename = tempfile.mkstemp(dir=cache_dir, prefix='.file_hashes.')
+    with os.fdopen(handle, 'w') as f:
+        json.dump(hashes, f, indent=2, sort_keys=True)
+    os.rename(tmp_filename, hashes_filename)
+    return sha1
+
+
+def atlas_index_key(segmented_image, lookuptable, network_mask_filename=None, cache_dir=None):
+    """ Key identifying an atlas index: the hash of the segmented image, of the
+    lookup table and, if passed, of the network mask. The hashes of the files
+    are cached in cache_dir (see cached_file_hash). """
+    sha1 = hashlib.sha1()
+    sha1.update(cached_file_hash(segmented_image, cache_dir).encode('ascii'))
+    sha1.update(np.ascontiguousarray(lookuptable['intensity'], dtype=np.float64).tobytes())
+    sha1.update(' '.join(lookuptable_region_names(lookuptable)).encode('utf-8'))
+    if network_mask_filename is not None:
+        sha1.update(cached_file_hash(network_mask_filename, cache_dir).encode('ascii'))
+    return sha1.hexdigest()
+
+
+def lookuptable_region_names(lookuptable):
+    """ Return the region names of the lookup table as a list of strings """
+    return [region.decode('utf-8') if isinstance(region, bytes) else str(region)
+            for region in lookuptable['regions']]
+
+
+def build_atlas_index(segmented_image, lookuptable, network_mask_filename=None):
+    """ Precompute everything extract_roi needs from the atlas:
+        - region_names: the names of the regions of the lookup table;
+        - voxels/offsets: the flat voxel indices of each region of the lookup
+          table (see roi_voxel_index);
+        - mask: the flat voxel indices of the union of all regions;
+        - network_regions/network_offsets: the regions assigned to each
+          network (only if a network mask is passed);
+        - within_voxels/within_offsets: the voxels of the regions of all
+          networks, in network order (within_network);
+        - between_voxels/between_offsets: the voxels of each network
+          (between_network).
+    """
+    segmented_image_data = np.asanyarray(nib.load(segmented_image).dataobj)
+
+    # Note: Not all intensity values are integers on the csf/wm segmentaton image are int. Therefore, we use
+    # the np.isclose function to find all values that are in a similar range. This lead to the inclusion of
+    # a few regions.
+    regions = [np.isclose(segmented_image_data, intensity, atol=.0)
+               for intensity in lookuptable['intensity']]
+    voxels, offsets = roi_voxel_index(regions)
+    index = {'shape': np.array(segmented_image_data.shape, dtype=np.int64),
+             'region_names': np.array(lookuptable_region_names(lookuptable), dtype=np.str_),
+             'voxels': voxels,
+             'offsets': offsets,
+             'mask': np.unique(voxels)}
+
+    if network_mask_filename is None:
+        empty = np.zeros(0, dtype=np.int64)
+        for name in ['network_regions', 'within_voxels', 'between_voxels']:
+            index[name] = empty
+        for name in ['network_offsets', 'within_offsets', 'between_offsets']:
+            index[name] = np.zeros(1, dtype=np.int64)
+        return index
+
+    # Find the most likely regions inside the network.
+    ntw_data = np.asanyarray(nib.load(network_mask_filename).dataobj)
+    boolean_ntw = ntw_data > 1.64
+    equal_voxels, equal_offsets = roi_voxel_index(
+        [segmented_image_data == intensity for intensity in lookuptable['intensity']])
+    networks, assignment = most_likely_roi_network(equal_voxels, equal_offsets, boolean_ntw)
+
+    network_lengths = [len(networks[network]) for network in range(len(networks))]
+    index['network_regions'] = np.array([region for network in range(len(networks))
+                                         for region in networks[network]], dtype=np.int64)
+    index['network_offsets'] = np.concatenate([[0], np.cumsum(network_lengths)]).astype(np.int64)
+    index['within_voxels'], index['within_offsets'] = region_subset_index(
+        equal_voxels, equal_offsets, index['network_regions'])
+
+    # The between network ROIs are made of the voxels of the assigned regions
+    # that are also inside the network.
+    ntw_voxels = boolean_ntw.reshape(-1, boolean_ntw.shape[3])
+    between = []
+    for network in range(len(networks)):
+        region_voxels, _ = region_subset_index(equal_voxels, equal_offsets, networks[network])
+        between.append(np.unique(region_voxels[ntw_voxels[region_voxels, network]]))
+    index['between_voxels'] = np.concatenate(between).astype(np.int64)
+    index['between_offsets'] = np.concatenate([[0], np.cumsum([len(v) for v in between])]).astype(np.int64)
+    return index
+
+
+def region_subset_index(voxels, offsets, regions):
+    """ Select some regions (in the passed order) of a region voxel index (see
+    roi_voxel_index). """
+    lengths = np.array([offsets[region + 1] - offsets[region] for region in regions], dtype=np.int64)
+    subset_offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    if len(regions):
+        subset_voxels = np.concatenate([voxels[offsets[region]:offsets[region + 1]]
+                                        for region in regions]).astype(np.int64)
+    else:
+        subset_voxels = np.zeros(0, dtype=np.int64)
+    return subset_voxels, subset_offsets
+
+
+def atlas_networks(index):
+    """ Return the region -> network assignment stored in an atlas index as a
+    dictionary of lists (the format returned by most_likely_roi_network). """
+    offsets = index['network_offsets']
+    return {network: [int(region) for region in
+                      index['network_regions'][offsets[network]:offsets[network + 1]]]
+            for network in range(len(offsets) - 1)}
+
+
+def atlas_mask(index):
+    """ Return the union of all atlas regions as a 3D volume """
+    shape = tuple(index['shape'])
+    mask = np.zeros(int(np.prod(shape)))
+    mask[index['mask']] = 1
+    return mask.reshape(shape)
+
+
+def default_atlas_cache_dir(segmented_image):
+    return os.path.join(os.path.dirname(os.path.abspath(segmented_image)), 'atlas_index')
+
+
+def atlas_index_path(segmented_image, lookuptable, network_mask_filename=None,
+                     cache_dir=None):
+    """ Return the folder where the index of the atlas is cached. The cache
+    entry is keyed by the hash of the atlas files (see atlas_index_key), so it
+    is only built the first time a given atlas is used. The hashes of the files
+    are kept in the cache as well, and only computed again when the files
+    change. """
+    if cache_dir is None:
+        cache_dir = default_atlas_cache_dir(segmented_image)
+    key = atlas_index_key(segmented_image, lookuptable, network_mask_filename, cache_dir)
+    index_path = os.path.join(cache_dir, key)
+
+    if not os.path.isdir(index_path):
+        logging.info('Building atlas index: %s' % (index_path))
+        index = build_atlas_index(segmented_image, lookuptable, network_mask_filename)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # Write the index to a temporary folder and rename it, so that
+        # concurrent jobs never see a partially written index.
+        tmp_path = tempfile.mkdtemp(dir=cache_dir, prefix='.%s.' % key)
+        for name in ATLAS_INDEX_ARRAYS:
+            np.save(os.path.join(tmp_path, name + '.npy'), index[name])
+        try:
+            os.rename(tmp_path, index_path)
+        except OSError:
+            # Another job stored the same index in the meantime.
+            shutil.rmtree(tmp_path)
+    return index_path
+
+
+def open_atlas_index(index_path, mmap_mode='r'):
+    """ Open a cached atlas index. The arrays are memory-mapped (mmap_mode),
+    hence all the processes using the same atlas share the same pages instead
+    of holding a copy each. """
+    return {name: np.load(os.path.join(index_path, name + '.npy'), mmap_mode=mmap_mode)
+            for name in ATLAS_INDEX_ARRAYS}
+
+
+def load_atlas_index(segmented_image, lookuptable, network_mask_filename=None,
+                     cache_dir=None, mmap_mode='r'):
+    """ Load the index of the atlas from the on-disk cache, building it if
+    needed (see atlas_index_path and open_atlas_index).
+
+    Returns a dictionary with the arrays described in build_atlas_index.
+    """
+    index_path = atlas_index_path(segmented_image, lookuptable, network_mask_filename, cache_dir)
+    return open_atlas_index(index_path, mmap_mode)
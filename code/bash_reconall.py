@@ -1,68 +1,201 @@
+#!/usr/bin/env python
+""" Run FreeSurfer's recon-all for the subjects of the dataset, at most
+--jobs at a time, either locally or through SLURM (srun).
+
+Subjects whose recon-all already completed are skipped, and the status of
+every subject is recorded in a state file (see scheduler.run_stage), so a
+batch that crashed resumes where it stopped. """
 import os
-import subprocess
-import pickle
-
-
-base_path = "/home/jdafflon/data/ucla-la5/data_in/ds000030"
-sub_list = [
-        'sub-10159', 'sub-10171', 'sub-10189', 'sub-10193', 'sub-10206',
-        'sub-10217', 'sub-10225', 'sub-10227', 'sub-10228', 'sub-10235',
-        'sub-10249', 'sub-10269', 'sub-10271', 'sub-10273', 'sub-10274',
-        'sub-10280', 'sub-10290', 'sub-10292', 'sub-10299']
-
-        # ['sub-10304',
-        # 'sub-10316', 'sub-10321', 'sub-10325', 'sub-10329', 'sub-10339',
-        # 'sub-10340', 'sub-10345', 'sub-10347', 'sub-10356', 'sub-10361',
-        # 'sub-10365', 'sub-10376', 'sub-10377', 'sub-10388']
-# sub_list = ['sub-10429', 'sub-10438', 'sub-10440', 'sub-10448',
-#         'sub-10455', 'sub-10460', 'sub-10471', 'sub-10478', 'sub-10487',
-#         'sub-10492', 'sub-10501', 'sub-10506', 'sub-10517', 'sub-10523',
-#         'sub-10524', 'sub-10525', 'sub-10527', 'sub-10530', 'sub-10557',
-#         'sub-10565', 'sub-10570', 'sub-10575', 'sub-10624', 'sub-10629',
-#         'sub-10631', 'sub-10638', 'sub-10668', 'sub-10672', 'sub-10674',
-#         'sub-10678', 'sub-10680', 'sub-10686', 'sub-10692', 'sub-10696',
-#         'sub-10697', 'sub-10704', 'sub-10707', 'sub-10708', 'sub-10719',
-#         'sub-10724', 'sub-10746', 'sub-10762', 'sub-10779', 'sub-10785',
-#         'sub-10788', 'sub-10844', 'sub-10855', 'sub-10871', 'sub-10877',
-#         'sub-10882', 'sub-10891', 'sub-10893', 'sub-10912', 'sub-10934',
-#         'sub-10940', 'sub-10948', 'sub-10949', 'sub-10958', 'sub-10963',
-#         'sub-10968', 'sub-10975', 'sub-10977', 'sub-10987',
-#         'sub-10998', 'sub-11019', 'sub-11030', 'sub-11044', 'sub-11050',
-#         'sub-11052', 'sub-11059', 'sub-11061', 'sub-11062', 'sub-11066',
-#         'sub-11067', 'sub-11068', 'sub-11077', 'sub-11082', 'sub-11088',
-#         'sub-11090', 'sub-11097', 'sub-11098', 'sub-11104', 'sub-11105',
-#         'sub-11106', 'sub-11108', 'sub-11112', 'sub-11122',
-#         'sub-11128', 'sub-11131', 'sub-11142', 'sub-11143', 'sub-11149',
-#         'sub-11156']
-# sub_list = ['sub-50004', 'sub-50005', 'sub-50006', 'sub-50007', 'sub-50008',
-#         'sub-50010', 'sub-50013', 'sub-50014', 'sub-50015', 'sub-50016',
-#         'sub-50020', 'sub-50021', 'sub-50022', 'sub-50023', 'sub-50025',
-#         'sub-50027', 'sub-50029', 'sub-50032', 'sub-50033', 'sub-50034',
-#         'sub-50035', 'sub-50036', 'sub-50038', 'sub-50043', 'sub-50047',
-#         'sub-50048', 'sub-50049', 'sub-50050', 'sub-50051', 'sub-50052',
-#         'sub-50053', 'sub-50054', 'sub-50055', 'sub-50056', 'sub-50058',
-#         'sub-50059', 'sub-50060', 'sub-50061', 'sub-50064', 'sub-50066',
-#         'sub-50067', 'sub-50069', 'sub-50073', 'sub-50075', 'sub-50076',
-#         'sub-50077', 'sub-50080', 'sub-50081', 'sub-50083', 'sub-50085']
-# sub_list = ['sub-50043', 'sub-50047', 'sub-50048', 'sub-50049', 'sub-50050',
-#         'sub-50051', 'sub-50052', 'sub-50053', 'sub-50054', 'sub-50055',
-#         'sub-50056', 'sub-50058', 'sub-50059']
-pickle_file = os.path.join(base_path, 'reconall_data', 'sub2id.pickle')
-# check if pickle file exists
-if os.path.exists(pickle_file):
-    with open(pickle_file, 'rb') as rfp:
-        sub2id = pickle.load(rfp)
-else:
-    sub2id = {}
-
-for sub in sub_list:
-    file_path = os.path.join(base_path, sub, 'anat', ''.join([sub, '_T1w.nii.gz']))
-    # FIXME: This command is not running when calling directly from terminal
-    cmd = 'srun /apps/software/freesurfer/5.3.0/bin/recon-all -all -i {0} -subjid {1} -sd {2}/reconall_data'.format(file_path, sub,base_path)
-    job_id = subprocess.check_output(cmd, shell=True)
-    sub2id[sub] = job_id
-
-# save pickle with the corresponding job-id for each subject
-with open(pickle_file, 'wb') as wfp:
-    pickle.dump(sub2id, wfp)
+import sys
+import glob
+import errno
+import socket
+import logging
+from argparse import ArgumentParser
+
+from scheduler import load_state, save_state, run_stage
+from dataset_index import load_dataset_index, index_subjects
+
+
+backends = ['local', 'slurm']
+
+
+def reconall_done(subjects_dir, subject):
+    """ Check if recon-all completed for a subject """
+    scripts_path = os.path.join(subjects_dir, subject, 'scripts')
+    return os.path.exists(os.path.join(scripts_path, 'recon-all.done')) and \
+        not os.path.exists(os.path.join(scripts_path, 'recon-all.error'))
+
+
+def reconall_lock_owner(lock_filename):
+    """ Return the host and the process id recorded by recon-all in one of
+    its IsRunning lock files, or None for the values that are missing """
+    host, pid = None, None
+    with open(lock_filename) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 2:
+                continue
+            if fields[0] == 'HOST':
+                host = fields[1]
+            elif fields[0] == 'PROCESSID' and fields[1].isdigit():
+                pid = int(fields[1])
+    return host, pid
+
+
+def process_running(pid):
+    """ Check if a process of this host is running """
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        return error.errno == errno.EPERM
+    return True
+
+
+def reconall_lock_is_stale(lock_filename, status=None):
+    """ Check if a lock file of recon-all was left behind by a run that died,
+    rather than held by a run still going on (e.g. started by another batch or
+    still running on another node). It is stale if status (the state of the
+    subject's job, see scheduler.run_stage) shows that the previous attempt of
+    this scheduler ended with an error, or if the process recorded in the lock
+    file no longer runs on this host. The locks of other hosts are kept. """
+    if status is not None and status['status'] in ['pending', 'failed'] and status['returncode'] not in [None, 0]:
+        return True
+    host, pid = reconall_lock_owner(lock_filename)
+    if host is None or pid is None:
+        return False
+    if host.split('.')[0] != socket.gethostname().split('.')[0]:
+        return False
+    return not process_running(pid)
+
+
+def reconall_command(dataset_path, subjects_dir, subject, backend='local', reconall='recon-all', cpus=1):
+    """ Return the recon-all command of a subject. If a previous run left the
+    subject's folder behind, recon-all is restarted on it instead of being
+    initialised from the T1 image again. """
+    if os.path.isdir(os.path.join(subjects_dir, subject)):
+        command = [reconall, '-all', '-subjid', subject, '-sd', subjects_dir]
+    else:
+        t1 = os.path.join(dataset_path, subject, 'anat', ''.join([subject, '_T1w.nii.gz']))
+        command = [reconall, '-all', '-i', t1, '-subjid', subject, '-sd', subjects_dir]
+    if backend == 'slurm':
+        command = ['srun', '-n', '1', '-c', str(cpus), '-J', 'reconall_%s' % subject] + command
+    elif backend != 'local':
+        raise ValueError('Unrecognised backend: %s.' % (backend))
+    return command
+
+
+def reconall_jobs(dataset_path, subjects_dir, subjects, state, backend='local', reconall='recon-all', cpus=1):
+    """ Return the (job id, command) pairs of the subjects that still need
+    recon-all. Completed subjects are marked as done in the state, and the
+    subjects locked by a recon-all still running (see reconall_lock_is_stale)
+    are left out. """
+    jobs = []
+    for subject in subjects:
+        job_id = 'reconall/%s' % subject
+        if reconall_done(subjects_dir, subject):
+            logging.info('%-60s already completed' % (job_id))
+            state[job_id] = {'command': None, 'attempts': 0, 'returncode': 0, 'status': 'done'}
+            continue
+        # A run that crashed leaves its lock files behind, which would stop
+        # recon-all from restarting.
+        lock_files = glob.glob(os.path.join(subjects_dir, subject, 'scripts', 'IsRunning.*'))
+        live_lock_files = [lock_file for lock_file in lock_files
+                           if not reconall_lock_is_stale(lock_file, state.get(job_id))]
+        if live_lock_files:
+            logging.info('%-60s locked by a running recon-all: %s' % (job_id, ', '.join(live_lock_files)))
+            continue
+        for lock_file in lock_files:
+            os.remove(lock_file)
+        jobs.append((job_id, reconall_command(dataset_path, subjects_dir, subject, backend, reconall, cpus)))
+    return jobs
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(
+            description='Run recon-all for the subjects of the dataset'
+            )
+    parser.add_argument(
+            '-d', '--dataset-path', dest='dataset_path', default=None,
+            help='Path of the BIDS dataset (default: the dataset of --dataset-index)'
+            )
+    parser.add_argument(
+            '--subjects-dir', dest='subjects_dir', default=None,
+            help='FreeSurfer subjects directory (default: DATASET_PATH/reconall_data)'
+            )
+    parser.add_argument(
+            '-s', '--subjects', dest='subjects', nargs='+', default=None,
+            help='Subjects to process (default: all subjects of the dataset index with a T1 image)'
+            )
+    parser.add_argument(
+            '--dataset-index', dest='dataset_index', default=None,
+            help='Index of the dataset, built from DATASET_PATH if missing (default: '
+                 'DATASET_PATH/dataset_index.json, see dataset_index.py)'
+            )
+    parser.add_argument(
+            '--rebuild-index', dest='rebuild_index', action='store_true',
+            help='Rebuild the dataset index before using it'
+            )
+    parser.add_argument(
+            '-b', '--backend', dest='backend', default='local',
+            choices=backends,
+            help='Where recon-all runs. Choose from: ' + ', '.join(backends)
+            )
+    parser.add_argument(
+            '-j', '--jobs', dest='jobs', type=int, default=1,
+            help='Maximum number of recon-all running at the same time'
+            )
+    parser.add_argument(
+            '--cpus', dest='cpus', type=int, default=1,
+            help='CPUs requested for each recon-all (slurm only)'
+            )
+    parser.add_argument(
+            '--retries', dest='retries', type=int, default=0,
+            help='Number of times a failed recon-all is retried'
+            )
+    parser.add_argument(
+            '--reconall', dest='reconall', default='recon-all',
+            help='recon-all executable'
+            )
+    parser.add_argument(
+            '--state-file', dest='state_filename', default=None,
+            help='File where the status of the subjects is recorded '
+                 '(default: SUBJECTS_DIR/reconall_state.json)'
+            )
+
+    args = parser.parse_args()
+    if args.dataset_path is None and args.dataset_index is None:
+        parser.error('You must specify: --dataset-path or --dataset-index.')
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stdout)
+
+    dataset_path = args.dataset_path
+    dataset_index = None
+    if args.subjects is None or dataset_path is None:
+        dataset_index_filename = args.dataset_index
+        if dataset_index_filename is None:
+            dataset_index_filename = os.path.join(dataset_path, 'dataset_index.json')
+        dataset_index = load_dataset_index(dataset_index_filename, dataset_path, rebuild=args.rebuild_index)
+        if dataset_path is None:
+            dataset_path = dataset_index['dataset_path']
+
+    subjects_dir = args.subjects_dir
+    if subjects_dir is None:
+        subjects_dir = os.path.join(dataset_path, 'reconall_data')
+    if not os.path.isdir(subjects_dir):
+        os.makedirs(subjects_dir)
+    state_filename = args.state_filename
+    if state_filename is None:
+        state_filename = os.path.join(subjects_dir, 'reconall_state.json')
 
+    subjects = args.subjects
+    if subjects is None:
+        subjects = index_subjects(dataset_index, t1=True)
+    state = load_state(state_filename)
+    jobs = reconall_jobs(dataset_path, subjects_dir, subjects, state, args.backend, args.reconall, args.cpus)
+    save_state(state_filename, state)
+    failed = run_stage(jobs, state, state_filename, os.path.join(subjects_dir, 'reconall_logs'),
+                       args.jobs, args.retries)
+    if failed:
+        logging.info('recon-all failed for %d subjects: %s' % (len(failed), ', '.join(failed)))
+    sys.exit(1 if failed else 0)
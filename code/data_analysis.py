@@ -11,7 +11,6 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pickle
 import os
-import glob
 from scipy.signal import hilbert
 from scipy.stats import entropy
 from bct import (degrees_und, distance_bin, transitivity_bu, clustering_coef_bu,
@@ -19,6 +18,9 @@ from bct import (degrees_und, distance_bin, transitivity_bu, clustering_coef_bu,
                  community_louvain)
 from sklearn.cluster import KMeans
 
+from roi_store import load_subject_roi_timeseries, roi_subject_path, roi_nnetworks
+from synchrony import PhaseSynchrony, threshold_graphs
+from sliding_window import sliding_window_size, window_name, sliding_window_average, sliding_window_averages
 
 
 def dump_golden_subjects_json(output_base_path, network_type, subjects, window_size, data_analysis_type):
@@ -105,23 +107,37 @@ def estimate_cost(N, G):
 
 
 def calculate_healthy_optimal_k(roi_input_basepath, output_basepath, subjects, network_type, window_size, window_type,
-                                data_analysis_type, nclusters, rand_ind):
+                                data_analysis_type, nclusters, rand_ind, window_stride=1, window_taper='boxcar',
+                                ica_aroma_type=None, glm_denoise=None, band=None):
 
     # Calculate how many networks keys there are.
     nnetwork_keys = check_number_networks(subjects, roi_input_basepath,
-                                          network_type)
+                                          network_type, ica_aroma_type, glm_denoise, band)
 
     # Calculate the optimal k for each subject's network.
+    window_path = window_name(window_type, window_size, window_stride, window_taper)
+    subject_paths = [data_analysis_subject_basepath(output_basepath, network_type, window_path, data_analysis_type,
+                                                    nclusters, rand_ind, subject)
+                     for subject in subjects]
+    healthy_k_optima = subjects_optimal_k(subjects, subject_paths, nnetwork_keys)
+
+    # Dump json file with optimal k and timestamp for the current analysis
+    output_path = os.path.split(subject_paths[-1])[0]
+    dump_optimal_k(output_path, healthy_k_optima)
+
+    dump_golden_subjects_json(output_path, network_type, subjects, window_size, data_analysis_type)
+
+    return
+
+
+def subjects_optimal_k(subjects, subject_paths, nnetwork_keys):
+    """ Calculate the optimal k of each network for the subjects whose dynamic
+    measures are saved in subject_paths (see calculate_subject_optimal_k).
+    Returns a dictionary mapping each network to the list of optimal k of the
+    subjects. """
     healthy_k_optima = {key: [] for key in range(nnetwork_keys)}
-    for subject in subjects:
+    for subject, subject_path in zip(subjects, subject_paths):
         # Load the mean_synchrony for the subject.
-        subject_path = data_analysis_subject_basepath(output_basepath,
-                                                      network_type,
-                                                      window_type,
-                                                      data_analysis_type,
-                                                      nclusters,
-                                                      rand_ind,
-                                                      subject)
         dynamic_measures = pickle.load(
             open(os.path.join(subject_path, 'dynamic_measures.pickle'),
                  'rb'))
@@ -139,35 +155,32 @@ def calculate_healthy_optimal_k(roi_input_basepath, output_basepath, subjects, n
             indices = zip(indices[0], indices[1])
             healthy_k_optima[network].append(
                 calculate_subject_optimal_k(mean_synchrony[network], indices))
+    return healthy_k_optima
 
+
+def dump_optimal_k(output_path, healthy_k_optima):
+    """ Log the mean optimal k of each network and save the optimal k of the
+    subjects in output_path/optimal_k.json """
     # Find optimal mean of healthy subjects.
-    k_optima = {}
     logging.info('')
     logging.info('* OPTIMAL MEAN THRESHOLD:')
-    for network in range(nnetwork_keys):
-        k_optima[network] = np.mean(healthy_k_optima[network])
-        logging.info('Network %d: %3f' % (network, k_optima[network]))
+    for network in sorted(healthy_k_optima):
+        logging.info('Network %d: %3f' % (network, np.mean(healthy_k_optima[network])))
     logging.info('')
 
-    # Dump json file with optimal k and timestamp for the current analysis
-    output_path = os.path.split(subject_path)[0]
     with open(os.path.join(output_path, 'optimal_k.json'), 'w') as json_file:
         json.dump(healthy_k_optima, json_file, indent=4)
 
-    dump_golden_subjects_json(output_path, network_type, subjects, window_size, data_analysis_type)
-
-    return
-
 
-def check_number_networks(subjects, input_basepath, network_type):
+def check_number_networks(subjects, input_basepath, network_type, ica_aroma_type=None, glm_denoise=None, band=None):
     # Calculate how many networks keys there are. The number of networks for within network
-    # is defined based on the known extracted ROIs.
+    # is defined based on the known extracted ROIs (see roi_store.roi_nnetworks).
     # We use the first subject for this purpose.
-    data_path = os.path.join(input_basepath, subjects[0])
     if network_type == 'between_network':
         nnetwork_keys = 1
     elif network_type == 'within_network':
-        nnetwork_keys = len(glob.glob1(data_path, "within_network_*.txt"))
+        nnetwork_keys = roi_nnetworks(roi_subject_path(input_basepath, subjects[0], ica_aroma_type, glm_denoise,
+                                                       band))
     elif network_type == 'full_network':
         nnetwork_keys = 1
     else:
@@ -176,85 +189,137 @@ def check_number_networks(subjects, input_basepath, network_type):
 
 
 def calculate_dynamic_measures(subjects, input_basepath, output_basepath, network_type, window_size, window_type,
-                               data_analysis_type, ica_aroma_type, glm_denoise, nclusters, rand_ind, pipeline_call=True):
+                               data_analysis_type, ica_aroma_type, glm_denoise, nclusters, rand_ind, pipeline_call=True,
+                               window_stride=1, window_taper='boxcar', band=None):
     # Find number of network for dataset
-    nnetwork_keys = check_number_networks(subjects, input_basepath, network_type)
+    nnetwork_keys = check_number_networks(subjects, input_basepath, network_type, ica_aroma_type, glm_denoise, band)
 
     # Compute synchrony, metastability and mean synchrony for each subject, both
     # globally and pairwise.
     if pipeline_call:
         logging.info('* DYNAMIC MEASURES')
 
+    # Cohort stores of the ROI time series, opened once for all subjects.
+    cohorts = {}
     for subject in subjects:
         if pipeline_call:
             logging.info('Subject ID:        %s' %(subject))
 
-        # Calculate Hilbert transform for the network(s).
-        # Import ROI data for each VOI.
-        # The actual data depends on the network type.
-        hilbert_transforms = {}
-
-        # Obtain correct path for the extracted ROI according with the type of ica_aroma and glm_analysis
-        if (ica_aroma_type in ['aggr', 'nonaggr']) and (glm_denoise is False):
-            analysis_path = os.path.join('ica', subject, ''.join(['icaroma_', ica_aroma_type]))
-        elif (ica_aroma_type in ['aggr', 'nonaggr']) and (glm_denoise is True):
-            analysis_path = os.path.join('ica_glm', subject, ''.join(['icaroma_', ica_aroma_type]))
-        elif (ica_aroma_type == 'no_ica') and (glm_denoise is True):
-            analysis_path = os.path.join('glm', subject)
-
-        if network_type == 'between_network':
-            data_path = os.path.join(input_basepath, analysis_path, 'between_network.txt')
-            data = np.genfromtxt(data_path)
-            hilbert_transforms[0] = compute_hilbert_tranform(data)
-        elif network_type == 'within_network':
-            for network in range(nnetwork_keys):
-                data_path = os.path.join(input_basepath, analysis_path, 'within_network_%d.txt' % network)
-                data = np.genfromtxt(data_path)
-                hilbert_transforms[network] = compute_hilbert_tranform(data)
-        elif network_type == 'full_network':
-            data_path = os.path.join(input_basepath, analysis_path, 'full_network.txt')
-            data = np.genfromtxt(data_path)
-            hilbert_transforms[0] = compute_hilbert_tranform(data)
-
-        # Calculate data synchrony following Hellyer-2015_Cognitive.
-        dynamic_measures = {}
-        for network in hilbert_transforms:
-            # Apply sliding windowing if required.
-            hilbert_transform = hilbert_transforms[network]
-            if window_type == 'sliding':
-                hilbert_transform = apply_sliding_window(hilbert_transform,
-                                                         window_size)
-
-            # Calculate synchrony, metastability and mean synchrony.
-            synchrony, \
-            mean_synchrony, \
-            metastability, \
-            global_synchrony, \
-            global_metastability = calculate_phi(hilbert_transform)
-
-            # Save the results for later dump.
-            dynamic_measures[network] = {
-                'synchrony': synchrony,
-                'metastability': metastability,
-                'mean_synchrony': mean_synchrony,
-                'global_synchrony': global_synchrony,
-                'global_metastability': global_metastability
-            }
+        dynamic_measures = subject_dynamic_measures(input_basepath, subject, network_type, nnetwork_keys,
+                                                    window_size, window_type, ica_aroma_type, glm_denoise,
+                                                    cohorts, window_stride, window_taper, band)
 
         # Dump results for all networks, for this subject, into a pickle file.
         subject_path = data_analysis_subject_basepath(output_basepath,
-                                                      network_type, window_type,
+                                                      network_type,
+                                                      window_name(window_type, window_size,
+                                                                  window_stride, window_taper),
                                                       data_analysis_type, nclusters, rand_ind,
                                                       subject)
         if not os.path.exists(subject_path):
             os.makedirs(subject_path)
-        pickle.dump(dynamic_measures,
-                    open(os.path.join(subject_path, 'dynamic_measures.pickle'),
-                         'wb'))
+        dump_dynamic_measures(subject_path, dynamic_measures)
         if pipeline_call:
             logging.info('    Done')
 
 
+def subject_dynamic_measures(input_basepath, subject, network_type, nnetwork_keys, window_size, window_type,
+                             ica_aroma_type, glm_denoise, cohorts=None, window_stride=1, window_taper='boxcar',
+                             band=None):
+    """ Compute the synchrony, metastability and mean synchrony of each network
+    of a subject, both globally and pairwise. The measures only depend on the
+    ROI time series and the window, not on the number of clusters. If band is
+    passed, the ROI time series filtered on the ROI with that band are used
+    (see roi_store.load_subject_roi_timeseries). """
+    return subject_window_dynamic_measures(input_basepath, subject, network_type, nnetwork_keys, [window_size],
+                                           window_type, ica_aroma_type, glm_denoise, cohorts,
+                                           window_stride, window_taper, band)[window_size]
+
+
+def subject_window_dynamic_measures(input_basepath, subject, network_type, nnetwork_keys, window_sizes, window_type,
+                                    ica_aroma_type, glm_denoise, cohorts=None, window_stride=1,
+                                    window_taper='boxcar', band=None):
+    """ Compute the dynamic measures of a subject (see subject_dynamic_measures)
+    for each of the window_sizes. The ROI time series and their Hilbert
+    transform are loaded once, and all the sliding windows are averaged from a
+    single pass (see sliding_window_averages).
+
+    Returns a dictionary mapping each window size to the dynamic measures. With
+    the non-sliding window type the window size is not used, and all sizes
+    share the same measures. """
+    # Calculate Hilbert transform for the network(s).
+    # Import ROI data for each VOI.
+    # The actual data depends on the network type.
+    hilbert_transforms = {}
+
+    # The path of the extracted ROI depends on the type of ica_aroma and
+    # glm_analysis (see roi_store.roi_analysis_path).
+    if network_type == 'between_network':
+        data = load_subject_roi_timeseries(input_basepath, subject, 'between_network',
+                                           ica_aroma_type, glm_denoise, cohorts, band)
+        hilbert_transforms[0] = compute_hilbert_tranform(data)
+    elif network_type == 'within_network':
+        for network in range(nnetwork_keys):
+            data = load_subject_roi_timeseries(input_basepath, subject, 'within_network_%d' % network,
+                                               ica_aroma_type, glm_denoise, cohorts, band)
+            hilbert_transforms[network] = compute_hilbert_tranform(data)
+    elif network_type == 'full_network':
+        data = load_subject_roi_timeseries(input_basepath, subject, 'full_network',
+                                           ica_aroma_type, glm_denoise, cohorts, band)
+        hilbert_transforms[0] = compute_hilbert_tranform(data)
+
+    # Calculate data synchrony following Hellyer-2015_Cognitive.
+    window_dynamic_measures = dict((window_size, {}) for window_size in window_sizes)
+    for network in hilbert_transforms:
+        # Apply sliding windowing if required.
+        if window_type == 'sliding':
+            slided = apply_sliding_windows(hilbert_transforms[network], window_sizes,
+                                           window_stride, window_taper)
+        else:
+            slided = {None: hilbert_transforms[network]}
+
+        network_measures = {}
+        for window_size in window_sizes:
+            key = window_size if window_type == 'sliding' else None
+            if key not in network_measures:
+                network_measures[key] = network_dynamic_measures(slided[key])
+            window_dynamic_measures[window_size][network] = network_measures[key]
+    return window_dynamic_measures
+
+
+def network_dynamic_measures(hilbert_transform):
+    """ Compute the dynamic measures of the (regions x time) Hilbert transform
+    of a network (see calculate_phi) """
+    # Calculate synchrony, metastability and mean synchrony.
+    synchrony, \
+    mean_synchrony, \
+    metastability, \
+    global_synchrony, \
+    global_metastability = calculate_phi(hilbert_transform)
+
+    # Save the results for later dump.
+    return {
+        'synchrony': synchrony,
+        'metastability': metastability,
+        'mean_synchrony': mean_synchrony,
+        'global_synchrony': global_synchrony,
+        'global_metastability': global_metastability
+    }
+
+
+def dump_dynamic_measures(subject_path, dynamic_measures):
+    """ Save the dynamic measures of all networks of a subject in
+    dynamic_measures.pickle. The synchrony is computed on demand in memory
+    (see calculate_phi), but saved as a plain (regions x regions x time) array
+    so that the file does not depend on synchrony.PhaseSynchrony. """
+    saved_measures = {}
+    for network in dynamic_measures:
+        saved_measures[network] = dict(dynamic_measures[network])
+        saved_measures[network]['synchrony'] = np.asarray(dynamic_measures[network]['synchrony'])
+    with open(os.path.join(subject_path, 'dynamic_measures.pickle'), 'wb') as f:
+        pickle.dump(saved_measures, f)
+
+
 def compute_hilbert_tranform(data):
     """ Perform Hilbert Transform on given data. This allows extraction of phase
      information of the empirical data"""
@@ -267,62 +332,36 @@ def compute_hilbert_tranform(data):
     return hiltrans
 
 
-def slice_window_avg(array, window_size):
-    """ Perform convolution on the specified sliding window. By using the
-    'valid' mode the last time points will be discarded. """
-    window = np.ones(int(window_size)) / float(window_size)
-    return np.convolve(array, window, 'valid')
-    # TODO: use a less conservative approach for convolution ('full' instead of
-    # 'valid').
+def apply_sliding_window(hilbert_transform, window_size, window_stride=1, window_taper='boxcar'):
+    """ Average each region over sliding windows of window_size time points.
+    As with the 'valid' mode of a convolution, the last time points that do not
+    fill a window are discarded (see sliding_window_average). """
+    return sliding_window_average(hilbert_transform, window_size, window_stride, window_taper)
 
 
-def apply_sliding_window(hilbert_transform, window_size):
-    nregions = hilbert_transform.shape[0]
-    ntpoints = hilbert_transform.shape[1]
-    slided = np.zeros((nregions, ntpoints - window_size + 1), dtype=complex)
-    for roi in range(nregions):
-        slided[roi, :] = slice_window_avg(hilbert_transform[roi, :],
-                                          window_size)
-    return slided
+def apply_sliding_windows(hilbert_transform, window_sizes, window_stride=1, window_taper='boxcar'):
+    """ Apply the sliding windows of all window_sizes from a single pass over
+    the data (see sliding_window_averages). """
+    return sliding_window_averages(hilbert_transform, window_sizes, window_stride, window_taper)
 
 
 def calculate_phi(hiltrans):
-    n_regions = hiltrans.shape[0]
-    hilbert_t_points = hiltrans.shape[1]
-
-    # Find indices of regions for pairwise comparison and reshuffle them
-    # to obtain a tuple for each pairwise comparison.
-    # As the comparision is symmetric computation power can be saved by
-    # calculating only the lower diagonal matrix.
-    indices = np.tril_indices(n_regions)
-    indices = zip(indices[0], indices[1])
-
-    phi = np.zeros((n_regions, n_regions, hilbert_t_points), dtype=complex)
-    mean_synchrony = np.zeros((n_regions, n_regions))
-    pair_metastability = np.zeros((n_regions, n_regions))
+    """ Calculate the pairwise synchrony (Kuramoto order parameter of each
+    pair of regions) at each time point, its mean and standard deviation
+    (metastability) over time, and the global synchrony and metastability.
+
+    The order parameter of regions i and j is |(z_i + z_j) / 2|, where z are
+    the unit phase vectors of the regions. The synchrony is returned as a
+    PhaseSynchrony, which keeps only the phases and computes blocks of the
+    (regions x regions x time) tensor on demand; the mean synchrony and the
+    metastability are streamed over blocks of regions. """
     # find the phase angle of the data
     phase_angle = np.angle(hiltrans)
-
-    for index in indices:
-        # obtain phase of the data is already saved inside hiltrans
-        # calculate pairwise order parameter
-        phi[index[0], index[1], :] += np.exp(phase_angle[index[0]] * 1j)
-        phi[index[0], index[1], :] += np.exp(phase_angle[index[1]] * 1j)
-
-        # divide the obtained results by the number of regions, which in
-        # this case is 2.
-        phi[index[0], index[1], :] /= 2
-        # each value represent the synchrony between two regions over all time points
-        mean_synchrony[index[0], index[1]] = np.mean(abs(phi[index[0], index[1], :]))
-        # each value represent the standard deviation of synchrony over the time points
-        pair_metastability[index[0], index[1]] = np.std(abs(phi[index[0], index[1], :]))
-    synchrony = abs(phi)
-    # mirror array so that lower and upper matrix are identical
-    # Mirror each time point of synchrony
-    for time_p in range(synchrony.shape[2]):
-        synchrony[:, :, time_p] = mirror_array(synchrony[:, :, time_p])
-    mean_synchrony = mirror_array(mean_synchrony)
-    pair_metastability = mirror_array(pair_metastability)
+    synchrony = PhaseSynchrony.from_phase_angle(phase_angle)
+    # each value represent the synchrony between two regions over all time points
+    mean_synchrony = synchrony.mean()
+    # each value represent the standard deviation of synchrony over the time points
+    pair_metastability = synchrony.std()
     global_synchrony = np.mean(np.tril(mean_synchrony), -1)
     global_metastability = np.std(global_synchrony)
     return synchrony, mean_synchrony, pair_metastability, \
@@ -383,6 +422,190 @@ def bold_plot_threshold(data, n_regions, threshold=1.3):
     return thr_data
 
 
+def threshold_synchrony(synchrony, k_optima):
+    """ Binarise the synchrony matrix of each network at each time point with
+    the mean optimal threshold of the network (see calculate_healthy_optimal_k;
+    k_optima is the content of optimal_k.json).
+
+    The synchrony is symmetric, so the binary matrices are returned condensed,
+    with each pair of regions once, and bit-packed (see synchrony.PackedGraphs).
+    Their diagonal, the synchrony of each region with itself, is always 1. """
+    synchrony_bins = {}
+    for network in synchrony:
+        synchrony_bins[network] = threshold_graphs(synchrony[network], np.mean(k_optima[str(network)]))
+    return synchrony_bins
+
+
+def synchrony_shannon_entropy(synchrony_bins, nclusters):
+    """ Cluster the binarised synchrony matrices of each network over time
+    with k-means and calculate the Shannon entropy of the cluster labels. The
+    features of each time point are its condensed edges. """
+    measure = 'synchrony'
+    shannon_entropy_measures = {}
+    for network in synchrony_bins:
+        # One row of edges per time point.
+        synchrony_bin_flat = np.ascontiguousarray(np.transpose(synchrony_bins[network].condensed()))
+
+        # Calculate the k means for synchrony.
+        kmeans = KMeans(n_clusters=nclusters)
+        kmeans.fit_transform(synchrony_bin_flat)
+        kmeans_labels = kmeans.labels_
+        synchrony_entropy = entropy(kmeans_labels)
+
+        # Save the results.
+        shannon_entropy_measures[network] = {}
+        shannon_entropy_measures[network][measure] = {
+            'centroids': kmeans.cluster_centers_,
+            'entropy': synchrony_entropy
+        }
+    return shannon_entropy_measures
+
+
+def calculate_graph_measures(synchrony, synchrony_bins):
+    """ Calculate the graph theory measures of each network at each time point
+    from the packed binarised synchrony matrices (see threshold_synchrony).
+    The measures do not depend on the number of clusters. The square matrices
+    needed by bct are unpacked one block of time points at a time.
+
+    Returns the graph theory measures and the global efficiency of the
+    networks. """
+    graph_theory_measures = {}
+    networks_global_efficiency = {}
+    for network in synchrony_bins:
+        nregions = synchrony[network].shape[0]
+        ntpoints = synchrony_bins[network].ntpoints
+        graph_theory_measures[network] = {}
+
+        # Note: Because K-means will be performed over time and of the way
+        #  the data is defined all measures will need to transposed.
+        community_affiliation = np.arange(nregions) + 1
+        community_0 = 0
+        flexibility_time = np.zeros((ntpoints, nregions), dtype=bool)
+        degree_centrality = np.zeros((nregions, ntpoints))
+        cluster_coefficient = np.zeros((nregions, ntpoints))
+        global_efficiency = np.zeros(ntpoints)
+        weight = np.zeros((ntpoints, nregions))
+        for start, stop, synchrony_bin in synchrony_bins[network].iter_expanded_time_blocks(diagonal=1):
+            for t in range(start, stop):
+                W = synchrony_bin[:, :, t - start]
+
+                # Modularity/Flexibility:
+                # -------------------
+                # For the fist iteration each node is considered part of a separate community. All following
+                # iterations use previous knowledge to find only the nodes that change communities.
+                community_t, q = community_louvain(W, ci=community_affiliation)
+                # True: are the elemets that are different between time points
+                flexibility_time[t] = community_t - community_0 != 0
+                community_0 = community_t
+                community_affiliation = community_t
+
+                # Cluster Coefficient:
+                # ----------------------
+                # Calculate cluster Coefficient at each time point.
+                cluster_coefficient[:, t] = clustering_coef_bu(W)
+
+                # # Shortest path length:
+                # # ----------------------
+                # # Calculate the shortest path length between all nodes. The matrix for eacht time point
+                # # is flattened.
+                # _, tmp_shortest_path = breadthdist(W)
+                # shortest_path[:, t] = tmp_shortest_path.flatten()
+
+                # Global efficiency
+                # ----------------------
+                # Returns only a float. For comparision between groups the standard deviation will
+                # be used.
+                global_efficiency[t] = efficiency_bin(W)
+
+            # Degree centrality:
+            # -------------------
+            # Number of links connected to each node
+            degree_centrality[:, start:stop] = degrees_und(synchrony_bin)
+
+            # Weight
+            # -------------------
+            w = np.multiply(synchrony[network][:, :, start:stop], synchrony_bin)
+            # Averaging over the last axis of a contiguous copy sums in the
+            # same order as averaging each w[:, roi, t].
+            weight[start:stop] = np.mean(np.ascontiguousarray(np.transpose(w, (2, 1, 0))), axis=2)
+
+        # Eliminate first time point
+        flexibility_time = flexibility_time[1:]
+
+        # calculate flexibility for each node
+        flexibility_regions = np.sum(flexibility_time, axis=0)
+        graph_theory_measures[network]['flexibility'] = flexibility_regions
+        graph_theory_measures[network]['degree_centrality'] = np.transpose(degree_centrality)
+        graph_theory_measures[network]['cluster_coefficient'] = np.transpose(cluster_coefficient)
+        graph_theory_measures[network]['global_efficiency'] = global_efficiency
+        graph_theory_measures[network]['weight'] = weight
+    return graph_theory_measures, networks_global_efficiency
+
+
+def graph_measures_shannon_entropy(graph_theory_measures, nclusters):
+    """ Perform K-means and calculate Shannon Entropy for each graph theory
+    measurement of each network """
+    shannon_entropy_measures = {}
+    for network in graph_theory_measures:
+        kmeans = KMeans(n_clusters=nclusters)
+        shannon_entropy_measures[network] = {}
+        # Select only keys that will be used on the analysis
+        kmeans_measures = ['weight', 'cluster_coefficient', 'degree_centrality']
+        for measure in kmeans_measures:
+            shannon_entropy_measures[network][measure] = {}
+            measures = shannon_entropy_measures[network][measure]
+
+            # Calculate the k-means for the current measure.
+            kmeans.fit_transform(graph_theory_measures[network][measure])
+
+            # Save the results in the measure-specific dictionary.
+            measures['labels'] = kmeans.labels_
+            measures['entropy'] = entropy(shannon_entropy_measures[network][measure]['labels'])
+    return shannon_entropy_measures
+
+
+def dump_graph_measures(subject_path, graph_theory_measures, networks_global_efficiency):
+    pickle.dump(graph_theory_measures,
+                open(os.path.join(subject_path,
+                                  'graph_analysis_measures.pickle'),
+                     'wb'))
+    pickle.dump(networks_global_efficiency,
+                open(os.path.join(subject_path,
+                                  'global_efficiency.pickle'),
+                     'wb'))
+
+
+def bold_analysis(subject_path, data, nclusters):
+    """ Threshold the BOLD time series of the full network, cluster them over
+    time with k-means and save the Shannon entropy of the cluster labels in
+    subject_path """
+    # Apply a threshold to the data. We use the 1.3 default value.
+    nregions = data.shape[0]
+    thr_data = bold_plot_threshold(data, nregions, threshold=1.3)
+
+    # Save thresholded image of BOLD.
+    fig = plt.figure()
+    plt.imshow(thr_data, interpolation='nearest')
+    fig.savefig(os.path.join(subject_path, 'bold.png'))
+    plt.clf()
+    plt.close()
+
+    # Perfom k-means on the BOLD signal.
+    # Because BOLD only support one network and for compatibility with results.
+    network = 0
+    measure = 'BOLD'
+    bold_shannon_entropy = {network: {measure: {}}}
+    kmeans_bold = KMeans(n_clusters=nclusters)
+    kmeans_bold.fit_transform(np.transpose(thr_data))
+    kmeans_bold_labels = kmeans_bold.labels_
+
+    # Calculate Shannon Entropy.
+    bold_shannon_entropy[network][measure]['entropy'] = entropy(kmeans_bold_labels)
+    pickle.dump(bold_shannon_entropy,
+                open(os.path.join(subject_path, 'bold_shannon.pickle'),
+                     'wb'))
+
+
 def data_analysis_subject_basepath(basepath,
                                    network_type,
                                    window_type,
@@ -397,6 +620,18 @@ def data_analysis_subject_basepath(basepath,
     else:
         return os.path.join(subject_base_path, subject)
 
+def data_analysis_shared_basepath(basepath,
+                                  network_type,
+                                  window_type,
+                                  subject=None):
+    """ Folder of the results that depend neither on the data analysis type
+    nor on the number of clusters (dynamic measures, optimal thresholds and
+    graph measures), computed once by a parameter sweep (see sweep.py). """
+    shared_basepath = os.path.join(basepath, network_type, window_type, 'shared')
+    if subject is None:
+        return shared_basepath
+    return os.path.join(shared_basepath, subject)
+
 def data_analysis(subjects,
                   input_basepath,
                   output_basepath,
@@ -407,7 +642,11 @@ def data_analysis(subjects,
                   glm_denoise,
                   nclusters,
                   rand_ind,
-                  golden_subjects):
+                  golden_subjects,
+                  window_size=sliding_window_size,
+                  window_stride=1,
+                  window_taper='boxcar',
+                  band=None):
     ''' Compute the main analysis. This function calculates the synchrony,
     metastability and perform the graph analysis.
 
@@ -421,6 +660,13 @@ def data_analysis(subjects,
         - sliding_window: Sliding window used to reduce noise of the time serie
         - graph_analysis: Defines if graph_analysis will be performed or not
         - window_size:    Defined size of the sliding window
+        - window_stride:  Number of time points between two sliding windows
+        - window_taper:   Taper of the sliding window (see
+                          sliding_window.window_tapers)
+        - band:           Temporal filter band of the ROI time series filtered
+                          on the ROI (see temporal_filter.filter_bands). By
+                          default the ROI time series of the filtered images
+                          are used
         - n_time_points:  number ot time points of the data set
         - n_regions:      Define number of regions used in the data set
         - network_comp:   Define type of coparision that will be carried out.
@@ -436,7 +682,7 @@ def data_analysis(subjects,
         raise ValueError('The BOLD data analysis only works with ' +
                          'full_network networks.')
 
-    window_size = 5
+    window_path = window_name(window_type, window_size, window_stride, window_taper)
 
     logging.info('--------------------------------------------------------------------')
     logging.info(' Data Analysis')
@@ -446,6 +692,9 @@ def data_analysis(subjects,
     logging.info('Network type:        %s' %(network_type))
     logging.info('Window type:         %s' %(window_type))
     logging.info('Window size:         %d' %(window_size))
+    logging.info('Window stride:       %d' %(window_stride))
+    logging.info('Window taper:        %s' %(window_taper))
+    logging.info('Band:                %s' %(band))
     logging.info('Data analysis type:  %s' %(data_analysis_type))
     logging.info('ICA-AROMA type:      %s' %(ica_aroma_type))
     logging.info('Nclusters:           %d' %(nclusters))
@@ -454,7 +703,8 @@ def data_analysis(subjects,
     logging.info('')
 
     calculate_dynamic_measures(subjects, input_basepath, output_basepath, network_type, window_size, window_type,
-                               data_analysis_type, ica_aroma_type, glm_denoise, nclusters, rand_ind)
+                               data_analysis_type, ica_aroma_type, glm_denoise, nclusters, rand_ind,
+                               window_stride=window_stride, window_taper=window_taper, band=band)
 
     # Calculate the optimal k from the healthy subjects only.
     # Note: This is not needed with the BOLD data analysis. The optimal k will
@@ -464,10 +714,11 @@ def data_analysis(subjects,
         # Note: Golden subjects's id are hardcoded inside the json file and are not used for further analysis
         if golden_subjects:
             calculate_healthy_optimal_k(input_basepath, output_basepath, subjects, network_type, window_size, window_type,
-                                               data_analysis_type, nclusters, rand_ind)
+                                               data_analysis_type, nclusters, rand_ind, window_stride, window_taper,
+                                               ica_aroma_type, glm_denoise, band)
             return
         else:
-            filepath = data_analysis_subject_basepath(output_basepath, network_type, window_type, data_analysis_type,
+            filepath = data_analysis_subject_basepath(output_basepath, network_type, window_path, data_analysis_type,
                                                        nclusters, rand_ind, subjects[0])
             filepath = os.path.join(os.path.split(filepath)[0], 'optimal_k.json')
 
@@ -475,11 +726,12 @@ def data_analysis(subjects,
                 k_optima = json.load(f)
 
     # Calculate the Shannon entropy measures for every subject.
+    cohorts = {}
     for subject in subjects:
 
         subject_path = data_analysis_subject_basepath(output_basepath,
                                                       network_type,
-                                                      window_type,
+                                                      window_path,
                                                       data_analysis_type,
                                                       nclusters,
                                                       rand_ind,
@@ -489,33 +741,9 @@ def data_analysis(subjects,
 
         # Behave differently based on data analysis type.
         if data_analysis_type == 'BOLD':
-            # Apply a threshold to the data. We use the 1.3 default value.
-            data_path = os.path.join(input_basepath, subject, ica_aroma_type, 'full_network.txt')
-            data = np.genfromtxt(data_path)
-            nregions = data.shape[0]
-            thr_data = bold_plot_threshold(data, nregions, threshold=1.3)
-
-            # Save thresholded image of BOLD.
-            fig = plt.figure()
-            plt.imshow(thr_data, interpolation='nearest')
-            fig.savefig(os.path.join(subject_path, 'bold.png'))
-            plt.clf()
-            plt.close()
-
-            # Perfom k-means on the BOLD signal.
-            # Because BOLD only support one network and for compatibility with results.
-            network = 0
-            measure = 'BOLD'
-            bold_shannon_entropy = {network: {measure: {}}}
-            kmeans_bold = KMeans(n_clusters=nclusters)
-            kmeans_bold.fit_transform(np.transpose(thr_data))
-            kmeans_bold_labels = kmeans_bold.labels_
-
-            # Calculate Shannon Entropy.
-            bold_shannon_entropy[network][measure]['entropy'] = entropy(kmeans_bold_labels)
-            pickle.dump(bold_shannon_entropy,
-                        open(os.path.join(subject_path, 'bold_shannon.pickle'),
-                             'wb'))
+            data = load_subject_roi_timeseries(input_basepath, subject, 'full_network',
+                                               ica_aroma_type, glm_denoise, cohorts, band)
+            bold_analysis(subject_path, data, nclusters)
         else:
             # This first part of the code is common to the synchrony and graph
             # analysis data analysis types.
@@ -524,7 +752,8 @@ def data_analysis(subjects,
             dynamic_measures = pickle.load(
                 open(os.path.join(subject_path, 'dynamic_measures.pickle'),
                      'rb'))
-            nnetwork_keys = check_number_networks(subjects, input_basepath, network_type)
+            nnetwork_keys = check_number_networks(subjects, input_basepath, network_type, ica_aroma_type,
+                                                  glm_denoise, band)
 
             if len(dynamic_measures.keys()) != nnetwork_keys:
                 raise ValueError('Inconsistent number of networks for ' +
@@ -536,45 +765,11 @@ def data_analysis(subjects,
 
             # Threshold the synchrony matrix at each time point using the
             # optimal threshold and save the output.
-            synchrony_bins = {}
-            for network in range(nnetwork_keys):
-                nregions = synchrony[network].shape[0]
-                ntpoints = synchrony[network].shape[2]
-                indices = np.tril_indices(nregions)
-                indices = zip(indices[0], indices[1])
-                synchrony_bin = np.zeros((nregions, nregions, ntpoints))
-                for t in range(ntpoints):
-                    for index in indices:
-                        if synchrony[network][index[0], index[1], t] >= np.mean(k_optima[str(network)]):
-                            synchrony_bin[index[0], index[1], t] = 1
-                    synchrony_bin[:, :, t] = mirror_array(synchrony_bin[:, :, t])
-                synchrony_bins[network] = synchrony_bin
+            synchrony_bins = threshold_synchrony(synchrony, k_optima)
 
             # The actual measures we save depend on the data analysis type.
             if data_analysis_type == 'synchrony':
-                measure = 'synchrony'
-                shannon_entropy_measures = {}
-                for network in range(nnetwork_keys):
-                    # Flatten the synchrony bin for the current network.
-                    nregions = synchrony_bins[network].shape[0]
-                    ntpoints = synchrony_bins[network].shape[2]
-                    synchrony_bin_flat = np.zeros((ntpoints, nregions * nregions))
-                    for t in range(ntpoints):
-                        synchrony_bin_flat[t, :] = \
-                            np.ndarray.flatten(synchrony_bins[network][:, :, t])
-
-                    # Calculate the k means for synchrony.
-                    kmeans = KMeans(n_clusters=nclusters)
-                    kmeans.fit_transform(synchrony_bin_flat)
-                    kmeans_labels = kmeans.labels_
-                    synchrony_entropy = entropy(kmeans_labels)
-
-                    # Save the results.
-                    shannon_entropy_measures[network] = {}
-                    shannon_entropy_measures[network][measure] = {
-                        'centroids': kmeans.cluster_centers_,
-                        'entropy': synchrony_entropy
-                    }
+                shannon_entropy_measures = synchrony_shannon_entropy(synchrony_bins, nclusters)
 
                 # Dump the results in a pickle file.
                 pickle.dump(shannon_entropy_measures,
@@ -582,114 +777,16 @@ def data_analysis(subjects,
                                               'synchrony_shannon_entropy_measures.pickle'),
                                  'wb'))
             elif data_analysis_type == 'graph_analysis':
-                graph_theory_measures = {}
-                shannon_entropy_measures = {}
-                for network in range(nnetwork_keys):
-                    nregions = synchrony_bins[network].shape[0]
-                    ntpoints = synchrony_bins[network].shape[2]
-                    graph_theory_measures[network] = {}
-
-                    # Modularity/Flexibility:
-                    # -------------------
-                    # For the fist iteration each node is considered part of a separate community. All following iterations
-                    # use previous knowledge to find only the nodes that change communities.
-                    community_affiliation = np.arange(nregions) + 1
-                    community_0 = 0
-                    flexibility_time = np.zeros((ntpoints, nregions), dtype=bool)
-                    for t in range(ntpoints):
-                        W = synchrony_bins[network][:, :, t]
-                        community_t, q = community_louvain(W, ci=community_affiliation)
-                        # True: are the elemets that are different between time points
-                        flexibility_time[t] = community_t - community_0 != 0
-                        community_0 = community_t
-                        community_affiliation = community_t
-
-                    # Eliminate first time point
-                    flexibility_time = flexibility_time[1:]
-
-                    # calculate flexibility for each node
-                    flexibility_regions = np.sum(flexibility_time, axis=0)
-                    graph_theory_measures[network]['flexibility'] = flexibility_regions
-
-
-                    # Note: Because K-means will be performed over time and of the way
-                    #  the data is defined all measures will need to transposed.
-                    # Degree centrality:
-                    # -------------------
-                    # Number of links connected to each node
-                    degree_centrality = degrees_und(synchrony_bins[network])
-                    graph_theory_measures[network]['degree_centrality'] = \
-                        np.transpose(degree_centrality)
-
-                    # Cluster Coefficient:
-                    # ----------------------
-                    # Calculate cluster Coefficient at each time point.
-                    cluster_coefficient = np.zeros((nregions, ntpoints))
-                    for t in range(ntpoints):
-                        cluster_coefficient[:, t] = clustering_coef_bu(synchrony_bins[network][:, :, t])
-                    graph_theory_measures[network]['cluster_coefficient'] = np.transpose(cluster_coefficient)
-
-
-                    # # Shortest path length:
-                    # # ----------------------
-                    # # Calculate the shortest path length between all nodes. The matrix for eacht time point
-                    # # is flattened.
-                    # shortest_path = np.zeros((nregions * nregions, ntpoints))
-                    # for t in range(ntpoints):
-                    #     _, tmp_shortest_path = breadthdist(synchrony_bins[network][:, :, t])
-                    #     shortest_path[:, t] = tmp_shortest_path.flatten()
-                    # graph_theory_measures[network]['shortest_path'] = np.transpose(shortest_path)
-
-                    # Global efficiency
-                    # ----------------------
-                    # Returns only a float. For comparision between groups the standard deviation will
-                    # be used.
-                    networks_global_efficiency = {}
-                    global_efficiency = np.zeros(ntpoints)
-                    for t in range(ntpoints):
-                        global_efficiency[t] = efficiency_bin(synchrony_bins[network][:, :, t])
-                    graph_theory_measures[network]['global_efficiency'] = global_efficiency
-
-                    # Weight
-                    # -------------------
-                    weight = np.zeros((ntpoints, nregions))
-                    w = np.multiply(synchrony[network], synchrony_bins[network])
-                    for t in range(ntpoints):
-                        for roi in range(nregions):
-                            weight[t, roi] = np.average(w[:, roi, t])
-                    graph_theory_measures[network]['weight'] = weight
-
-                    # Perform K-means and calculate Shannon Entropy for each
-                    # graph theory measurement.
-                    kmeans = KMeans(n_clusters=nclusters)
-                    shannon_entropy_measures[network] = {}
-                    # Select only keys that will be used on the analysis
-                    kmeans_measures = ['weight', 'cluster_coefficient', 'degree_centrality']
-                    for measure in kmeans_measures:
-                        shannon_entropy_measures[network][measure] = {}
-                        measures = shannon_entropy_measures[network][measure]
-
-                        # Calculate the k-means for the current measure.
-                        kmeans.fit_transform(graph_theory_measures[network][measure])
-
-                        # Save the results in the measure-specific dictionary.
-                        measures['labels'] = kmeans.labels_
-                        measures['entropy'] = entropy(shannon_entropy_measures[network][measure]['labels'])
-
+                graph_theory_measures, networks_global_efficiency = \
+                    calculate_graph_measures(synchrony, synchrony_bins)
+                shannon_entropy_measures = graph_measures_shannon_entropy(graph_theory_measures, nclusters)
 
                 # Dump results into three pickle files.
-                pickle.dump(graph_theory_measures,
-                            open(os.path.join(subject_path,
-                                              'graph_analysis_measures.pickle'),
-                                 'wb'))
+                dump_graph_measures(subject_path, graph_theory_measures, networks_global_efficiency)
                 pickle.dump(shannon_entropy_measures,
                             open(os.path.join(subject_path,
                                               'graph_analysis_shannon_entropy_measures.pickle'),
                                  'wb'))
-                pickle.dump(networks_global_efficiency,
-                            open(os.path.join(subject_path,
-                                              'global_efficiency.pickle'),
-                                 'wb'))
             else:
                 raise ValueError('Unrecognised data analysis type: %s' %
                                  (data_analysis_type))
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+""" Index of the dataset (ds000030): subjects, diagnosis groups, functional
+runs and the preprocessed images available for each subject.
+
+The index is built once by walking the dataset and the preprocessing outputs,
+and cached as a JSON file, so that the stages can query it instead of probing
+the (network) filesystem for every subject. Rebuild it (--rebuild) after new
+subjects are added or preprocessed. """
+import os
+import re
+import sys
+import csv
+import json
+import time
+import logging
+from argparse import ArgumentParser
+
+from roi_store import discover_roi_variants
+
+
+# Diagnosis of the participants.tsv of ds000030 of the groups compared in the
+# analysis.
+diagnosis_groups = {'CONTROL': 'healthy', 'SCHZ': 'schizo'}
+
+
+def read_participants(dataset_path):
+    """ Read participants.tsv. Returns a dictionary mapping each subject to
+    its row (a dictionary of the columns). """
+    filename = os.path.join(dataset_path, 'participants.tsv')
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        return dict((row['participant_id'], row) for row in csv.DictReader(f, delimiter='\t'))
+
+
+def subject_runs(subject_path):
+    """ Return the functional runs of a subject as a dictionary mapping each
+    task to the (relative) path of its bold image """
+    runs = {}
+    func_path = os.path.join(subject_path, 'func')
+    if os.path.isdir(func_path):
+        for filename in sorted(os.listdir(func_path)):
+            match = re.match(r'.*_task-([a-zA-Z0-9]+).*_bold\.nii(\.gz)?$', filename)
+            if match:
+                runs[match.group(1)] = os.path.join('func', filename)
+    return runs
+
+
+def build_dataset_index(dataset_path, variant_basepaths=()):
+    """ Build the index of the dataset. variant_basepaths are the folders with
+    the preprocessed images (e.g. the temp_filt and denoised folders of the
+    preprocessing outputs), whose variants are indexed per subject (see
+    roi_store.discover_roi_variants).
+
+    Returns a dictionary with:
+        - subjects: for each subject, its diagnosis, group (see
+          diagnosis_groups), whether it has a T1 image and its functional runs
+        - variants: for each variant base path and subject, the variants found
+    """
+    participants = read_participants(dataset_path)
+    subjects = {}
+    for subject in sorted(os.listdir(dataset_path)):
+        subject_path = os.path.join(dataset_path, subject)
+        if not subject.startswith('sub-') or not os.path.isdir(subject_path):
+            continue
+        diagnosis = participants.get(subject, {}).get('diagnosis')
+        subjects[subject] = {
+            'diagnosis': diagnosis,
+            'group': diagnosis_groups.get(diagnosis),
+            't1': os.path.exists(os.path.join(subject_path, 'anat', '%s_T1w.nii.gz' % subject)),
+            'runs': subject_runs(subject_path)
+        }
+
+    variants = {}
+    for basepath in variant_basepaths:
+        basepath = os.path.abspath(basepath)
+        filtered = os.path.basename(os.path.normpath(basepath)) != 'denoised'
+        variants[basepath] = dict((subject, discover_roi_variants(basepath, subject, filtered))
+                                  for subject in subjects)
+
+    return {'timestamp': time.strftime("%Y%m%d%H%M%S"),
+            'dataset_path': os.path.abspath(dataset_path),
+            'subjects': subjects,
+            'variants': variants}
+
+
+def save_dataset_index(filename, index):
+    with open(filename + '.tmp', 'w') as json_file:
+        json.dump(index, json_file, indent=4, sort_keys=True)
+    os.rename(filename + '.tmp', filename)
+
+
+def load_dataset_index(filename, dataset_path=None, variant_basepaths=(), rebuild=False):
+    """ Load the cached index of the dataset, building it (see
+    build_dataset_index) if it does not exist or if rebuild is True. """
+    if not rebuild and os.path.exists(filename):
+        with open(filename) as json_file:
+            return json.load(json_file)
+    if dataset_path is None:
+        raise ValueError('Dataset index not found: %s. Pass the dataset path to build it.' % (filename))
+    logging.info('Building dataset index: %s' % (filename))
+    index = build_dataset_index(dataset_path, variant_basepaths)
+    save_dataset_index(filename, index)
+    return index
+
+
+def index_subjects(index, group=None, tasks=(), t1=False):
+    """ Return the sorted subjects of the index, optionally only those of a
+    group, with a run of all tasks and/or with a T1 image """
+    return sorted(subject for subject, info in index['subjects'].items()
+                  if (group is None or info['group'] == group) and
+                  all(task in info['runs'] for task in tasks) and
+                  (not t1 or info['t1']))
+
+
+def subject_groups(index):
+    """ Return a dictionary mapping each subject of the index to its group """
+    return dict((subject, info['group']) for subject, info in index['subjects'].items())
+
+
+def diagnosis_group(subject, groups=None):
+    """ Return the group ('healthy', 'schizo' or None) of a subject. Without a
+    groups dictionary (see subject_groups) the group is inferred from the
+    subject ID: healthy subjects are numbered below 40000 and schizophrenic
+    patients above 50000. """
+    if groups is not None:
+        return groups.get(subject)
+    number = int(subject.strip('sub-'))
+    if number < 40000:
+        return 'healthy'
+    elif number > 50000:
+        return 'schizo'
+    return None
+
+
+def subject_variants(index, input_basepath, subject):
+    """ Return the indexed variants of a subject in input_basepath (see
+    roi_store.discover_roi_variants), or None if the folder is not indexed """
+    if index is None:
+        return None
+    variants = index['variants'].get(os.path.abspath(input_basepath))
+    if variants is None:
+        return None
+    return variants.get(subject, [])
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(
+            description='Build the index of the dataset'
+            )
+    parser.add_argument(
+            '-d', '--dataset-path', dest='dataset_path', required=True,
+            help='Path of the BIDS dataset (with participants.tsv)'
+            )
+    parser.add_argument(
+            '-o', '--index-file', dest='index_filename', default=None,
+            help='Index file (default: DATASET_PATH/dataset_index.json)'
+            )
+    parser.add_argument(
+            '-v', '--variant-paths', dest='variant_basepaths', nargs='*', default=[],
+            help='Folders with preprocessed images to index (temp_filt or denoised)'
+            )
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stdout)
+    index_filename = args.index_filename
+    if index_filename is None:
+        index_filename = os.path.join(args.dataset_path, 'dataset_index.json')
+    index = load_dataset_index(index_filename, args.dataset_path, args.variant_basepaths, rebuild=True)
+    logging.info('%d subjects indexed' % (len(index['subjects'])))
@@ -1,23 +1,230 @@
-def most_likely_roi_network(netw, ntw_data, net_filter, boolean_ntw, boolean_mask, region):
+def most_likely_roi_network(voxels, offsets, boolean_ntw):
+    """ For each region find the networks with the highest probability of
+    including it. The networks are visited in order and a region is assigned to
+    every network whose overlap with the region is larger than the overlap of
+    all the previous networks. The overlap is the fraction of the network voxels
+    that belong to the region.
+
+    The overlaps of all regions and networks are computed at once as a
+    (regions x networks) contingency table, using the region voxel indices
+    returned by roi_voxel_index and the boolean (x, y, z, network) volume.
+
+    Returns a dictionary with the regions assigned to each network and the
+    (regions x networks) boolean assignment matrix."""
     import numpy as np
-    """ iterate over each network and find the one with the highest probability of
-    including a specific region. Once the best network is found, compute the mean bold from
-    that region. The mean bold will be used to compare among regions that belong
-    to the same network"""
-
-    p_network = 0
-    for n_network in range(ntw_data.shape[3]):
-        # find voxels that correspond to that region in the current network
-        filtered_mask = np.multiply(boolean_ntw[:, :, :, n_network], boolean_mask)
-        tmp = np.sum(filtered_mask) / float(np.sum(boolean_ntw[:, :, :, n_network]))
-        if tmp > p_network:
-            netw[n_network].append(region)
-            net_filter[:, :, :, n_network] = np.add(filtered_mask, net_filter[:, :, :, n_network])
-            p_network = tmp
-    return netw, net_filter
-
-
-def dump_extract_roi_json_(output_base_path, network_type, subjects, ica_aroma_type, segmented_image_filename):
+
+    nregions = len(offsets) - 1
+    nnetworks = boolean_ntw.shape[3]
+    ntw_voxels = boolean_ntw.reshape(-1, nnetworks)
+
+    # Number of voxels of each region that belong to each network.
+    overlap = np.zeros((nregions, nnetworks))
+    nonempty = np.diff(offsets) > 0
+    if np.any(nonempty):
+        overlap[nonempty] = np.add.reduceat(ntw_voxels[voxels].astype(np.float64),
+                                            offsets[:-1][nonempty], axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p_network = overlap / np.sum(ntw_voxels, axis=0, dtype=np.float64)
+
+    # A network is selected when its probability exceeds the best probability
+    # found among the previous networks (starting from 0).
+    best_previous = np.zeros((nregions, nnetworks))
+    best_previous[:, 1:] = np.maximum.accumulate(np.nan_to_num(p_network), axis=1)[:, :-1]
+    with np.errstate(invalid='ignore'):
+        assignment = p_network > np.maximum(best_previous, 0)
+
+    networks = {network: [int(region) for region in np.flatnonzero(assignment[:, network])]
+                for network in range(nnetworks)}
+    return networks, assignment
+
+
+def roi_voxel_index(masks):
+    """ Concatenate the flat voxel indices of each mask into a single index
+    array. The voxels of region i are voxels[offsets[i]:offsets[i + 1]], which
+    allows all regions to be averaged at once (see average_roi_timeseries)."""
+    import numpy as np
+
+    voxels = [np.flatnonzero(mask) for mask in masks]
+    offsets = np.zeros(len(voxels) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(region_voxels) for region_voxels in voxels])
+    if len(voxels):
+        voxels = np.concatenate(voxels).astype(np.int64)
+    else:
+        voxels = np.zeros(0, dtype=np.int64)
+    return voxels, offsets
+
+
+def average_roi_timeseries(image_data, voxels, offsets, dtype=None):
+    """ Average the BOLD signal of every region for every time point in a
+    single pass over the 4D image. All the region voxels are gathered at once
+    and summed per region with np.add.reduceat. Regions without voxels are set
+    to nan, as the mean of an empty selection would be. The averages are
+    computed in dtype (float64 by default).
+
+    Returns a (regions x time) matrix."""
+    import numpy as np
+
+    if dtype is None:
+        dtype = np.float64
+    nregions = len(offsets) - 1
+    ntpoints = image_data.shape[3]
+    avg = np.full((nregions, ntpoints), np.nan, dtype=dtype)
+    counts = np.diff(offsets)
+    nonempty = counts > 0
+    if not np.any(nonempty):
+        return avg
+
+    # (voxels x time) matrix with the signal of all regions
+    data = image_data[np.unravel_index(voxels, image_data.shape[:3])]
+    data = np.asarray(data, dtype=dtype)
+    # Empty regions do not own any voxel, hence the start of the non empty
+    # regions delimit the sums of each region.
+    sums = np.add.reduceat(data, offsets[:-1][nonempty], axis=0)
+    avg[nonempty] = sums / counts[nonempty][:, np.newaxis]
+    return avg
+
+
+def iter_image_chunks(image, chunk_mb=256):
+    """ Walk a 4D nibabel image in chunks of consecutive time points. The
+    number of time points per chunk is chosen so that a float64 chunk does not
+    exceed chunk_mb megabytes; at least one volume is always read.
+
+    Uncompressed images are read through the image's array proxy (.nii files
+    are memory-mapped). Slicing the proxy of a compressed image decompresses
+    the file from its start for every chunk, so compressed images are instead
+    streamed through a single file object: the time points are the slowest
+    axis on disk, hence each chunk is the next block of the file.
+
+    Yields the index of the first time point of the chunk and the chunk."""
+    import numpy as np
+    import nibabel as nib
+    from nibabel.openers import ImageOpener
+    from nibabel.volumeutils import apply_read_scaling
+
+    ntpoints = image.shape[3]
+    volume_bytes = np.prod(image.shape[:3]) * np.dtype(np.float64).itemsize
+    chunk_tpoints = max(1, int(chunk_mb * 1024 ** 2 // volume_bytes))
+    filename = image.get_filename()
+    if filename is None or not nib.is_proxy(image.dataobj) or \
+            not filename.endswith(('.gz', '.bz2')) or len(image.shape) != 4:
+        for start in range(0, ntpoints, chunk_tpoints):
+            stop = min(start + chunk_tpoints, ntpoints)
+            yield start, np.asanyarray(image.dataobj[..., start:stop])
+        return
+
+    dtype = image.header.get_data_dtype()
+    volume_size = int(np.prod(image.shape[:3]))
+    with ImageOpener(filename) as fileobj:
+        fileobj.seek(image.dataobj.offset)
+        for start in range(0, ntpoints, chunk_tpoints):
+            stop = min(start + chunk_tpoints, ntpoints)
+            nbytes = volume_size * (stop - start) * dtype.itemsize
+            data = fileobj.read(nbytes)
+            if len(data) != nbytes:
+                raise ValueError('Unexpected end of the image data: %s.' % (filename))
+            chunk = np.frombuffer(data, dtype=dtype).reshape(image.shape[:3] + (stop - start,), order='F')
+            yield start, apply_read_scaling(chunk, image.dataobj.slope, image.dataobj.inter)
+
+
+def extract_roi_timeseries(image, voxels, offsets, chunk_mb=256, dtype=None):
+    """ Stream the 4D image chunk by chunk (see iter_image_chunks) and average
+    the BOLD signal of every region (see average_roi_timeseries). Peak memory is
+    bounded by chunk_mb instead of the size of the image.
+
+    Returns a (regions x time) matrix."""
+    import numpy as np
+
+    if dtype is None:
+        dtype = np.float64
+    avg = np.zeros((len(offsets) - 1, image.shape[3]), dtype=dtype)
+    for start, chunk in iter_image_chunks(image, chunk_mb):
+        avg[:, start:start + chunk.shape[3]] = average_roi_timeseries(chunk, voxels, offsets, dtype)
+    return avg
+
+
+def expand_design_matrix(design, derivatives=False, squares=False):
+    """ Expand a (time x regressor) design matrix with the temporal derivatives
+    of the regressors (backward differences, the first time point is 0) and/or
+    with the squares of all the columns (regressors and derivatives). """
+    import numpy as np
+
+    columns = [design]
+    if derivatives:
+        derivative = np.zeros_like(design)
+        derivative[1:] = np.diff(design, axis=0)
+        columns.append(derivative)
+    if squares:
+        columns.append(np.square(np.hstack(columns)))
+    return np.hstack(columns)
+
+
+def build_design_matrix(subject,
+                        input_file,
+                        segmented_image,
+                        lookuptable,
+                        output_basepath,
+                        ica_aroma_type='no_ica',
+                        derivatives=False,
+                        squares=False,
+                        chunk_mb=256,
+                        atlas_cache_dir=None):
+    """
+    Build the CSF/WM nuisance design matrix used by FSL's GLM. The mean signal
+    of every region of the (CSF/WM) segmented_image listed in the lookuptable is
+    computed in float32 in a single pass over the input image (see
+    extract_roi_timeseries). Derivatives and squares of the regressors can be
+    added (see expand_design_matrix).
+
+    The design matrix (time x regressor) is saved as a text file in
+    output_basepath/subject (in a icaroma_<type> sub-folder for ICA-AROMA
+    outputs) and its path is returned.
+    """
+    import os
+    import numpy as np
+    import nibabel as nib
+    import logging
+    # Note: Imported here because nipype's Function nodes only run the source
+    #       code of this function.
+    from extract_roi import extract_roi_timeseries, expand_design_matrix
+    from atlas_index import load_atlas_index
+
+    logging.info('Design matrix:     %s' % (subject))
+    subject_path = os.path.join(output_basepath, subject)
+    if ica_aroma_type in ['aggr', 'nonaggr']:
+        subject_path = os.path.join(subject_path, ''.join(['icaroma_', ica_aroma_type]))
+    if not os.path.exists(subject_path):
+        os.makedirs(subject_path)
+
+    atlas = load_atlas_index(segmented_image, lookuptable, cache_dir=atlas_cache_dir)
+    image = nib.load(input_file)
+    avg = extract_roi_timeseries(image, atlas['voxels'], atlas['offsets'], chunk_mb, dtype=np.float32)
+
+    # Fsl GLM design matrix requires (time x regressor)
+    design = expand_design_matrix(np.transpose(avg), derivatives, squares)
+    design_output_file = os.path.join(subject_path, 'wm_csf_time_course.txt')
+    np.savetxt(design_output_file, design, delimiter=' ', fmt='%.7e')
+    return design_output_file
+
+
+def recorded_path(path, shared_paths=None):
+    """ Path of a file as recorded in the provenance, the manifests and
+    extract_roi.json. shared_paths is the (scratch base path, shared base
+    path) pair of a job running on a scratch folder (see scratch.stage_in), in
+    which case the paths under the scratch base path are recorded as their
+    location on the shared filesystem (see scratch.scratch_to_shared). """
+    import os
+    from scratch import scratch_to_shared
+
+    if path is None or shared_paths is None:
+        return path
+    scratch_base_path, shared_base_path = shared_paths
+    if os.path.relpath(path, scratch_base_path).split(os.sep)[0] == os.pardir:
+        return path
+    return scratch_to_shared(path, scratch_base_path, shared_base_path)
+
+
+def dump_extract_roi_json_(output_base_path, network_type, subjects, ica_aroma_type, segmented_image_filename,
+                           extracted_subjects=None):
     import json
     import time
     import os
@@ -32,12 +239,415 @@ def dump_extract_roi_json_(output_base_path, network_type, subjects, ica_aroma_t
     parameters_list['subjects'] = subjects
     parameters_list['ica_aroma_type'] = ica_aroma_type
     parameters_list['segmentation_image'] = segmented_image_filename
+    if extracted_subjects is not None:
+        parameters_list['extracted_subjects'] = extracted_subjects
 
     # Dump json file.
     with open(os.path.join(output_path, 'extract_roi.json'), 'w') as json_file:
         json.dump(parameters_list, json_file, indent=4)
 
 
+def extract_roi_manifest_entry(input_file, atlas_key, parameters, previous=None, shared_paths=None):
+    """ Describe the inputs of an extraction: the content hash of the input
+    image, the atlas index key (see atlas_index.atlas_index_key) and the
+    parameters. The input image is only hashed again when its size or
+    modification time differ from the previous entry. The input image is
+    recorded on the shared filesystem if shared_paths is passed (see
+    recorded_path). """
+    import os
+    from atlas_index import file_hash
+
+    stat = os.stat(input_file)
+    input_stat = [stat.st_size, stat.st_mtime]
+    input_image = recorded_path(input_file, shared_paths)
+    if previous is not None and previous.get('input_image') == input_image and \
+       previous.get('input_stat') == input_stat:
+        input_hash = previous['input_hash']
+    else:
+        input_hash = file_hash(input_file)
+    return {'input_image': input_image,
+            'input_stat': input_stat,
+            'input_hash': input_hash,
+            'atlas': atlas_key,
+            'parameters': parameters}
+
+
+def same_extract_roi_inputs(entry, previous):
+    """ Check if two manifest entries (see extract_roi_manifest_entry) describe
+    the same inputs """
+    if previous is None:
+        return False
+    return all(entry[key] == previous.get(key) for key in ['input_hash', 'atlas', 'parameters'])
+
+
+def load_extract_roi_manifest(filename):
+    """ Load the manifest of the extractions of a subject: one entry per
+    network type (see extract_roi_manifest_entry). """
+    import os
+    import json
+
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as json_file:
+        return json.load(json_file)
+
+
+def save_extract_roi_manifest(filename, manifest):
+    import os
+    import json
+
+    with open(filename + '.tmp', 'w') as json_file:
+        json.dump(manifest, json_file, indent=4, sort_keys=True)
+    os.rename(filename + '.tmp', filename)
+
+
+def check_extract_roi_manifest(subject_path, input_file, network_type, ica_aroma_type, glm_denoise, atlas,
+                               atlas_key, bands=None, shared_paths=None):
+    """ Check in the subject's extract_roi_manifest.json if the ROI time series
+    were already extracted from the same input image, atlas and parameters, and
+    if all the outputs exist (in the folder of each band, if bands are passed,
+    see save_filtered_subject_roi).
+
+    Returns whether the extraction can be skipped and the manifest entry of the
+    inputs (see extract_roi_manifest_entry). """
+    import os
+    from atlas_index import atlas_networks
+    from roi_store import roi_timeseries_names
+
+    manifest_filename = os.path.join(subject_path, 'extract_roi_manifest.json')
+    manifest = load_extract_roi_manifest(manifest_filename)
+    parameters = {'network_type': network_type,
+                  'ica_aroma_type': ica_aroma_type,
+                  'glm_denoise': glm_denoise}
+    output_paths = [subject_path]
+    if bands is not None:
+        parameters['bands'] = [[name, highpass_sigma, lowpass_sigma] for name, highpass_sigma, lowpass_sigma in bands]
+        output_paths = [os.path.join(subject_path, name) for name, _, _ in bands]
+    manifest_entry = extract_roi_manifest_entry(input_file, atlas_key, parameters, manifest.get(network_type),
+                                                shared_paths)
+    outputs = roi_timeseries_names(network_type, len(atlas_networks(atlas)))
+    if same_extract_roi_inputs(manifest_entry, manifest.get(network_type)) and \
+       all(os.path.exists(os.path.join(output_path, output + '.npy'))
+           for output_path in output_paths for output in outputs):
+        if manifest_entry != manifest[network_type]:
+            # Only the modification time changed.
+            update_extract_roi_manifest(subject_path, network_type, manifest_entry)
+        return True, manifest_entry
+    return False, manifest_entry
+
+
+def update_extract_roi_manifest(subject_path, network_type, manifest_entry):
+    import os
+
+    manifest_filename = os.path.join(subject_path, 'extract_roi_manifest.json')
+    manifest = load_extract_roi_manifest(manifest_filename)
+    manifest[network_type] = manifest_entry
+    save_extract_roi_manifest(manifest_filename, manifest)
+
+
+def network_roi_voxels(atlas, network_type):
+    """ Region voxel index (see roi_voxel_index) of the ROIs of a network type """
+    if network_type == 'full_network':
+        return atlas['voxels'], atlas['offsets']
+    elif network_type == 'within_network':
+        # The regions of all networks are averaged together so that the image
+        # is only streamed once.
+        return atlas['within_voxels'], atlas['within_offsets']
+    elif network_type == 'between_network':
+        return atlas['between_voxels'], atlas['between_offsets']
+    raise ValueError('Unrecognised network type: %s.' % (network_type))
+
+
+def save_subject_roi(subject_path, network_type, avg, atlas, affine, provenance):
+    """ Save the ROI time series (avg) of a network type, computed from the
+    voxels returned by network_roi_voxels. """
+    import os
+    import nibabel as nib
+    from atlas_index import atlas_networks, atlas_mask
+    from roi_store import save_roi_timeseries
+
+    if network_type == 'full_network':
+        # Write the mask of all regions, unless already present.
+        mask_filename = os.path.join(subject_path, 'mask.nii.gz')
+        if not os.path.exists(mask_filename):
+            nib.save(nib.Nifti1Image(atlas_mask(atlas), affine), mask_filename)
+        save_roi_timeseries(os.path.join(subject_path, 'full_network'),
+                            avg, atlas['region_names'], provenance)
+    elif network_type == 'within_network':
+        # Calculate the BOLD signal for the selected regions in the
+        # network. The labels from the original segmentation will be used
+        # to identify the regions of interest.
+        # The number of networks is kept in the sidecars, for the data
+        # analysis (see roi_store.roi_nnetworks).
+        network_offsets = atlas['network_offsets']
+        networks = atlas_networks(atlas)
+        for network, regions in networks.items():
+            save_roi_timeseries(os.path.join(subject_path,
+                                             'within_network_%d' % network),
+                                avg[network_offsets[network]:network_offsets[network + 1]],
+                                atlas['region_names'][regions],
+                                dict(provenance, network=network, nnetworks=len(networks)))
+    elif network_type == 'between_network':
+        # Calculate the BOLD signal across the selected networks. This
+        # procedure is similar to the full network approach, however,
+        # the BOLD activity of all regions enclosed in one network is
+        # taken into account.
+        save_roi_timeseries(os.path.join(subject_path,
+                                         'between_network'),
+                            avg, ['network_%d' % network for network in range(avg.shape[0])],
+                            provenance)
+    else:
+        raise ValueError('Unrecognised network type: %s.' % (network_type))
+
+
+def save_filtered_subject_roi(subject_path, network_type, avg, atlas, affine, provenance, bands):
+    """ Filter the ROI time series (avg) with each band (a list of (name,
+    highpass_sigma, lowpass_sigma), see temporal_filter.filter_bands) and save
+    them in the band's folder inside subject_path (see save_subject_roi). """
+    import os
+    from temporal_filter import bandpass_filter
+
+    for name, highpass_sigma, lowpass_sigma in bands:
+        band_path = os.path.join(subject_path, name)
+        if not os.path.exists(band_path):
+            os.makedirs(band_path)
+        band_provenance = dict(provenance, band=name, highpass_sigma=highpass_sigma, lowpass_sigma=lowpass_sigma)
+        save_subject_roi(band_path, network_type, bandpass_filter(avg, highpass_sigma, lowpass_sigma),
+                         atlas, affine, band_provenance)
+
+
+def extract_subject_roi(subject,
+                        network_type,
+                        glm_denoise,
+                        input_file,
+                        output_basepath,
+                        ica_aroma_type,
+                        atlas,
+                        chunk_mb=256,
+                        provenance=None,
+                        atlas_key=None,
+                        bands=None,
+                        shared_paths=None):
+    """ Extract the ROI time series of one subject (see extract_roi). The atlas
+    is the index returned by atlas_index.load_atlas_index and atlas_key its key.
+    The provenance dictionary is stored with the time series, together with the
+    subject and the input image (see recorded_path for shared_paths).
+
+    If bands are passed, the ROI time series are extracted from the unfiltered
+    image and filtered with each band (see save_filtered_subject_roi).
+
+    The inputs of every extraction are recorded in the subject's
+    extract_roi_manifest.json. The extraction is skipped when the input image,
+    the atlas and the parameters did not change and the outputs exist.
+
+    Returns True if the time series were extracted and False if they had
+    already been extracted before. """
+    import os
+    import nibabel as nib
+    import logging
+    from roi_store import roi_analysis_path, denoised_image_filename
+
+    logging.info('')
+    logging.info('Subject ID:        %s' %(subject))
+
+    # Generate the output folder. Specify input filename
+    analysis_path = roi_analysis_path(subject, ica_aroma_type, glm_denoise)
+    subject_path = os.path.join(output_basepath, analysis_path)
+    if not os.path.exists(subject_path):
+        os.makedirs(subject_path)
+    roi_base_path = input_file
+    input_file_path = os.path.join(roi_base_path, analysis_path,
+                                   denoised_image_filename(ica_aroma_type, glm_denoise,
+                                                           filtered=bands is None))
+
+    # Check if ROIs has been extracted from the same inputs in case yes, early
+    # exit
+    extracted, manifest_entry = check_extract_roi_manifest(subject_path, input_file_path, network_type,
+                                                           ica_aroma_type, glm_denoise, atlas, atlas_key, bands,
+                                                           shared_paths)
+    if extracted:
+        logging.info('Time course for this subject was already extracted')
+        return False
+
+    image = nib.load(input_file_path)
+    provenance = dict(provenance if provenance is not None else {},
+                      subject=subject,
+                      network_type=network_type,
+                      input_image=recorded_path(input_file_path, shared_paths),
+                      chunk_mb=chunk_mb)
+    voxels, offsets = network_roi_voxels(atlas, network_type)
+    avg = extract_roi_timeseries(image, voxels, offsets, chunk_mb)
+    if bands is None:
+        save_subject_roi(subject_path, network_type, avg, atlas, image.affine, provenance)
+    else:
+        save_filtered_subject_roi(subject_path, network_type, avg, atlas, image.affine, provenance, bands)
+    update_extract_roi_manifest(subject_path, network_type, manifest_entry)
+    return True
+
+
+def prefetch_image_chunks(images, chunk_mb=256, depth=1):
+    """ Iterate over the chunks (see iter_image_chunks) of several images,
+    reading them ahead in a background thread. Decompressing the next chunk
+    (zlib releases the GIL) then overlaps with processing the current one. At
+    most depth chunks are queued, so about depth + 2 chunks are in memory.
+
+    Yields the index of the image, the index of the first time point of the
+    chunk and the chunk. """
+    import threading
+    try:
+        import queue
+    except ImportError:
+        import Queue as queue
+
+    chunks = queue.Queue(maxsize=depth)
+
+    def read_chunks():
+        try:
+            for n_image, image in enumerate(images):
+                for start, chunk in iter_image_chunks(image, chunk_mb):
+                    chunks.put((n_image, start, chunk))
+        except Exception as error:
+            chunks.put((None, None, error))
+        chunks.put(None)
+
+    reader = threading.Thread(target=read_chunks)
+    reader.daemon = True
+    reader.start()
+    while True:
+        item = chunks.get()
+        if item is None:
+            break
+        if item[0] is None:
+            raise item[2]
+        yield item
+    reader.join()
+
+
+def extract_subject_variants(subject,
+                             network_type,
+                             input_file,
+                             output_basepath,
+                             atlas,
+                             chunk_mb=256,
+                             provenance=None,
+                             atlas_key=None,
+                             bands=None,
+                             variants=None,
+                             shared_paths=None):
+    """ Extract the ROI time series of all the preprocessing variants of one
+    subject found under input_file (see roi_store.discover_roi_variants), or
+    of the variants passed (e.g. queried from dataset_index), in a single
+    process. The next image is decompressed while the current one is
+    reduced (see prefetch_image_chunks). Variants whose inputs did not change
+    are skipped (see check_extract_roi_manifest). If bands are passed, the
+    unfiltered images are used and the ROI time series filtered with each band
+    (see save_filtered_subject_roi). See recorded_path for shared_paths.
+
+    Returns the list of (ica_aroma_type, glm_denoise) variants extracted. """
+    import os
+    import numpy as np
+    import nibabel as nib
+    import logging
+    from roi_store import discover_roi_variants
+
+    logging.info('')
+    logging.info('Subject ID:        %s' %(subject))
+
+    if variants is None:
+        variants = discover_roi_variants(input_file, subject, filtered=bands is None)
+    pending = []
+    for variant in variants:
+        subject_path = os.path.join(output_basepath, variant['analysis_path'])
+        if not os.path.exists(subject_path):
+            os.makedirs(subject_path)
+        extracted, manifest_entry = check_extract_roi_manifest(subject_path, variant['input_file'], network_type,
+                                                               variant['ica_aroma_type'], variant['glm_denoise'],
+                                                               atlas, atlas_key, bands, shared_paths)
+        if extracted:
+            logging.info('Time course already extracted: %s' % (variant['analysis_path']))
+        else:
+            pending.append((variant, subject_path, manifest_entry))
+
+    voxels, offsets = network_roi_voxels(atlas, network_type)
+    images = [nib.load(variant['input_file']) for variant, _, _ in pending]
+    avgs = [np.zeros((len(offsets) - 1, image.shape[3])) for image in images]
+    for n_image, start, chunk in prefetch_image_chunks(images, chunk_mb):
+        avgs[n_image][:, start:start + chunk.shape[3]] = average_roi_timeseries(chunk, voxels, offsets)
+
+    for (variant, subject_path, manifest_entry), image, avg in zip(pending, images, avgs):
+        logging.info('Time course extracted:         %s' % (variant['analysis_path']))
+        variant_provenance = dict(provenance if provenance is not None else {},
+                                  subject=subject,
+                                  network_type=network_type,
+                                  ica_aroma_type=variant['ica_aroma_type'],
+                                  glm_denoise=variant['glm_denoise'],
+                                  input_image=recorded_path(variant['input_file'], shared_paths),
+                                  chunk_mb=chunk_mb)
+        if bands is None:
+            save_subject_roi(subject_path, network_type, avg, atlas, image.affine, variant_provenance)
+        else:
+            save_filtered_subject_roi(subject_path, network_type, avg, atlas, image.affine, variant_provenance,
+                                      bands)
+        update_extract_roi_manifest(subject_path, network_type, manifest_entry)
+    return [(variant['ica_aroma_type'], variant['glm_denoise']) for variant, _, _ in pending]
+
+
+# Atlas index of the worker processes of extract_roi (see init_extract_roi_worker).
+_worker_atlas = None
+
+
+def init_extract_roi_worker(atlas_path):
+    """ Attach a worker process to the cached atlas index. The index is
+    memory-mapped, so all workers share the same copy instead of receiving a
+    pickled one. """
+    from atlas_index import open_atlas_index
+    global _worker_atlas
+    _worker_atlas = open_atlas_index(atlas_path)
+
+
+def extract_subject_roi_worker(parameters):
+    """ Run extract_subject_roi in a worker process. The parameters are the
+    arguments of extract_subject_roi, without the atlas. """
+    parameters = dict(parameters, atlas=_worker_atlas)
+    return extract_subject_roi(**parameters)
+
+
+def extract_subject_variants_worker(parameters):
+    """ Run extract_subject_variants in a worker process. The parameters are
+    the arguments of extract_subject_variants, without the atlas. """
+    parameters = dict(parameters, atlas=_worker_atlas)
+    return extract_subject_variants(**parameters)
+
+
+def update_cohort_stores(output_basepath, network_type, subjects, extracted_subjects, ica_aroma_type,
+                         glm_denoise, bands=None):
+    """ Add the ROI time series of the subjects to the cohort stores (see
+    roi_store.append_cohort_timeseries). Extracted subjects are always
+    (re)written, the others only if they are missing from the store or their
+    row does not match their own file (see roi_store.cohort_row_is_current).
+    If bands are passed, the time series of each band (see
+    save_filtered_subject_roi) are added to the store of the band. """
+    import os
+    from roi_store import (roi_subject_path, roi_nnetworks, roi_timeseries_names, cohort_store_path,
+                           load_cohort_index, load_roi_timeseries, load_roi_metadata, append_cohort_timeseries,
+                           cohort_row_is_current)
+
+    band_names = [None] if bands is None else [name for name, _, _ in bands]
+    for subject in subjects:
+        for band in band_names:
+            subject_path = roi_subject_path(output_basepath, subject, ica_aroma_type, glm_denoise, band)
+            nnetworks = roi_nnetworks(subject_path) if network_type == 'within_network' else None
+            for name in roi_timeseries_names(network_type, nnetworks):
+                basename = os.path.join(subject_path, name)
+                if not os.path.exists(basename + '.npy'):
+                    continue
+                store = cohort_store_path(output_basepath, ica_aroma_type, glm_denoise, name, band)
+                index = load_cohort_index(store)
+                if subject in extracted_subjects or not cohort_row_is_current(index, subject, basename):
+                    append_cohort_timeseries(store, subject, load_roi_timeseries(basename),
+                                             load_roi_metadata(basename)['regions'], source=basename)
+
+
 def extract_roi(subjects,
                 network_type,
                 extract_csf_wm,
@@ -47,13 +657,21 @@ def extract_roi(subjects,
                 lookuptable,
                 output_basepath,
                 ica_aroma_type,
-                network_mask_filename=None):
+                network_mask_filename=None,
+                chunk_mb=256,
+                atlas_cache_dir=None,
+                jobs=1,
+                all_variants=False,
+                bands=None,
+                dataset_index=None,
+                cohort_stores=True,
+                shared_paths=None):
     """
     Iterate over all subjects and all regions (specified by the segmented_image).
      For each region find the correspoding BOLD signal. To reduce the
      dimensionality the signal belonging to the same anatomical regions are
      averaged for each time point. The BOLD signal for each region is then saved
-     in a txt file for each subject
+     for each subject (see roi_store.save_roi_timeseries)
 
      Inputs:
          - subjects_id   : List of subjects id
@@ -71,11 +689,43 @@ def extract_roi(subjects,
                            specified
          - network_comp  : Allow for comparison between networks and inside
                            networks
+         - chunk_mb      : Memory budget (in MB) used to stream the images
+         - atlas_cache_dir: Folder where the atlas index is cached. By default
+                           an atlas_index folder next to the segmented_image
+         - jobs          : Number of subjects processed in parallel
+         - all_variants  : Extract all the preprocessing variants found in
+                           input_file for each subject in one pass (see
+                           extract_subject_variants). ica_aroma_type and
+                           glm_denoise are then ignored
+         - bands         : Temporal filter bands (see
+                           temporal_filter.filter_bands). If passed, input_file
+                           holds the unfiltered denoised images and the
+                           filters are applied to the ROI time series, which
+                           are saved in one folder per band
+         - dataset_index : Index of the dataset (see dataset_index). With
+                           all_variants, the variants of the subjects are
+                           taken from the index if input_file is indexed
+         - cohort_stores : Add the subjects to the cohort stores (see
+                           update_cohort_stores). Jobs running on a scratch
+                           folder update the stores of the shared filesystem
+                           instead
+         - shared_paths  : (scratch base path, shared base path) of a job
+                           running on a scratch folder. The paths recorded in
+                           the provenance, the manifests and extract_roi.json
+                           are then those of the shared filesystem (see
+                           recorded_path)
      """
     import os
-    import numpy as np
-    import nibabel as nib
     import logging
+    import multiprocessing
+    # Note: Imported here as well because nipype's Function nodes only run the
+    #       source code of this function.
+    from extract_roi import (extract_subject_roi, extract_subject_roi_worker, extract_subject_variants,
+                             extract_subject_variants_worker, init_extract_roi_worker, update_cohort_stores,
+                             dump_extract_roi_json_, build_design_matrix, recorded_path)
+    from roi_store import ROI_VARIANTS
+    from atlas_index import atlas_index_path, open_atlas_index
+    from dataset_index import subject_variants
 
     # Only full_network does not require a network mask.
     if network_type != 'full_network' and network_mask_filename is None:
@@ -85,7 +735,12 @@ def extract_roi(subjects,
     if network_type != 'full_network' and extract_csf_wm == 'csf_wm':
         raise ValueError('CSF and white matter can only be extracted with the full network method')
 
-    if ica_aroma_type == 'no_ica' and glm_denoise == False:
+    if all_variants and extract_csf_wm:
+        raise ValueError('CSF and white matter are extracted for one variant at a time')
+
+    if all_variants:
+        ica_aroma_type, glm_denoise = 'all', None
+    elif ica_aroma_type == 'no_ica' and glm_denoise == False:
         raise ValueError('If no ica-type was passed the glm_denoise must be True')
 
     if extract_csf_wm:
@@ -101,145 +756,83 @@ def extract_roi(subjects,
     logging.info('ica aroma type:    %s' %(ica_aroma_type))
     logging.info('extract CSF/WM:    %s' %(extract_csf_wm))
     logging.info('denoised with GLM: %s' %(glm_denoise))
+    logging.info('jobs:              %d' %(jobs))
 
-    for subject in subjects:
-        logging.info('')
-        logging.info('Subject ID:        %s' %(subject))
-
-        segmented_image_nib = nib.load(segmented_image)
-        segmented_image_data = segmented_image_nib.get_data()
-
-        # Generate the output folder. Specify input filename
-        if extract_csf_wm:
-            subject_path = os.path.join(output_basepath, subject)
-            if not os.path.exists(subject_path):
-                os.makedirs(subject_path)
-            image = nib.load(input_file)
-            image_data = image.get_data()
-            ntpoints = image_data.shape[3]
-
-        else:
-            if (ica_aroma_type in ['aggr', 'nonaggr']) and (glm_denoise is False):
-                analysis_path = os.path.join('ica', subject, ''.join(['icaroma_', ica_aroma_type]))
-                subject_path = os.path.join(output_basepath, analysis_path)
-                filename = 'denoised_func_data_%s_filt.nii.gz' %ica_aroma_type
-            elif (ica_aroma_type in ['aggr', 'nonaggr']) and (glm_denoise is True):
-                analysis_path = os.path.join('ica_glm', subject, ''.join(['icaroma_', ica_aroma_type]))
-                subject_path = os.path.join(output_basepath, analysis_path)
-                filename = 'denoised_func_data_filt_wm_csf_extracted_filt.nii.gz'
-            elif (ica_aroma_type == 'no_ica') and (glm_denoise is True):
-                analysis_path = os.path.join('glm', subject)
-                subject_path = os.path.join(output_basepath, analysis_path)
-                filename = 'func_data_filt_wm_csf_extracted_filt.nii.gz'
-            if not os.path.exists(subject_path):
-                os.makedirs(subject_path)
-
-
-            # Check if ROIs has been extracted in case yes, early exit
-            if network_type == 'full_network' or 'between_network':
-                if os.path.exists(os.path.join(subject_path, network_type + '.txt')):
-                    logging.info('Time course for this subject was already extracted')
-                    continue
-            elif network_type == 'within_network':
-                if os.path.exists(os.path.join(subject_path, network_type + '_9.txt')):
-                    logging.info('Time course for this subject was already extracted')
-                    continue
-
-            roi_base_path = input_file
-            input_file_path = os.path.join(roi_base_path, analysis_path, filename)
-            image = nib.load(input_file_path)
-            image_data = image.get_data()
-            ntpoints = image_data.shape[3]
-
-
-        if network_type == 'full_network':
-            # Calculate the average BOLD signal over all regions.
-            avg = np.zeros((lookuptable['intensity'].shape[0], ntpoints))
-            mask = np.zeros((image.shape[0], image.shape[1], image.shape[2]))
-
-            for region in range(len(lookuptable)):
-                intensity = lookuptable['intensity'][region]
-                # Note: Not all intensity values are integers on the csf/wm segmentaton image are int. Therefore, we use
-                # the np.isclose function to find all values that are in a similar range. This lead to the inclusion of
-                # a few regions.
-                boolean_region = np.isclose(segmented_image_data, intensity, atol=.0)
-                boolean_mask = np.where(boolean_region)
-                mask[boolean_region] = 1
-                for t in range(ntpoints):
-                    data = image_data[:, :, :, t]
-                    data = data[boolean_mask[0], boolean_mask[1], boolean_mask[2]]
-                    avg[region, t] = data.mean()
-
-            affine = image.affine
-            mask_img = nib.Nifti1Image(mask, affine)
-            nib.save(mask_img, os.path.join(subject_path, ''.join('mask.nii.gz')))
-
-            # Dump the results.
-            if extract_csf_wm:
-                # Fsl GLM design matrix requires (time x regressor) and demeaned data
-                design = np.transpose(avg)
-                # design_mean = np.mean(design, axis=0)
-                # design -= design_mean
-                design_output_file = os.path.join(subject_path, ''.join(['wm_csf_time_course', '.txt']))
-                np.savetxt(design_output_file, design, delimiter=' ')
-                return design_output_file
-            else:
-                np.savetxt(os.path.join(subject_path, 'full_network.txt'),
-                           avg, delimiter=' ', fmt='%5e')
-
-        else:
-            # Load the network mask.
-            ntw_image = nib.load(network_mask_filename)
-            ntw_data = ntw_image.get_data()
-            boolean_ntw = ntw_data > 1.64
-
-            # Find the most likely regions inside the network.
-            networks = {key: [] for key in range(ntw_data.shape[3])}
-            ntw_filter = np.zeros(ntw_data.shape)
-            for region in range(len(lookuptable)):
-                intensity = lookuptable['intensity'][region]
-                boolean_mask = segmented_image_data == intensity
-                networks, ntw_filter = most_likely_roi_network(networks,
-                                                               ntw_data,
-                                                               ntw_filter,
-                                                               boolean_ntw,
-                                                               boolean_mask,
-                                                               region)
-
-            if network_type == 'within_network':
-                # Calculate the BOLD signal for the selected regions in the
-                # network. The labels from the original segmentation will be used
-                # to identify the regions of interest
-                for network in networks:
-                    avg = np.zeros((len(networks[network]), ntpoints))
-                    for region in range(len(networks[network])):
-                        intensity = lookuptable['intensity'][networks[network][region]]
-                        boolean_mask = np.where(segmented_image_data == intensity)
-                        for t in range(ntpoints):
-                            data = image_data[:, :, :, t]
-                            data = data[boolean_mask[0], boolean_mask[1], boolean_mask[2]]
-                            avg[region, t] = data.mean()
-                    np.savetxt(os.path.join(subject_path,
-                                            'within_network_%d.txt' % network),
-                               avg, delimiter=' ', fmt='%5e')
-            elif network_type == 'between_network':
-                # Calculate the BOLD signal across the selected networks. This
-                # procedure is similar to the full network approach, however,
-                # the BOLD activity of all regions enclosed in one network is
-                # taken into account.
-                avg = np.zeros((ntw_data.shape[3], ntpoints))
-                for network in range(ntw_data.shape[3]):
-                    boolean_mask = np.where(ntw_filter[:, :, :, network] > 0)
-                    for t in range(ntpoints):
-                        data = image_data[:, :, :, t]
-                        data = data[boolean_mask[0], boolean_mask[1], boolean_mask[2]]
-                        avg[network, t] = data.mean()
-                np.savetxt(os.path.join(subject_path,
-                                        'between_network.txt'),
-                           avg, delimiter=' ', fmt='%5e')
-            else:
-                raise ValueError('Unrecognised network type: %s.' % (network_type))
+    if extract_csf_wm:
+        # The CSF/WM design matrix is the one of the preprocessing GLM.
+        return build_design_matrix(subjects[0], input_file, segmented_image, lookuptable, output_basepath,
+                                   ica_aroma_type, chunk_mb=chunk_mb, atlas_cache_dir=atlas_cache_dir)
+
+    # The atlas index (regions, networks and mask) is loaded only once for all
+    # subjects and built only the first time a given atlas is used.
+    if network_type == 'full_network':
+        network_mask_filename = None
+    atlas_path = atlas_index_path(segmented_image, lookuptable, network_mask_filename,
+                                  cache_dir=atlas_cache_dir)
+
+    provenance = {'segmentation_image': recorded_path(segmented_image, shared_paths),
+                  'network_mask': recorded_path(network_mask_filename, shared_paths),
+                  'atlas_index': recorded_path(atlas_path, shared_paths)}
+    if all_variants:
+        extract_function, worker_function = extract_subject_variants, extract_subject_variants_worker
+        parameters = [{'subject': subject,
+                       'network_type': network_type,
+                       'input_file': input_file,
+                       'output_basepath': output_basepath,
+                       'chunk_mb': chunk_mb,
+                       'provenance': provenance,
+                       'atlas_key': os.path.basename(atlas_path),
+                       'bands': bands,
+                       'variants': subject_variants(dataset_index, input_file, subject),
+                       'shared_paths': shared_paths}
+                      for subject in subjects]
+    else:
+        extract_function, worker_function = extract_subject_roi, extract_subject_roi_worker
+        parameters = [{'subject': subject,
+                       'network_type': network_type,
+                       'glm_denoise': glm_denoise,
+                       'input_file': input_file,
+                       'output_basepath': output_basepath,
+                       'ica_aroma_type': ica_aroma_type,
+                       'chunk_mb': chunk_mb,
+                       'provenance': dict(provenance,
+                                          ica_aroma_type=ica_aroma_type,
+                                          glm_denoise=glm_denoise),
+                       'atlas_key': os.path.basename(atlas_path)} for subject in subjects]
+        for subject_parameters in parameters:
+            subject_parameters['bands'] = bands
+            subject_parameters['shared_paths'] = shared_paths
+    if jobs > 1 and len(subjects) > 1:
+        # The results are returned in the order of the subjects, which keeps
+        # the manifest independent of the scheduling of the workers.
+        pool = multiprocessing.Pool(min(jobs, len(subjects)),
+                                    initializer=init_extract_roi_worker,
+                                    initargs=(atlas_path,))
+        try:
+            extracted = pool.map(worker_function, parameters, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        atlas = open_atlas_index(atlas_path)
+        extracted = [extract_function(atlas=atlas, **subject_parameters)
+                     for subject_parameters in parameters]
+
+    # Add the subjects to the cohort stores of this preprocessing variant.
+    # Note: This is done here, in the order of the subjects, so that parallel
+    #       workers never write to the same store. Separate extraction jobs
+    #       are serialised by the lock of the store.
+    extracted_subjects = [subject for subject, done in zip(subjects, extracted) if done]
+    if cohort_stores and all_variants:
+        # Only the variants without band sub-folders have a cohort store.
+        for variant in ROI_VARIANTS:
+            variant_subjects = [subject for subject, done in zip(subjects, extracted) if variant in done]
+            update_cohort_stores(output_basepath, network_type, subjects, variant_subjects,
+                                 variant[0], variant[1], bands)
+    elif cohort_stores:
+        update_cohort_stores(output_basepath, network_type, subjects, extracted_subjects,
+                             ica_aroma_type, glm_denoise, bands)
 
     # Dump json with parameters of the roi extraction.
-    dump_extract_roi_json_(output_basepath, network_type, subjects, ica_aroma_type, segmented_image)
-
+    dump_extract_roi_json_(output_basepath, network_type, subjects, ica_aroma_type,
+                           recorded_path(segmented_image, shared_paths), extracted_subjects)
@@ -0,0 +1,27 @@
+import os
+import fcntl
+from contextlib import contextmanager
+
+
+def makedirs(path):
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
+
+@contextmanager
+def file_lock(lock_filename):
+    """ Hold an exclusive lock (an flock on lock_filename, created if needed),
+    so that concurrent jobs on the shared filesystem do not update the same
+    files at the same time. """
+    if os.path.dirname(lock_filename):
+        makedirs(os.path.dirname(lock_filename))
+    with open(lock_filename, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -0,0 +1,123 @@
+from __future__ import division
+
+
+def residual_forming_matrix(design, demean=True):
+    """ Return the (time x time) matrix R = I - X pinv(X), which maps a time
+    series to the residuals of its least squares fit on the regressors of the
+    design matrix X (time x regressors). As with fsl_glm --demean, the
+    regressors are demeaned when demean is True. """
+    import numpy as np
+
+    design = np.asarray(design, dtype=np.float64)
+    if design.ndim == 1:
+        design = design[:, np.newaxis]
+    if demean:
+        design = design - design.mean(axis=0)
+    return np.eye(design.shape[0]) - np.dot(design, np.linalg.pinv(design))
+
+
+def iter_image_slabs(image, chunk_mb=256):
+    """ Iterate over slabs of slices (along the third axis) of a 4D image, so
+    that each slab holds the whole time series of its voxels and takes at most
+    about chunk_mb MB in double precision (at least one slice).
+
+    Yields the index of the first slice of the slab and the slab. """
+    import numpy as np
+
+    nx, ny, nz, nt = image.shape
+    slice_bytes = nx * ny * nt * 8
+    step = max(1, min(nz, int(chunk_mb * 2 ** 20 // slice_bytes)))
+    for start in range(0, nz, step):
+        yield start, np.asarray(image.dataobj[:, :, start:start + step, :], dtype=np.float64)
+
+
+def decompress_image(filename, output_dir):
+    """ Decompress the gzipped image filename into a temporary .nii file in
+    output_dir, which can be memory-mapped, and return its name. The caller
+    removes the file. """
+    import os
+    import gzip
+    import shutil
+    import tempfile
+
+    handle, uncompressed = tempfile.mkstemp(suffix='.nii', dir=output_dir)
+    with os.fdopen(handle, 'wb') as f_out:
+        with gzip.open(filename, 'rb') as f_in:
+            shutil.copyfileobj(f_in, f_out, 16 * 2 ** 20)
+    return uncompressed
+
+
+def glm_nuisance_regression(in_file, design, out_res_name, demean=True, chunk_mb=256):
+    """ Regress the nuisance regressors of design (a text file with one column
+    per regressor, see extract_roi.build_design_matrix) out of the 4D image
+    in_file and save the residuals as out_res_name.
+
+    This computes the residuals of fsl_glm (with --demean if demean is True)
+    without writing the betas: the residual forming matrix of the design is
+    computed once and applied to slabs of voxels (see iter_image_slabs). A
+    gzipped in_file is decompressed once into a temporary file (see
+    decompress_image), since every slab would otherwise decompress the image
+    from its start. The residuals are written directly into an uncompressed
+    NIfTI file, whose name is returned. """
+    import os
+    import logging
+    import numpy as np
+    import nibabel as nib
+    # Note: Imported here as well because nipype's Function nodes only run the
+    #       source code of this function.
+    from glm_denoise import residual_forming_matrix, iter_image_slabs, decompress_image
+
+    image = nib.load(in_file)
+    if len(image.shape) != 4:
+        raise ValueError('Expected a 4D image: %s.' % (in_file))
+    design_matrix = np.loadtxt(design, ndmin=2)
+    if design_matrix.shape[0] != image.shape[3]:
+        raise ValueError('The design matrix has %d time points and the image %d.' %
+                         (design_matrix.shape[0], image.shape[3]))
+    residual_matrix = residual_forming_matrix(design_matrix, demean)
+    shape, affine = image.shape, image.affine
+
+    # Residuals are saved uncompressed, so that they can be written slab by
+    # slab through a memory map. The data offset is set by the header when it
+    # is written (after the header and its extensions).
+    if out_res_name.endswith('.nii.gz'):
+        out_res_name = out_res_name[:-len('.gz')]
+    out_res = os.path.abspath(out_res_name)
+    header = nib.Nifti1Header.from_header(image.header)
+    header.extensions = nib.nifti1.Nifti1Extensions()
+    header.set_data_dtype(np.float32)
+    header.set_data_shape(image.shape)
+    header.set_slope_inter(None, None)
+    header.set_data_offset(0)
+    dtype = header.get_data_dtype()
+    with open(out_res, 'wb') as f:
+        header.write_to(f)
+        offset = header.get_data_offset()
+        f.truncate(offset + int(np.prod(image.shape)) * dtype.itemsize)
+    residuals = np.memmap(out_res, dtype=dtype, mode='r+', offset=offset, shape=image.shape, order='F')
+
+    uncompressed = None
+    if in_file.endswith('.gz'):
+        uncompressed = decompress_image(in_file, os.path.dirname(out_res))
+        image = nib.load(uncompressed)
+    try:
+        nt = image.shape[3]
+        for start, slab in iter_image_slabs(image, chunk_mb):
+            data = slab.reshape(-1, nt).T
+            if demean:
+                data = data - data.mean(axis=0)
+            residuals[:, :, start:start + slab.shape[2], :] = \
+                np.dot(residual_matrix, data).T.reshape(slab.shape)
+        residuals.flush()
+        del residuals
+    finally:
+        if uncompressed is not None:
+            del image
+            os.remove(uncompressed)
+
+    saved = nib.load(out_res)
+    if saved.shape != shape or saved.get_data_dtype() != dtype or not np.allclose(saved.affine, affine):
+        raise ValueError('The GLM residuals do not match the input image: %s.' % (out_res))
+
+    logging.info('GLM residuals saved: %s' % (out_res))
+    return out_res
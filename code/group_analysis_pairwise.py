@@ -12,6 +12,7 @@ import logging
 from scipy import stats
 
 from data_analysis import data_analysis_subject_basepath
+from dataset_index import diagnosis_group
 
 def group_analysis_group_basepath(basepath,
                                   network_type,
@@ -39,7 +40,12 @@ def group_analysis_pairwise(subjects,
                             group_analysis_type,
                             nclusters,
                             rand_ind,
-                            significancy=.05):
+                            significancy=.05,
+                            groups=None):
+    """ Compare the healthy and schizophrenic subjects. The group of each
+    subject is taken from groups (see dataset_index.subject_groups) or, if not
+    passed, inferred from the subject ID (see dataset_index.diagnosis_group).
+    """
 
     logging.info('--------------------------------------------------------------------')
     logging.info(' Group analysis')
@@ -112,7 +118,7 @@ def group_analysis_pairwise(subjects,
 
         # Aggregate all data by measure and by healthy/schizophrenic subjects.
         for network in data:
-            if int(subject.strip('sub-')) < 40000:
+            if diagnosis_group(subject, groups) == 'healthy':
                 if network not in healthy_parameters:
                     healthy_parameters[network] = {}
                 for measure in measures:
@@ -135,7 +141,7 @@ def group_analysis_pairwise(subjects,
                         healthy_parameters[network]['global_efficiency']['std'] = []
                     healthy_parameters[network]['global_efficiency']['mean'].append(np.mean(data_graph_measures[network]['global_efficiency']))
                     healthy_parameters[network]['global_efficiency']['std'].append(np.std(data_graph_measures[network]['global_efficiency']))
-            elif int(subject.strip('sub-')) > 50000:
+            elif diagnosis_group(subject, groups) == 'schizo':
                 if network not in schizo_parameters:
                     schizo_parameters[network] = {}
                 for measure in measures:
@@ -24,6 +24,11 @@ ica_aroma_types = ['aggr', 'nonaggr', 'no_ica']
 # This needs to be first, because even path settings depend on the
 # parameters passed to the command line.
 from argparse import ArgumentParser
+# Note: The sliding window and temporal filter modules do not log, so their
+#       parameters can be imported before the global logging is set up.
+from sliding_window import sliding_window_size, window_tapers, window_name
+from temporal_filter import filter_bands
+band_names = [name for name, _, _ in filter_bands()]
 parser = ArgumentParser(
     description='Analyse the subjects.'
 )
@@ -39,6 +44,11 @@ parser.add_argument(
     action='store_true', dest='golden_subjects',
     help='Perform analysis with subset of healthy subjects'
 )
+parser.add_argument(
+    '--subjects-file',
+    dest='subjects_filename', metavar='SUBJECTS_FILE', default='subjects.json',
+    help='JSON file with the lists of subjects (default: subjects.json).'
+)
 # Number of subjects
 parser.add_argument(
     '-n', '--nsubjects',
@@ -79,22 +89,41 @@ parser.add_argument(
     choices=network_types,
     help='Network type. Choose from: ' + ', '.join(network_types)
 )
+# Note: Several window types, window sizes, data analysis types and numbers of
+#       clusters run the data and group analyses as a parameter sweep (see
+#       sweep.py).
 parser.add_argument(
     '--window-type',
-    dest='window_type', metavar='WINDOW_TYPE',
+    dest='window_type', metavar='WINDOW_TYPE', nargs='+',
     choices=window_types,
-    help='Window type. Choose from: ' + ', '.join(window_types)
+    help='Window type(s). Choose from: ' + ', '.join(window_types)
+)
+parser.add_argument(
+    '--window-size',
+    type=int, dest='window_size', metavar='WINDOW_SIZE', nargs='+',
+    help='Size(s) of the sliding window in time points (default: %d).' % sliding_window_size
+)
+parser.add_argument(
+    '--window-stride',
+    type=int, dest='window_stride', metavar='WINDOW_STRIDE', default=1,
+    help='Number of time points between two sliding windows (default: 1).'
+)
+parser.add_argument(
+    '--window-taper',
+    dest='window_taper', metavar='WINDOW_TAPER', default='boxcar',
+    choices=window_tapers,
+    help='Taper of the sliding window. Choose from: ' + ', '.join(window_tapers) + ' (default: boxcar).'
 )
 parser.add_argument(
     '--data-analysis-type',
-    dest='data_analysis_type', metavar='DATA_ANALYSIS_TYPE',
+    dest='data_analysis_type', metavar='DATA_ANALYSIS_TYPE', nargs='+',
     choices=data_analysis_types,
-    help='Data analysis type. Choose from: ' + ', '.join(data_analysis_types)
+    help='Data analysis type(s). Choose from: ' + ', '.join(data_analysis_types)
 )
 parser.add_argument(
     '--nclusters',
-    type=int, dest='nclusters', metavar='NCLUSTERS',
-    help='Number of clusters to use in data analysis.'
+    type=int, dest='nclusters', metavar='NCLUSTERS', nargs='+',
+    help='Number(s) of clusters to use in data analysis.'
 )
 parser.add_argument(
     '--rand-ind',
@@ -119,13 +148,93 @@ parser.add_argument(
     action='store_true',
     help='Perfrom denoising with GLM'
 )
+parser.add_argument(
+    '--chunk-mb',
+    type=int, dest='chunk_mb', metavar='CHUNK_MB', default=256,
+    help='Memory budget (in MB) used to stream the images during ROI extraction.'
+)
+parser.add_argument(
+    '-j', '--jobs',
+    type=int, dest='jobs', metavar='JOBS', default=1,
+    help='Number of subjects processed in parallel during ROI extraction, and of ' +
+         'steps run in parallel in a parameter sweep.'
+)
+parser.add_argument(
+    '--plugin',
+    dest='plugin', metavar='PLUGIN', default='Linear',
+    help='Execution backend of the pre-processing workflow: Linear, MultiProc or SLURM (default: Linear).'
+)
+parser.add_argument(
+    '--n-procs',
+    type=int, dest='n_procs', metavar='NPROCS', default=None,
+    help='Number of processors used by the MultiProc pre-processing (default: all).'
+)
+parser.add_argument(
+    '--memory-gb',
+    type=float, dest='memory_gb', metavar='MEMORY_GB', default=None,
+    help='Memory (GB) used by the MultiProc pre-processing (default: 90%% of the total).'
+)
+parser.add_argument(
+    '--all-variants',
+    dest='all_variants',
+    action='store_true',
+    help='Extract the ROIs of all preprocessing variants found for each subject.'
+)
+parser.add_argument(
+    '--filter-on-roi',
+    dest='filter_on_roi',
+    action='store_true',
+    help='Extract the ROIs from the unfiltered images and filter the ROI time series with each band.'
+)
+parser.add_argument(
+    '--band',
+    dest='band', metavar='BAND',
+    choices=band_names,
+    help='Analyse the ROI time series filtered on the ROI (see --filter-on-roi) with this band. Choose from: ' +
+         ', '.join(band_names)
+)
+parser.add_argument(
+    '--dataset-index',
+    dest='dataset_index', action='store_true',
+    help='Query subjects, groups and preprocessed images from the dataset index (built if missing).'
+)
+parser.add_argument(
+    '--rebuild-index',
+    dest='rebuild_index', action='store_true',
+    help='Rebuild the dataset index before using it.'
+)
+parser.add_argument(
+    '--scratch',
+    dest='scratch', metavar='SCRATCH', default=None,
+    help='Node-local folder where the inputs are copied and the outputs computed, before being synced back.'
+)
 args = parser.parse_args()
 
+# The data and group analyses run as a parameter sweep when more than one
+# combination of the swept options is given. Otherwise the options hold a
+# single value, as expected by the phases below.
+if args.window_size is None:
+    args.window_size = [sliding_window_size]
+sweep_options = ['window_type', 'window_size', 'data_analysis_type', 'nclusters']
+sweep = any(len(getattr(args, option) or []) > 1 for option in sweep_options)
+if not sweep:
+    for option in sweep_options:
+        values = getattr(args, option)
+        setattr(args, option, values[0] if values else None)
+    # Folder of the results of the window (see window_name).
+    window_path = window_name(args.window_type, args.window_size, args.window_stride, args.window_taper)
+
 ################################################################################
 # Path settings
 ################################################################################
 # Base path for all input and output data.
 base_path = os.path.join(os.path.sep, 'group', 'dynamics', 'scz_dynamics', 'ucla-la5')
+# In scratch mode all the paths below point to the scratch folder. The inputs
+# of each phase are copied there from the shared base path and the outputs are
+# synced back at the end of the phase.
+shared_base_path = base_path
+if args.scratch is not None:
+    base_path = os.path.join(args.scratch, 'ucla-la5')
 base_path_in = os.path.join(base_path, 'data_in')
 base_path_out = os.path.join(base_path, 'data_out', args.analysis_type)
 
@@ -145,7 +254,11 @@ roi_input_lookuptable = os.path.join(base_path_in, 'voi_extraction', 'LookupTabl
 roi_input_segmented_regions_path = os.path.join(base_path_in, 'voi_extraction')
 # Image where between_network and within_network are specified.
 roi_input_network_filename = os.path.join(base_path_in, 'voi_extraction', 'PNAS_Smith09_rsn10.nii')
+# Cache of the precomputed atlas indices (regions, networks and mask).
+roi_atlas_cache_path = os.path.join(base_path_in, 'voi_extraction', 'atlas_index')
 roi_input_basepath = os.path.join(preprocessing_output_basepath, 'temp_filt')
+# Unfiltered denoised images (pre-processing with --filter-on-roi).
+roi_input_unfiltered_basepath = os.path.join(preprocessing_output_basepath, 'denoised')
 roi_output_basepath = os.path.join(base_path_out, 'extract_roi')
 
 # Data analysis
@@ -156,9 +269,24 @@ data_analysis_output_basepath = os.path.join(base_path_out, 'data_analysis')
 group_analysis_input_basepath = data_analysis_output_basepath
 group_analysis_output_basepath = os.path.join(base_path_out, 'group_analysis')
 
+# The ROI time series filtered on the ROI are analysed one band at a time, and
+# the results of each band are kept in their own folder.
+if args.band is not None:
+    data_analysis_output_basepath = os.path.join(data_analysis_output_basepath, args.band)
+    group_analysis_input_basepath = data_analysis_output_basepath
+    group_analysis_output_basepath = os.path.join(group_analysis_output_basepath, args.band)
+
 # Subjects
 # FIXME: Move to data_in folder.
-subjects_filename = 'subjects.json'
+subjects_filename = args.subjects_filename
+# Dataset index (subjects, groups, runs and preprocessed images). It always
+# lives on the shared filesystem.
+dataset_path = os.path.join(shared_base_path, 'data_in', 'ds000030')
+dataset_index_filename = os.path.join(shared_base_path, 'data_in', 'dataset_index.json')
+dataset_index_variant_basepaths = [os.path.join(shared_base_path, 'data_out', analysis_type, 'preprocessing_out', folder)
+                                   for analysis_type in analysis_types for folder in ['temp_filt', 'denoised']]
+# Task of the functional run of each analysis type.
+analysis_tasks = {'rest': 'rest', 'task': 'stopsignal'}
 
 ################################################################################
 # Global logging
@@ -166,9 +294,20 @@ subjects_filename = 'subjects.json'
 # Note: This needs to be setup before other local modules are imported and
 #       and before any local code is executed.
 import logging
-logpath = os.path.join(data_analysis_output_basepath, args.network_type, args.window_type, args.data_analysis_type)
 timestamp = time.strftime("%Y%m%d%H%M%S")
-log_filename = os.path.join(logpath, '%s_ucla5_%d.log' %(timestamp, args.nclusters))
+if sweep:
+    logpath = os.path.join(data_analysis_output_basepath, args.network_type, 'sweep')
+    log_filename = os.path.join(logpath, '%s_ucla5_sweep.log' %(timestamp))
+elif args.network_type is not None and args.data_analysis_type is not None and args.nclusters is not None:
+    logpath = os.path.join(data_analysis_output_basepath, args.network_type, window_path, args.data_analysis_type)
+    log_filename = os.path.join(logpath, '%s_ucla5_%d.log' %(timestamp, args.nclusters))
+else:
+    # Phases that do not depend on the data analysis options (pre-processing
+    # and ROI extraction).
+    logpath = os.path.join(base_path_out, 'logs')
+    log_filename = os.path.join(logpath, '%s_ucla5.log' %(timestamp))
+if not os.path.isdir(logpath):
+    os.makedirs(logpath)
 formatter = logging.Formatter('%(message)s')
 log = logging.getLogger('')
 log.setLevel(logging.DEBUG)
@@ -189,10 +328,18 @@ log.addHandler(ch)
 # Local imports
 ################################################################################
 from subjects import load_subjects
+from dataset_index import load_dataset_index, subject_groups
 from preprocessing_workflow import preprocessing_pipeline, get_lookuptable
-from extract_roi import extract_roi
-from data_analysis import data_analysis
+from extract_roi import extract_roi, update_cohort_stores
+from roi_store import ROI_VARIANTS, roi_analysis_path
+from scratch import stage_in, stage_out, scratch_to_shared
+from data_analysis import data_analysis, data_analysis_subject_basepath, data_analysis_shared_basepath
 from group_analysis_pairwise import group_analysis_pairwise
+from sweep import sweep_graph, run_graph, sweep_windows
+
+# Exit status of the script: non-zero when steps of a parameter sweep failed,
+# so that the scheduler does not start the stages that depend on them.
+exit_status = 0
 
 ################################################################################
 # Load subjects.
@@ -200,7 +347,20 @@ from group_analysis_pairwise import group_analysis_pairwise
 # They must always be loaded, no matter the type of the analysis.
 # Note: If the user didn't specify nsubjects, we take all subjects (still
 #       balanced).
-subjects = load_subjects(subjects_filename, args.golden_subjects, args.nsubjects)
+dataset_index = None
+if args.dataset_index or args.rebuild_index:
+    dataset_index = load_dataset_index(dataset_index_filename, dataset_path, dataset_index_variant_basepaths,
+                                       rebuild=args.rebuild_index)
+subjects = load_subjects(subjects_filename, args.golden_subjects, args.nsubjects, dataset_index,
+                         [analysis_tasks[args.analysis_type]])
+# The sweep computes the optimal threshold from the golden subjects itself,
+# unless a previous sweep with --golden-subjects computed it.
+golden_subjects = []
+if sweep:
+    if args.golden_subjects and args.analyse_data_group:
+        parser.error('A parameter sweep with --golden-subjects only computes the optimal thresholds: ' +
+                     'do not pass --analyse-data-group.')
+    golden_subjects = load_subjects(subjects_filename, True)
 
 ############################################################################
 # Pre-processing
@@ -208,10 +368,10 @@ subjects = load_subjects(subjects_filename, args.golden_subjects, args.nsubjects
 if args.preprocess:
     # Note: Preprocessing is only running on the old cluster
     print('Preprocessing')
-    preprocessing_pipeline(subjects,
-                        preprocessing_input_basepath,
-                        preprocessing_output_basepath,
-                        )
+    for subject in subjects:
+        preprocessing_pipeline(subject, base_path, args.analysis_type,
+                               plugin=args.plugin, n_procs=args.n_procs, memory_gb=args.memory_gb,
+                               filter_on_roi=args.filter_on_roi)
 
     # extract csf and white matter
     print('Pre-processing.')
@@ -223,24 +383,62 @@ if args.extract_roi:
     if args.network_type is None:
         parser.error('You must specify: --network_type.')
 
+    roi_input_path = roi_input_unfiltered_basepath if args.filter_on_roi else roi_input_basepath
+    roi_subjects = subjects
+    if sweep and args.analyse_data:
+        roi_subjects = subjects + [subject for subject in golden_subjects if subject not in subjects]
+    if args.scratch is not None:
+        # Atlas, images of the subjects and ROIs already extracted. Only the
+        # folders of the subjects and variants of the job are copied; the
+        # cohort stores are not (see below).
+        variants = ROI_VARIANTS if args.all_variants else [(args.ica_aroma_type, args.glm_denoise)]
+        roi_relpaths = [roi_analysis_path(subject, ica_aroma_type, glm_denoise)
+                        for subject in roi_subjects for ica_aroma_type, glm_denoise in variants]
+        stage_in(os.path.join(base_path_in, 'voi_extraction'), base_path, shared_base_path)
+        stage_in(roi_input_path, base_path, shared_base_path, roi_relpaths)
+        stage_in(roi_output_basepath, base_path, shared_base_path, roi_relpaths)
+
     lookuptable = get_lookuptable(roi_input_lookuptable)
 
     # Extract ROIs.
-    extract_roi(subjects,
+    extract_roi(roi_subjects,
                 args.network_type,
                 args.extract_csf_wm,
                 args.glm_denoise,
-                roi_input_basepath,
+                roi_input_path,
                 roi_input_segmented_image_filename,
                 lookuptable,
                 roi_output_basepath,
                 args.ica_aroma_type,
-                network_mask_filename=roi_input_network_filename)
+                network_mask_filename=roi_input_network_filename,
+                chunk_mb=args.chunk_mb,
+                atlas_cache_dir=roi_atlas_cache_path,
+                jobs=args.jobs,
+                all_variants=args.all_variants,
+                bands=filter_bands() if args.filter_on_roi else None,
+                dataset_index=dataset_index,
+                cohort_stores=args.scratch is None,
+                shared_paths=(base_path, shared_base_path) if args.scratch is not None else None)
+
+    if args.scratch is not None:
+        # The folders of the subjects hold their extraction manifests, and
+        # extract_roi.json the parameters of the extraction. The paths they
+        # record are already those of the shared filesystem.
+        stage_out(roi_output_basepath, base_path, shared_base_path, roi_relpaths + ['extract_roi.json'])
+        stage_out(roi_atlas_cache_path, base_path, shared_base_path)
+        # The cohort stores are shared by all jobs, so they are updated in
+        # place on the shared filesystem, under the lock of each store (see
+        # roi_store.append_cohort_timeseries), rather than synced back.
+        if not args.extract_csf_wm:
+            for ica_aroma_type, glm_denoise in variants:
+                update_cohort_stores(scratch_to_shared(roi_output_basepath, base_path, shared_base_path),
+                                     args.network_type, roi_subjects, [], ica_aroma_type, glm_denoise,
+                                     filter_bands() if args.filter_on_roi else None)
 
 ############################################################################
 # Data analysis
 ############################################################################
-if args.analyse_data:
+if args.analyse_data and not sweep:
     if args.network_type is None or \
        args.window_type is None or \
        args.data_analysis_type is None or \
@@ -254,6 +452,19 @@ if args.analyse_data:
                      '--rand-ind.')
 
     # Analyse data.
+    # Note: The outputs of the job are the folder of this combination of
+    #       parameters, which holds the optimal threshold and one folder per
+    #       subject.
+    data_analysis_path = os.path.dirname(data_analysis_subject_basepath(data_analysis_output_basepath,
+                                                                        args.network_type, window_path,
+                                                                        args.data_analysis_type, args.nclusters,
+                                                                        args.rand_ind, ''))
+    if args.scratch is not None:
+        # ROI time series of the subjects and, unless the job computes it, the
+        # optimal threshold.
+        stage_in(data_analysis_input_basepath, base_path, shared_base_path,
+                 [roi_analysis_path(subject, args.ica_aroma_type, args.glm_denoise) for subject in subjects])
+        stage_in(data_analysis_path, base_path, shared_base_path, ['optimal_k.json'])
     data_analysis(subjects,
                   data_analysis_input_basepath,
                   data_analysis_output_basepath,
@@ -264,13 +475,19 @@ if args.analyse_data:
                   args.glm_denoise,
                   args.nclusters,
                   args.rand_ind,
-                  args.golden_subjects)
+                  args.golden_subjects,
+                  window_size=args.window_size,
+                  window_stride=args.window_stride,
+                  window_taper=args.window_taper,
+                  band=args.band)
+    if args.scratch is not None:
+        stage_out(data_analysis_path, base_path, shared_base_path)
 
 
 ############################################################################
 # Group analysis
 ############################################################################
-if args.analyse_data_group:
+if args.analyse_data_group and not sweep:
     if args.network_type is None or \
        args.window_type is None or \
        args.data_analysis_type is None or \
@@ -285,17 +502,112 @@ if args.analyse_data_group:
                      '--nclusters, ' + \
                      '--rand-ind.')
 
+    if args.scratch is not None:
+        # Results of the subjects for this combination of parameters.
+        stage_in(group_analysis_input_basepath, base_path, shared_base_path,
+                 [data_analysis_subject_basepath('', args.network_type, window_path, args.data_analysis_type,
+                                                 args.nclusters, args.rand_ind, subject)
+                  for subject in subjects])
     group_analysis_pairwise(subjects,
                             group_analysis_input_basepath,
                             group_analysis_output_basepath,
                             args.network_type,
-                            args.window_type,
+                            window_path,
                             args.data_analysis_type,
                             args.group_analysis_type,
                             args.nclusters,
-                            args.rand_ind)
+                            args.rand_ind,
+                            groups=subject_groups(dataset_index) if dataset_index is not None else None)
+    if args.scratch is not None:
+        stage_out(group_analysis_output_basepath, base_path, shared_base_path)
+
+############################################################################
+# Parameter sweep
+############################################################################
+if sweep and (args.analyse_data or args.analyse_data_group):
+    if args.network_type is None or \
+       args.window_type is None or \
+       args.data_analysis_type is None or \
+       args.nclusters is None or \
+       args.rand_ind is None or \
+       (args.analyse_data_group and args.group_analysis_type is None):
+        parser.error('You must specify: ' + \
+                     '--network-type, ' + \
+                     '--window-type, ' + \
+                     '--data-analysis-type, ' + \
+                     '--nclusters, ' + \
+                     '--rand-ind ' + \
+                     '(and --group-analysis-type with -g).')
+
+    sweep_output_path = os.path.join(data_analysis_output_basepath, args.network_type)
+    # With --golden-subjects the sweep only computes the optimal threshold of
+    # each window (the golden pass, see the analyse_data_golden stage of
+    # scheduler.py). The other sweeps use the thresholds of the golden pass if
+    # all the windows have one, and otherwise compute them first.
+    optimal_k_relpaths = [os.path.join(data_analysis_shared_basepath('', args.network_type, window_path), 'optimal_k.json')
+                          for _, _, window_path in sweep_windows(args.window_type, args.window_size,
+                                                                 args.window_stride, args.window_taper)]
+    compute_optimal_k = args.golden_subjects or not all(
+        os.path.exists(os.path.join(scratch_to_shared(data_analysis_output_basepath, base_path, shared_base_path),
+                                    relpath))
+        for relpath in optimal_k_relpaths)
+    if args.analyse_data and not compute_optimal_k:
+        logging.info('Using the optimal thresholds of the golden pass.')
+    if args.scratch is not None:
+        if args.analyse_data:
+            # ROI time series of the subjects and, unless the sweep computes
+            # them, the optimal thresholds.
+            stage_in(data_analysis_input_basepath, base_path, shared_base_path,
+                     [roi_analysis_path(subject, args.ica_aroma_type, args.glm_denoise)
+                      for subject in subjects + [subject for subject in golden_subjects
+                                                 if subject not in subjects and compute_optimal_k]])
+            if not compute_optimal_k:
+                stage_in(data_analysis_output_basepath, base_path, shared_base_path, optimal_k_relpaths)
+        else:
+            # Results of the subjects for each combination of parameters.
+            stage_in(data_analysis_output_basepath, base_path, shared_base_path,
+                     [data_analysis_subject_basepath('', args.network_type, sweep_window_path, data_analysis_type,
+                                                     nclusters, args.rand_ind, subject)
+                      for _, _, sweep_window_path in sweep_windows(args.window_type, args.window_size,
+                                                             args.window_stride, args.window_taper)
+                      for data_analysis_type in args.data_analysis_type
+                      for nclusters in args.nclusters
+                      for subject in subjects])
+    nodes = sweep_graph(subjects,
+                        golden_subjects,
+                        data_analysis_input_basepath,
+                        data_analysis_output_basepath,
+                        group_analysis_output_basepath,
+                        args.network_type,
+                        args.window_type,
+                        args.data_analysis_type,
+                        args.nclusters,
+                        args.rand_ind,
+                        args.ica_aroma_type,
+                        args.glm_denoise,
+                        analyse_data=args.analyse_data,
+                        group_analysis_type=args.group_analysis_type if args.analyse_data_group else None,
+                        groups=subject_groups(dataset_index) if dataset_index is not None else None,
+                        window_sizes=args.window_size,
+                        window_stride=args.window_stride,
+                        window_taper=args.window_taper,
+                        band=args.band,
+                        golden_pass=args.golden_subjects,
+                        compute_optimal_k=compute_optimal_k)
+    failed = run_graph(nodes, args.jobs)
+    if failed:
+        logging.info('%d of %d sweep steps failed or were skipped: %s' % (len(failed), len(nodes), ', '.join(failed)))
+        exit_status = 1
+    if args.scratch is not None:
+        stage_out(sweep_output_path, base_path, shared_base_path)
+        if args.analyse_data_group:
+            stage_out(group_analysis_output_basepath, base_path, shared_base_path)
 
 # remember to close the handlers
 for handler in log.handlers:
     handler.close()
-    log.removeFilter(handler)
\ No newline at end of file
+    log.removeFilter(handler)
+
+if args.scratch is not None:
+    stage_out(logpath, base_path, shared_base_path)
+sys.exit(exit_status)
\ No newline at end of file
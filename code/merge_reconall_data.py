@@ -1,27 +1,172 @@
-# This script copies original data to the recon-all folder.
-import subprocess
+#!/usr/bin/env python
+""" Stage the BIDS folders (anat, beh, dwi, func) of the subjects into the
+recon-all/preprocessing input tree (reconall_data) without copying the data:
+files are hardlinked (or symlinked) and only copied when the input tree is on
+a different filesystem than the dataset.
+
+The files to stage are listed in a manifest of (source, target) pairs, which
+can be written once and reused. Staging is idempotent, so it can be run again
+for new batches of subjects. """
 import os
-# subjects_list = ['sub-10290', 'sub-10292', 'sub-10299', 'sub-10304',
-#         'sub-10316', 'sub-10321', 'sub-10325', 'sub-10329', 'sub-10339',
-#         'sub-10340', 'sub-10345', 'sub-10347', 'sub-10356', 'sub-10361',
-#         'sub-10365', 'sub-10376', 'sub-10377', 'sub-10388', 'sub-50004',
-#         'sub-50005', 'sub-50006', 'sub-50007', 'sub-50008', 'sub-50010',
-#         'sub-50013', 'sub-50014', 'sub-50015', 'sub-50016', 'sub-50020',
-#         'sub-50021', 'sub-50022', 'sub-50023', 'sub-50025', 'sub-50027',
-#         'sub-50029', 'sub-50032', 'sub-50033', 'sub-50034', 'sub-50035',
-#         'sub-50036', 'sub-50038', 'sub-50060', 'sub-50061', 'sub-50064',
-#         'sub-50066', 'sub-50067', 'sub-50069', 'sub-50073', 'sub-50075',
-#         'sub-50076', 'sub-50077', 'sub-50080', 'sub-50081', 'sub-50083',
-#         'sub-50085']
-subjects_list = ['sub-10429', 'sub-10438', 'sub-10440']
-base_data = '/home/jdafflon/scratch/personal/data_in/ucla_la5/ds000030'
-for sub in subjects_list:
-    anat_data = os.path.join(base_data, sub, 'anat')
-    beh_data  = os.path.join(base_data, sub, 'beh')
-    dwi_data  = os.path.join(base_data, sub, 'dwi')
-    func_data = os.path.join(base_data, sub, 'func')
-    end_path  = os.path.join(base_data, 'reconall_data', sub)
-    cmd = 'cp -r {0} {1} {2} {3} {4}'.format(anat_data, beh_data, dwi_data,
-            func_data, end_path)
-    subprocess.call(cmd, shell=True)
-    print ('Done subject{}'.format(sub))
+import sys
+import json
+import errno
+import shutil
+import logging
+from multiprocessing.pool import ThreadPool
+from argparse import ArgumentParser
+
+from scratch import same_size_and_mtime
+from dataset_index import load_dataset_index, index_subjects
+
+
+stage_folders = ['anat', 'beh', 'dwi', 'func']
+stage_modes = ['hardlink', 'symlink', 'copy']
+
+
+def staging_manifest(dataset_path, subjects_dir, subjects, folders=stage_folders):
+    """ List the files of the folders of each subject as [source, target]
+    pairs, where target mirrors the source path inside subjects_dir """
+    manifest = []
+    for subject in subjects:
+        for folder in folders:
+            folder_path = os.path.join(dataset_path, subject, folder)
+            for root, dirs, files in os.walk(folder_path):
+                dirs.sort()
+                for filename in sorted(files):
+                    source = os.path.join(root, filename)
+                    target = os.path.join(subjects_dir, os.path.relpath(source, dataset_path))
+                    manifest.append([source, target])
+    return manifest
+
+
+def save_manifest(filename, manifest):
+    with open(filename, 'w') as f:
+        json.dump(manifest, f, indent=4)
+
+
+def load_manifest(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+def stage_file(source, target, mode='hardlink'):
+    """ Make target point to the content of source. With mode hardlink, a
+    copy is made if both paths are on different filesystems. A target that
+    already points to source is left untouched, and so is a copy of source
+    (same size and modification time, which shutil.copy2 preserves) unless
+    mode is symlink.
+
+    Returns how the file was staged: 'hardlink', 'symlink', 'copy' or
+    'exists'. """
+    if os.path.lexists(target):
+        if os.path.exists(target) and os.path.samefile(source, target):
+            return 'exists'
+        if mode != 'symlink' and not os.path.islink(target) and same_size_and_mtime(source, target):
+            return 'exists'
+        os.remove(target)
+    target_dir = os.path.dirname(target)
+    try:
+        os.makedirs(target_dir)
+    except OSError as error:
+        if error.errno != errno.EEXIST:
+            raise
+
+    if mode == 'hardlink':
+        try:
+            os.link(source, target)
+            return 'hardlink'
+        except OSError as error:
+            if error.errno != errno.EXDEV:
+                raise
+    elif mode == 'symlink':
+        os.symlink(os.path.abspath(source), target)
+        return 'symlink'
+    elif mode != 'copy':
+        raise ValueError('Unrecognised staging mode: %s.' % (mode))
+    shutil.copy2(source, target)
+    return 'copy'
+
+
+def stage(manifest, mode='hardlink', jobs=8):
+    """ Stage all the files of the manifest, jobs files at a time. Returns the
+    number of files staged in each way (see stage_file). """
+    pool = ThreadPool(max(1, jobs))
+    try:
+        results = pool.map(lambda pair: stage_file(pair[0], pair[1], mode), manifest)
+    finally:
+        pool.close()
+        pool.join()
+    return dict((result, results.count(result)) for result in set(results))
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(
+            description='Stage the BIDS data of the subjects into the recon-all input tree'
+            )
+    parser.add_argument(
+            '-d', '--dataset-path', dest='dataset_path', default=None,
+            help='Path of the BIDS dataset (default: the dataset of --dataset-index)'
+            )
+    parser.add_argument(
+            '--subjects-dir', dest='subjects_dir', default=None,
+            help='Input tree of recon-all and of the preprocessing (default: DATASET_PATH/reconall_data)'
+            )
+    parser.add_argument(
+            '-s', '--subjects', dest='subjects', nargs='+', default=None,
+            help='Subjects to stage (default: all subjects of the dataset index)'
+            )
+    parser.add_argument(
+            '--dataset-index', dest='dataset_index', default=None,
+            help='Index of the dataset, built from DATASET_PATH if missing (default: '
+                 'DATASET_PATH/dataset_index.json, see dataset_index.py)'
+            )
+    parser.add_argument(
+            '--rebuild-index', dest='rebuild_index', action='store_true',
+            help='Rebuild the dataset index before using it'
+            )
+    parser.add_argument(
+            '-m', '--manifest', dest='manifest', default=None,
+            help='Manifest of the files to stage. Used if it exists, written otherwise'
+            )
+    parser.add_argument(
+            '--mode', dest='mode', default='hardlink',
+            choices=stage_modes,
+            help='How files are staged. Choose from: ' + ', '.join(stage_modes)
+            )
+    parser.add_argument(
+            '-j', '--jobs', dest='jobs', type=int, default=8,
+            help='Number of files staged in parallel'
+            )
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stdout)
+
+    if args.manifest is not None and os.path.exists(args.manifest):
+        manifest = load_manifest(args.manifest)
+    else:
+        if args.dataset_path is None and args.dataset_index is None:
+            parser.error('You must specify: --dataset-path or --dataset-index (or an existing --manifest).')
+        dataset_path = args.dataset_path
+        dataset_index = None
+        if args.subjects is None or dataset_path is None:
+            dataset_index_filename = args.dataset_index
+            if dataset_index_filename is None:
+                dataset_index_filename = os.path.join(dataset_path, 'dataset_index.json')
+            dataset_index = load_dataset_index(dataset_index_filename, dataset_path, rebuild=args.rebuild_index)
+            if dataset_path is None:
+                dataset_path = dataset_index['dataset_path']
+        subjects_dir = args.subjects_dir
+        if subjects_dir is None:
+            subjects_dir = os.path.join(dataset_path, 'reconall_data')
+        subjects = args.subjects
+        if subjects is None:
+            subjects = index_subjects(dataset_index)
+        manifest = staging_manifest(dataset_path, subjects_dir, subjects)
+        if args.manifest is not None:
+            save_manifest(args.manifest, manifest)
+
+    counts = stage(manifest, args.mode, args.jobs)
+    logging.info('Staged %d files: %s' % (len(manifest),
+                                          ', '.join('%d %s' % (counts[key], key) for key in sorted(counts))))
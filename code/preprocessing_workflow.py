@@ -2,7 +2,13 @@
 from __future__ import division
 
 import os
-from nipype.interfaces.fsl import Info, FSLCommand, MCFLIRT, MeanImage, TemporalFilter, IsotropicSmooth, BET, GLM, BinaryMaths
+import glob
+import logging
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+from nipype.interfaces.fsl import Info, FSLCommand, MCFLIRT, MeanImage, TemporalFilter, IsotropicSmooth, BET, BinaryMaths
 from nipype.interfaces.freesurfer import BBRegister, MRIConvert
 from nipype.interfaces.ants import Registration, ApplyTransforms
 from nipype.interfaces.c3 import C3dAffineTool
@@ -13,7 +19,38 @@ from nipype.interfaces.utility import IdentityInterface, Function
 from argparse import ArgumentParser
 
 from nipypext import nipype_wrapper
-from extract_roi import extract_roi
+from extract_roi import build_design_matrix
+from glm_denoise import glm_nuisance_regression
+from temporal_filter import highpass_hz, lowpass_hz, TR, filter_sigma
+from filesystem import file_lock
+
+
+# Execution backends of the preprocessing workflow. 'SLURM' submits each node
+# as a job and falls back to 'MultiProc' on machines without sbatch.
+preprocessing_plugins = ['Linear', 'MultiProc', 'SLURM']
+
+# Resources (number of threads and memory in GB) requested by the nodes of the
+# preprocessing workflow, passed as the n_procs and mem_gb arguments of their
+# Node/MapNode constructors. They are used by the MultiProc scheduler to run
+# independent nodes (e.g. the ICA-AROMA and temporal filter iterables) side by
+# side, and translated into sbatch arguments for SLURM. Nodes that are not
+# listed use nipype's defaults.
+node_resources = {
+    'anatomical':             {'n_procs': 8, 'mem_gb': 4},
+    'motion_correction':      {'n_procs': 1, 'mem_gb': 2},
+    'antsreg':                {'n_procs': 8, 'mem_gb': 4},
+    'bbRegister':             {'n_procs': 1, 'mem_gb': 2},
+    'warpall':                {'n_procs': 1, 'mem_gb': 4},
+    'SpatialFilterAll':       {'n_procs': 1, 'mem_gb': 3},
+    'ICA_aroma':              {'n_procs': 1, 'mem_gb': 6},
+    'GLM_Design_Matrix_ICA':  {'n_procs': 1, 'mem_gb': 1},
+    'GLM_Design_Matrix_Only': {'n_procs': 1, 'mem_gb': 1},
+    'GLM_Nuissance_ICA_aroma':{'n_procs': 1, 'mem_gb': 1},
+    'GLM_Nuissance':          {'n_procs': 1, 'mem_gb': 1},
+    'TemporalFilter_ICA':     {'n_procs': 1, 'mem_gb': 3},
+    'TemporalFilter_ICA_GLM': {'n_procs': 1, 'mem_gb': 3},
+    'TemporalFilter_GLM':     {'n_procs': 1, 'mem_gb': 3},
+}
 
 
 def get_file(in_file):
@@ -74,73 +111,144 @@ def get_lookuptable(segmented_regions_file):
                                 )
     return lookuptable
 
-def preprocessing_pipeline(subject, base_path, preprocessing_type=None):
+def run_workflow(workflow, plugin='Linear', n_procs=None, memory_gb=None, plugin_args=None):
+    """ Run a workflow with one of the preprocessing_plugins:
+        - Linear: run the nodes one after the other
+        - MultiProc: run independent nodes in parallel on the local machine,
+          using at most n_procs processors and memory_gb GB of memory (the
+          whole machine by default)
+        - SLURM: submit every node as a SLURM job, requesting the resources of
+          node_resources. Falls back to MultiProc if sbatch is not available.
+    """
+    if plugin not in preprocessing_plugins:
+        raise ValueError('Unrecognised plugin: %s. Choose from: %s.' %
+                         (plugin, ', '.join(preprocessing_plugins)))
+    plugin_args = dict(plugin_args) if plugin_args is not None else {}
+
+    if plugin == 'SLURM' and which('sbatch') is None:
+        logging.warning('sbatch not found: running the SLURM workflow with MultiProc')
+        plugin = 'MultiProc'
+
+    if plugin == 'Linear':
+        return workflow.run()
+    elif plugin == 'MultiProc':
+        if n_procs is not None:
+            plugin_args['n_procs'] = n_procs
+        if memory_gb is not None:
+            plugin_args['memory_gb'] = memory_gb
+        return workflow.run(plugin='MultiProc', plugin_args=plugin_args)
+    elif plugin == 'SLURM':
+        sbatch_args = plugin_args.get('sbatch_args', '')
+        for name in workflow.list_node_names():
+            node = workflow.get_node(name)
+            node.plugin_args = {'sbatch_args': ' '.join([sbatch_args,
+                                                         '--cpus-per-task=%d' % node.n_procs,
+                                                         '--mem=%dM' % int(node.mem_gb * 1024)]),
+                                'overwrite': True}
+        return workflow.run(plugin='SLURM', plugin_args=plugin_args)
+
+
+def anatomical_outputs(subject, base_path, done=True):
+    """ Return the outputs of the anatomical stage of a subject (see
+    anatomical_pipeline) as a dictionary with:
+        - t1: the FreeSurfer T1 image in nii.gz format
+        - transform/inverse_transform: the composite T1 -> MNI transform and
+          its inverse
+        - warped_image: the T1 image in MNI space
+        - aseg: the aseg.auto segmentation in MNI space
+    Returns None if the stage was not (completely) run, i.e. if an output or
+    its done marker (see anatomical_done_filename) is missing. The marker is
+    not required if done is False. """
+    if done and not os.path.exists(anatomical_done_filename(subject, base_path)):
+        return None
+    anat_dir = os.path.join(base_path, 'data_out', 'anatomical', 'anatomical_out', subject)
+    outputs = {}
+    for name in ['t1', 'transform', 'inverse_transform', 'warped_image', 'aseg']:
+        files = sorted(glob.glob(os.path.join(anat_dir, name, '*')))
+        if len(files) != 1:
+            return None
+        outputs[name] = files[0]
+    return outputs
+
+
+def anatomical_done_filename(subject, base_path):
+    """ Marker written once all the outputs of the anatomical stage of a
+    subject are saved """
+    return os.path.join(base_path, 'data_out', 'anatomical', 'anatomical_out', subject, 'anatomical.done')
+
+
+def anatomical_pipeline(subject, base_path, plugin='Linear', n_procs=None, memory_gb=None, plugin_args=None):
     '''
-    The second argument specify the type of preprocessing
+    Subject-level anatomical processing, which does not depend on the
+    functional run: conversion of the FreeSurfer T1, T1 -> MNI registration
+    with ANTs and warp of the aseg.auto segmentation into MNI space.
+
+    The outputs are saved once per subject in data_out/anatomical (see
+    anatomical_outputs) and reused by the preprocessing of every run and task
+    type. The workflow is only run if they are missing.
+
+    The stage holds a per-subject lock, so that the runs of a subject
+    preprocessed at the same time (e.g. rest and task) wait for a single
+    anatomical stage instead of running it in the same folders. Its done
+    marker is written (atomically) only after the workflow succeeded, so an
+    interrupted stage is run again.
+    '''
+    data_out_dir = os.path.join(base_path, 'data_out', 'anatomical')
+    with file_lock(os.path.join(data_out_dir, subject, 'anatomical.lock')):
+        outputs = anatomical_outputs(subject, base_path)
+        if outputs is not None:
+            logging.info('Anatomical stage already computed for %s' % (subject))
+            return outputs
+
+        run_anatomical_workflow(subject, base_path, plugin, n_procs, memory_gb, plugin_args)
+
+        outputs = anatomical_outputs(subject, base_path, done=False)
+        if outputs is None:
+            raise RuntimeError('The anatomical stage of %s did not produce all its outputs.' % (subject))
+        done_filename = anatomical_done_filename(subject, base_path)
+        with open(done_filename + '.tmp', 'w') as done_file:
+            done_file.write(subject + '\n')
+        os.rename(done_filename + '.tmp', done_filename)
+        return outputs
+
+
+def run_anatomical_workflow(subject, base_path, plugin='Linear', n_procs=None, memory_gb=None, plugin_args=None):
+    '''
+    Build and run the workflow of the anatomical stage of a subject (see
+    anatomical_pipeline). Its working directory is data_out/anatomical/<subject>,
+    so the stages of different subjects can run side by side.
     '''
-    # Note: Subjects need to be passed as a list
-    subjects_list = [subject]
-
-    if preprocessing_type == None:
-        raise ValueError('Pass type of image you want to be preprocessessed')
-    #------------------------------------------------------------------------------
-    #                              Specify Variabless
-    #------------------------------------------------------------------------------
-    # all outputs will ge generated in compressed nifti format
     FSLCommand.set_default_output_type('NIFTI_GZ')
     # location of template file
     template = Info.standard_image('MNI152_T1_2mm.nii.gz')
 
     # Data Location
-    segmented_region_path = os.path.join(base_path, 'data_in', 'voi_extraction', 'csf_wm_LookupTable')
     data_in_dir = os.path.join(base_path, 'data_in', 'reconall_data')
-    data_out_dir = os.path.join(base_path, 'data_out', preprocessing_type)
+    data_out_dir = os.path.join(base_path, 'data_out', 'anatomical')
 
-    # Get functional image
+    # Get anatomical images
     datasource = Node(interface=DataGrabber(infields=['subject_id'],
-            outfields=['epi', 't1', 'aseg_auto']), name='datasource')
+            outfields=['t1', 'aseg_auto']), name='datasource')
     datasource.inputs.base_directory = data_in_dir
     datasource.inputs.template = '*'
     datasource.inputs.sort_filelist = True
-    if preprocessing_type == 'rest':
-        datasource.inputs.field_template = dict(epi=os.path.join('%s', 'func', '%s_task-rest_bold.nii.gz'),
-                                                t1=os.path.join('%s', 'anat', '%s_T1w.nii.gz'),
-                                                aseg_auto=os.path.join('%s', 'mri', 'aseg.auto.mgz'))
-    elif preprocessing_type == 'task':
-        datasource.inputs.field_template = dict(epi=os.path.join('%s', 'func', '%s_task-stopsignal_bold.nii.gz'),
-                                                t1=os.path.join('%s', 'anat', '%s_T1w.nii.gz'),
-                                                aseg_auto=os.path.join('%s', 'mri', 'aseg.auto.mgz'))
-    # this specifies the variables for the field_templates
-    datasource.inputs.template_args = dict(epi=[['subject_id', 'subject_id']],
-                                           t1=[['subject_id', 'subject_id']],
+    datasource.inputs.field_template = dict(t1=os.path.join('%s', 'anat', '%s_T1w.nii.gz'),
+                                            aseg_auto=os.path.join('%s', 'mri', 'aseg.auto.mgz'))
+    datasource.inputs.template_args = dict(t1=[['subject_id', 'subject_id']],
                                            aseg_auto=[['subject_id']])
-    datasource.inputs.subject_id = subjects_list
-    #------------------------------------------------------------------------------
+    datasource.inputs.subject_id = subject
     # Use data grabber specific for FreeSurfer data
     fslsource = Node(FreeSurferSource(), name='getFslData')
+    fslsource.inputs.subject_id = subject
     fslsource.inputs.subjects_dir = data_in_dir
 
-    # Generate mean image - only for the EPI image
-    mean_image = Node(MeanImage(), name='Mean_Image')
-    # mean_image.inputs.out_file = 'MeanImage.nii.gz'
-
-    # motion correction
-    mot_par = Node(MCFLIRT(), name='motion_correction')
-    mot_par.inputs.mean_vol = True
-    mot_par.inputs.save_rms = True
-    mot_par.inputs.save_plots = True
-
     # convert FreeSurfer's MGZ format to nii.gz format
     mgz2nii = Node(MRIConvert(), name='mri_convert')
     mgz2nii.inputs.out_type = 'niigz'
 
-    bet = Node(BET(), name='bet')
-    bet.inputs.frac = 0.3 # recommended by ICA-Aroma manual
-    bet.inputs.mask = True
-
     # parameters from:
     # http://miykael.github.io/nipype-beginner-s-guide/normalize.html
-    antsreg = Node(Registration(), name='antsreg')
+    antsreg = Node(Registration(), name='antsreg', **node_resources['antsreg'])
     antsreg.inputs.args = '--float'
     # antsreg.inputs.collapse_output_transforms = True
     antsreg.inputs.fixed_image = template
@@ -169,8 +277,137 @@ def preprocessing_pipeline(subject, base_path, preprocessing_type=None):
     antsreg.inputs.write_composite_transform = True
     antsreg.inputs.save_state = 'savestate.mat'
 
+    warpaseg = MapNode(ApplyTransforms(), name='warpaseg', iterfield=['input_image'])
+    warpaseg.inputs.args = '--float'
+    warpaseg.inputs.reference_image = template
+    warpaseg.inputs.input_image_type = 3
+    warpaseg.inputs.interpolation = 'Linear'
+    warpaseg.inputs.num_threads = 1
+    warpaseg.inputs.terminal_output = 'file' # writes output to file
+
+    warpaseg2file = Node(name='warpaseg2file', interface=Function(input_names=['in_file'],
+        output_names=['out_file'], function=get_file))
+
+    warpasegnii = Node(MRIConvert(), name='warpaseg_mgz2nii')
+    warpasegnii.inputs.out_type = 'niigz'
+
+    # Define DataSink, where all data will be saved
+    data_sink = Node(DataSink(), name='DataSink')
+    data_sink.inputs.base_directory = os.path.join(data_out_dir, 'anatomical_out')
+    data_sink.inputs.container = subject
+
+    anat = Workflow(name='anatomical')
+    anat.base_dir = os.path.join(data_out_dir, subject)
+    anat.connect([
+        (fslsource,           mgz2nii,        [('T1'             , 'in_file'       )] ),
+        (mgz2nii,             data_sink,      [('out_file'       , 't1'            )] ),
+        # Normalise T1 to MNI
+        (datasource,          antsreg,        [('t1'             , 'moving_image'  )] ),
+        (antsreg,             data_sink,      [('warped_image'   , 'warped_image'  ),
+                                              ('inverse_warped_image',
+                                                    'antsreg.inverse_warped_image'),
+                                              ('composite_transform',
+                                                                      'transform'  ),
+                                              ('inverse_composite_transform',
+                                                              'inverse_transform'  )] ),
+        # register aseg.auto image with WM and CSF segmentation
+        (datasource,          warpaseg,        [('aseg_auto'      , 'input_image'  )] ),
+        (antsreg,             warpaseg,        [('composite_transform',
+                                                                     'transforms'  )] ),
+        (warpaseg,            data_sink,       [('output_image'   ,
+                                                         'warp_complete.warpaseg.@')] ),
+        (warpaseg,            warpaseg2file,   [('output_image'   ,  'in_file'     )] ),
+        (warpaseg2file,       warpasegnii,     [('out_file'       ,  'in_file'     )] ),
+        (warpasegnii,         data_sink,       [('out_file'       , 'aseg'         )] ),
+    ])
+    run_workflow(anat, plugin, n_procs, memory_gb, plugin_args)
+
+
+def anatomical_stage(subject, base_path):
+    '''
+    Function node of the anatomical stage in the preprocessing workflow (see
+    anatomical_pipeline). The per-subject lock and the done marker are taken
+    inside the node, so the functional nodes that do not need the anatomical
+    outputs (motion correction, mean image, BBRegister) run alongside it.
+    The anatomical workflow itself is run linearly within the node, which
+    requests the resources of the ANTs registration.
+    '''
+    # Note: Imported here because nipype's Function nodes only run the source
+    #       code of this function.
+    from preprocessing_workflow import anatomical_pipeline
+    outputs = anatomical_pipeline(subject, base_path)
+    return outputs['t1'], outputs['transform'], outputs['aseg']
+
+
+def preprocessing_pipeline(subject, base_path, preprocessing_type=None, plugin='Linear', n_procs=None,
+                           memory_gb=None, plugin_args=None, filter_on_roi=False):
+    '''
+    The second argument specify the type of preprocessing. The workflow is run
+    with plugin (see run_workflow), the nodes requesting the resources listed
+    in node_resources. The anatomical stage is a node of the workflow, shared
+    with the other runs of the subject (see anatomical_stage).
+
+    If filter_on_roi is True, the denoised images are saved without temporal
+    filtering (in the denoised folder) and the filter bands are applied to the
+    ROI time series instead (see extract_roi).
+    '''
+    # Note: Subjects need to be passed as a list
+    subjects_list = [subject]
+
+    if preprocessing_type == None:
+        raise ValueError('Pass type of image you want to be preprocessessed')
+    #------------------------------------------------------------------------------
+    #                              Specify Variabless
+    #------------------------------------------------------------------------------
+    # all outputs will ge generated in compressed nifti format
+    FSLCommand.set_default_output_type('NIFTI_GZ')
+    # location of template file
+    template = Info.standard_image('MNI152_T1_2mm.nii.gz')
+
+    # Data Location
+    segmented_region_path = os.path.join(base_path, 'data_in', 'voi_extraction', 'csf_wm_LookupTable')
+    data_in_dir = os.path.join(base_path, 'data_in', 'reconall_data')
+    data_out_dir = os.path.join(base_path, 'data_out', preprocessing_type)
+
+    # Anatomical images and T1 -> MNI registration, shared by all the
+    # functional runs of the subject (computed only once).
+    anat = Node(name='anatomical',
+                interface=Function(input_names=['subject', 'base_path'],
+                                   output_names=['t1', 'transform', 'aseg'],
+                                   function=anatomical_stage),
+                **node_resources['anatomical'])
+    anat.inputs.base_path = base_path
+
+    # Get functional image
+    datasource = Node(interface=DataGrabber(infields=['subject_id'],
+            outfields=['epi']), name='datasource')
+    datasource.inputs.base_directory = data_in_dir
+    datasource.inputs.template = '*'
+    datasource.inputs.sort_filelist = True
+    if preprocessing_type == 'rest':
+        datasource.inputs.field_template = dict(epi=os.path.join('%s', 'func', '%s_task-rest_bold.nii.gz'))
+    elif preprocessing_type == 'task':
+        datasource.inputs.field_template = dict(epi=os.path.join('%s', 'func', '%s_task-stopsignal_bold.nii.gz'))
+    # this specifies the variables for the field_templates
+    datasource.inputs.template_args = dict(epi=[['subject_id', 'subject_id']])
+    datasource.inputs.subject_id = subjects_list
+    #------------------------------------------------------------------------------
+    # Generate mean image - only for the EPI image
+    mean_image = Node(MeanImage(), name='Mean_Image')
+    # mean_image.inputs.out_file = 'MeanImage.nii.gz'
+
+    # motion correction
+    mot_par = Node(MCFLIRT(), name='motion_correction', **node_resources['motion_correction'])
+    mot_par.inputs.mean_vol = True
+    mot_par.inputs.save_rms = True
+    mot_par.inputs.save_plots = True
+
+    bet = Node(BET(), name='bet')
+    bet.inputs.frac = 0.3 # recommended by ICA-Aroma manual
+    bet.inputs.mask = True
+
     # Corregister the median to surface
-    bbreg = Node(BBRegister(), name='bbRegister')
+    bbreg = Node(BBRegister(), name='bbRegister', **node_resources['bbRegister'])
     bbreg.inputs.init = 'fsl'
     bbreg.inputs.contrast_type = 't2'
     bbreg.inputs.out_fsl_file = True
@@ -196,7 +433,8 @@ def preprocessing_pipeline(subject, base_path, preprocessing_type=None):
     warpmean.inputs.terminal_output = 'file' # writes output to file
     warpmean.inputs.invert_transform_flags = [False, False]
 
-    warpall = MapNode(ApplyTransforms(), name='warpall', iterfield=['input_image'])
+    warpall = MapNode(ApplyTransforms(), name='warpall', iterfield=['input_image'],
+                      **node_resources['warpall'])
     warpall.inputs.args = '--float'
     warpall.inputs.reference_image = template
     warpall.inputs.input_image_type = 3
@@ -205,24 +443,11 @@ def preprocessing_pipeline(subject, base_path, preprocessing_type=None):
     warpall.inputs.terminal_output = 'file' # writes output to file
     warpall.inputs.invert_transform_flags = [False, False]
 
-    warpaseg = MapNode(ApplyTransforms(), name='warpaseg', iterfield=['input_image'])
-    warpaseg.inputs.args = '--float'
-    warpaseg.inputs.reference_image = template
-    warpaseg.inputs.input_image_type = 3
-    warpaseg.inputs.interpolation = 'Linear'
-    warpaseg.inputs.num_threads = 1
-    warpaseg.inputs.terminal_output = 'file' # writes output to file
-
-    warpasegnii = Node(MRIConvert(), name='warpaseg_mgz2nii')
-    warpasegnii.inputs.out_type = 'niigz'
-
     # get path from warp file
     warpall2file = Node(name='warpmean2file', interface=Function(input_names=['in_file'],
         output_names=['out_file'], function=get_file))
     warpmean2file = Node(name='warpall2file', interface=Function(input_names=['in_file'],
         output_names=['out_file'], function=get_file))
-    warpaseg2file = Node(name='warpaseg2file', interface=Function(input_names=['in_file'],
-        output_names=['out_file'], function=get_file))
 
     # Perform ICA to find components related to motion (implemented on ICA-Aroma)
     # inputs for the ICA-aroma function
@@ -230,7 +455,8 @@ def preprocessing_pipeline(subject, base_path, preprocessing_type=None):
                      interface=Function(input_names=['inFile', 'outDir',
                      'mc', 'subject_id', 'mask', 'denType'],
                                         output_names=['output_file', 'denType'],
-                                        function=nipype_wrapper.get_ica_aroma))
+                                        function=nipype_wrapper.get_ica_aroma),
+                     **node_resources['ICA_aroma'])
     ica_aroma.inputs.outDir = os.path.join(data_out_dir, 'preprocessing_out', 'ica_aroma')
     ica_aroma.iterables = ('denType', ['aggr', 'nonaggr'])
 
@@ -238,45 +464,53 @@ def preprocessing_pipeline(subject, base_path, preprocessing_type=None):
     mean_ica = Node(MeanImage(), name='Mean_Image_ICA')
 
     # Extract the design matrix
+    design_input_names = ['subject', 'input_file', 'segmented_image', 'lookuptable', 'output_basepath',
+                          'ica_aroma_type', 'derivatives', 'squares']
     glm_design_ica = Node(name='GLM_Design_Matrix_ICA',
-                      interface=Function(input_names=['subjects', 'network_type', 'extract_csf_wm',
-                                                      'glm_denoise', 'input_file', 'segmented_image', 'lookuptable',
-                                                      'output_basepath', 'ica_aroma_type', 'network_mask_filename'],
+                      interface=Function(input_names=design_input_names,
                                          output_names=['design_matrix'],
-                                         function=extract_roi))
-    glm_design_ica.inputs.network_type = 'full_network'
-    glm_design_ica.inputs.extract_csf_wm = True
-    glm_design_ica.inputs.glm_denoise = False
-    glm_design_ica.inputs.network_mask_filename = None
+                                         function=build_design_matrix),
+                      **node_resources['GLM_Design_Matrix_ICA'])
+    glm_design_ica.inputs.derivatives = False
+    glm_design_ica.inputs.squares = False
     glm_design_ica.inputs.lookuptable = get_lookuptable(segmented_region_path)
     glm_design_ica.inputs.output_basepath = os.path.join(data_out_dir, 'preprocessing_out', 'wm_csf_mask', 'ica_glm')
 
     glm_design_only = Node(name='GLM_Design_Matrix_Only',
-                          interface=Function(input_names=['subjects', 'network_type', 'extract_csf_wm',
-                                                          'glm_denoise', 'input_file', 'segmented_image', 'lookuptable',
-                                                          'output_basepath', 'ica_aroma_type', 'network_mask_filename'],
+                          interface=Function(input_names=design_input_names,
                                              output_names=['design_matrix'],
-                                             function=extract_roi))
-    glm_design_only.inputs.network_type = 'full_network'
-    glm_design_only.inputs.extract_csf_wm = True
-    glm_design_only.inputs.glm_denoise = True
-    glm_design_only.inputs.network_mask_filename = None
+                                             function=build_design_matrix),
+                          **node_resources['GLM_Design_Matrix_Only'])
+    glm_design_only.inputs.derivatives = False
+    glm_design_only.inputs.squares = False
     glm_design_only.inputs.lookuptable = get_lookuptable(segmented_region_path)
     glm_design_only.inputs.output_basepath = os.path.join(data_out_dir, 'preprocessing_out', 'wm_csf_mask', 'glm')
     glm_design_only.inputs.ica_aroma_type = 'no_ica'
 
-    glm_ica = Node(GLM(), name='GLM_Nuissance_ICA_aroma')
+    # Regress the nuisance regressors out of the data. Equivalent to the
+    # residuals of FSL's GLM with demean, computed in chunks of voxels (see
+    # glm_denoise.glm_nuisance_regression). The betas are not saved.
+    glm_input_names = ['in_file', 'design', 'out_res_name', 'demean', 'chunk_mb']
+    glm_ica = Node(name='GLM_Nuissance_ICA_aroma',
+                   interface=Function(input_names=glm_input_names,
+                                      output_names=['out_res'],
+                                      function=glm_nuisance_regression),
+                   **node_resources['GLM_Nuissance_ICA_aroma'])
     glm_ica.inputs.demean = True
-    glm_ica.inputs.out_res_name = 'denoised_func_data_filt_wm_csf_extracted.nii.gz'
-    glm_ica.inputs.out_file = 'glm_betas.nii.gz'
-
-    glm_only = Node(GLM(), name='GLM_Nuissance')
+    glm_ica.inputs.chunk_mb = 256
+    glm_ica.inputs.out_res_name = 'denoised_func_data_filt_wm_csf_extracted.nii'
+
+    glm_only = Node(name='GLM_Nuissance',
+                    interface=Function(input_names=glm_input_names,
+                                       output_names=['out_res'],
+                                       function=glm_nuisance_regression),
+                    **node_resources['GLM_Nuissance'])
     glm_only.inputs.demean = True
-    glm_only.inputs.out_res_name = 'func_data_filt_wm_csf_extracted.nii.gz'
-    glm_only.inputs.out_file = 'glm_betas.nii.gz'
+    glm_only.inputs.chunk_mb = 256
+    glm_only.inputs.out_res_name = 'func_data_filt_wm_csf_extracted.nii'
 
     # spatial filtering
-    iso_smooth_all = Node(IsotropicSmooth(), name='SpatialFilterAll')
+    iso_smooth_all = Node(IsotropicSmooth(), name='SpatialFilterAll', **node_resources['SpatialFilterAll'])
     iso_smooth_all.inputs.fwhm = 5
     # spatial filtering
     iso_smooth_mean = Node(IsotropicSmooth(), name='SpatialFilterMean')
@@ -286,24 +520,18 @@ def preprocessing_pipeline(subject, base_path, preprocessing_type=None):
     mean_iso_smooth = Node(MeanImage(), name='Mean_Iso_Smmoth')
 
     # temporal filtering
-    # note: TR for this experiment is 2.
-    # Because we don't know the best filtering band we performing the analyis with 4 different filters.
-    # Therefore, fwhm = 0.5 Hrz/0.01 Hrz = 50.
-    # The function here, however, requires the fwhm (aka sigma) of this value, hence, its half.
-    highpass_hz = [0.04, 0.04, 0.01, 0.01]
-    lowpass_hz= [0.1, 0.07, 0.07, 0.1]
-    TR = 2
-    temp_filt_ica = Node(TemporalFilter(), name='TemporalFilter_ICA')
-    lowpass_sigma_list = [round((1 / TR) / (lowpass * 2), 2) for lowpass in lowpass_hz]
-    highpass_sigma_list = [round((1 / TR) / (highpass * 2), 2) for highpass in highpass_hz]
+    # note: The filter bands are defined in temporal_filter.
+    temp_filt_ica = Node(TemporalFilter(), name='TemporalFilter_ICA', **node_resources['TemporalFilter_ICA'])
+    lowpass_sigma_list = [filter_sigma(lowpass, TR) for lowpass in lowpass_hz]
+    highpass_sigma_list = [filter_sigma(highpass, TR) for highpass in highpass_hz]
     temp_filt_ica.iterables = [('lowpass_sigma', lowpass_sigma_list),
                                ('highpass_sigma', highpass_sigma_list)]
 
-    temp_filt_ica_glm = Node(TemporalFilter(), name='TemporalFilter_ICA_GLM')
+    temp_filt_ica_glm = Node(TemporalFilter(), name='TemporalFilter_ICA_GLM', **node_resources['TemporalFilter_ICA_GLM'])
     temp_filt_ica_glm.iterables = [('lowpass_sigma', lowpass_sigma_list),
                                    ('highpass_sigma', highpass_sigma_list)]
 
-    temp_filt_glm = Node(TemporalFilter(), name='TemporalFilter_GLM')
+    temp_filt_glm = Node(TemporalFilter(), name='TemporalFilter_GLM', **node_resources['TemporalFilter_GLM'])
     temp_filt_glm.iterables = [('lowpass_sigma', lowpass_sigma_list),
                                ('highpass_sigma', highpass_sigma_list)]
     # temp_filt_glm.inputs.highpass_sigma = 2.5
@@ -340,7 +568,6 @@ def preprocessing_pipeline(subject, base_path, preprocessing_type=None):
                      ('_fwhm', 'fwhm'),
                      ('_warpmean0', 'warpmean'),
                      ('_warpall0', 'warpall'),
-                     ('_warpaseg0', 'warpaseg'),
                      ('_denType_aggr', 'icaroma_aggr'),
                      ('_denType_nonaggr', 'icaroma_nonaggr')]
     data_sink.inputs.substitutions = substitutions
@@ -352,8 +579,13 @@ def preprocessing_pipeline(subject, base_path, preprocessing_type=None):
     # Define connection between nodes
     preproc.connect([
         # iterate over epi and t1 files
-        (infosource,          fslsource,      [('subject_id'     , 'subject_id'    )] ),
         (infosource,          datasource,     [('subject_id'     , 'subject_id'    )] ),
+        # anatomical stage (shared by the runs of the subject)
+        (infosource,          anat,           [('subject_id'     , 'subject'       )] ),
+        (anat,                convert2itk,    [('t1'             , 'reference_file')] ),
+        (anat,                merge,          [('transform'      , 'in1'           )] ),
+        (anat,                glm_design_only,[('aseg'           , 'segmented_image')] ),
+        (anat,                glm_design_ica, [('aseg'           , 'segmented_image')] ),
         # get motion parameters
         (datasource,          mot_par,        [('epi'            , 'in_file'       )] ),
         (mot_par,             data_sink,      [('par_file'       ,
@@ -361,25 +593,11 @@ def preprocessing_pipeline(subject, base_path, preprocessing_type=None):
         # get mean image (functional data)
         (mot_par,             mean_image,     [('out_file'       , 'in_file'       )] ),
         # Co-register T1 and functional image
-        (fslsource,           mgz2nii,        [('T1'             , 'in_file'       )] ),
-        (mgz2nii,             convert2itk,    [('out_file'       , 'reference_file')] ),
         (mean_image,          convert2itk,    [('out_file'       , 'source_file'   )] ),
         (infosource,          bbreg,          [('subject_id'     , 'subject_id'    )] ),
         (mean_image,          bbreg,          [('out_file'       , 'source_file'   )] ),
         (bbreg,               convert2itk,    [('out_fsl_file'   , 'transform_file')] ),
-        # Normalise T1 to MNI
-        (datasource,          antsreg,        [('t1'             , 'moving_image'  )] ),
-        # concatenate affine and ants transforms into a list
-        (antsreg,             merge,          [('composite_transform', 'in1'       )] ),
         (convert2itk,         merge,          [('itk_transform'  , 'in2'           )] ),
-        (antsreg,             data_sink,      [('warped_image'   ,
-                                                            'antsreg.warped_image'),
-                                              ('inverse_warped_image',
-                                                    'antsreg.inverse_warped_image'),
-                                              ('composite_transform',
-                                                              'antsreg.transform' ),
-                                              ('inverse_composite_transform',
-                                                      'antsreg.inverse_transform'  )] ),
         # Use T1 transfomration to register mean functional image to MNI space
         (mean_image,          warpmean,        [('out_file'       , 'input_image'  )] ),
         (merge,               warpmean,         [('out'           , 'transforms'   )] ),
@@ -393,16 +611,6 @@ def preprocessing_pipeline(subject, base_path, preprocessing_type=None):
         # need to convert list of path given by warp all into path
         (warpall,             warpall2file,    [('output_image'   , 'in_file'      )] ),
         (warpmean,            warpmean2file,  [('output_image'    , 'in_file'      )] ),
-        # register aseg.auto image with WM and CSF segmentation
-        (datasource,          warpaseg,        [('aseg_auto'      , 'input_image'  )] ),
-        (antsreg,             warpaseg,        [('composite_transform',
-                                                                     'transforms'  )] ),
-        (warpaseg,            data_sink,       [('output_image'   ,
-                                                         'warp_complete.warpaseg.@')] ),
-        (warpaseg,            warpaseg2file,   [('output_image'   ,  'in_file'     )] ),
-        (warpaseg2file,       warpasegnii,     [('out_file'       ,  'in_file'     )] ),
-        (warpasegnii,         data_sink,       [('out_file'       ,
-                                                         'warp_complete.warpaseg.@nii')]),
         # skull strip EPI for ICA-AROMA
         (warpall2file,        bet,             [('out_file'       , 'in_file'      )] ),
         (bet,                 data_sink,       [('mask_file'      , 'bet.mask'     )] ),
@@ -416,65 +624,75 @@ def preprocessing_pipeline(subject, base_path, preprocessing_type=None):
                                                               'spatial_filter.all' )] ),
         # GLM only
         (iso_smooth_all,      mean_iso_smooth, [('out_file'       , 'in_file'      )]),
-        (infosource,          glm_design_only, [('subject_id'     , 'subjects'     )] ),
-        (warpasegnii,         glm_design_only, [('out_file'       ,
-                                                                'segmented_image'  )] ),
+        (infosource,          glm_design_only, [('subject_id'     , 'subject'      )] ),
         (iso_smooth_all,      glm_design_only, [('out_file'      , 'input_file'    )] ),
         (iso_smooth_all,      glm_only,        [('out_file'    ,   'in_file'    )] ),
         (glm_design_only,     glm_only,        [('design_matrix'  ,  'design'      )] ),
-        # Apply temporal filtering (data after wm + csf extraction)
-        (glm_only,            temp_filt_glm,   [('out_res'       , 'in_file'       )] ),
-        (temp_filt_glm,       data_sink,       [('out_file'       ,
-                                                                    'temp_filt.glm')] ),
-        # Add mean to the dataset
-        (temp_filt_glm,      final_mean_smooth,[('out_file'       , 'in_file'      )] ),
-        (mean_iso_smooth,    final_mean_smooth,[('out_file'       , 'operand_file' )] ),
-        (final_mean_smooth,  data_sink,        [('out_file'       ,
-                                                            'final_image.glm')] ),
         #                               ICA-AROMA
         # run ICA using normalised image
         (iso_smooth_all,      ica_aroma,      [('out_file'        , 'inFile'       )] ),
         (infosource,          ica_aroma,      [('subject_id'      , 'subject_id'   )] ),
         (mot_par,             ica_aroma,      [('par_file'        , 'mc'           )] ),
         (bet,                 ica_aroma,      [('mask_file'       , 'mask'         )] ),
-        # ICA-AROMA only
-        # Apply temporal filtering (data directly from ICA-aroma)
-        (ica_aroma,           temp_filt_ica,   [('output_file'    ,  'in_file'     )] ),
-        (temp_filt_ica,       data_sink,       [('out_file'       ,
-                                                                    'temp_filt.ica')] ),
-        (temp_filt_ica,       final_ica,       [('out_file'       , 'in_file'      )] ),
-        (mean_ica,            final_ica,       [('out_file'       , 'operand_file' )] ),
-        (final_ica,           data_sink,       [('out_file'       ,
-                                                                'final_image.aroma')] ),
         # ICA-AROMA + GLM
         # ICA-AROMA mean image
         (ica_aroma,           mean_ica,        [('output_file'    , 'in_file'      )] ),
         # Extract CSF + WM
-        (infosource,          glm_design_ica,  [('subject_id'     , 'subjects'     )] ),
-        (warpasegnii,         glm_design_ica,  [('out_file'       ,
-                                                                'segmented_image'  )] ),
+        (infosource,          glm_design_ica,  [('subject_id'     , 'subject'      )] ),
         (ica_aroma,           glm_design_ica,  [('output_file'    , 'input_file'   )] ),
         (ica_aroma,           glm_design_ica,  [('denType'        ,
                                                                  'ica_aroma_type'  )] ),
         (ica_aroma,           glm_ica,         [('output_file'    ,   'in_file'    )] ),
         (glm_design_ica,      glm_ica,         [('design_matrix'   ,  'design'     )] ),
-        # Apply temporal filtering (data after wm + csf extraction)
-        (glm_ica,             temp_filt_ica_glm,[('out_res'       , 'in_file'      )] ),
-        (temp_filt_ica_glm,   data_sink,       [('out_file'       ,
-                                                               'temp_filt.ica_glm' )] ),
-        # Add mean to the dataset
-        (temp_filt_ica_glm,   final_glm_ica,  [('out_file'       , 'in_file'      )] ),
-        (mean_ica,            final_glm_ica,  [('out_file'       , 'operand_file' )] ),
-        (final_glm_ica,      data_sink,       [('out_file'       ,
-                                                            'final_image.aroma_glm')] ),
     ])
 
+    if filter_on_roi:
+        # Save the denoised images without temporal filtering. The filter
+        # bands are applied to the ROI time series.
+        preproc.connect([
+            (ica_aroma,           data_sink,       [('output_file'    ,
+                                                                     'denoised.ica')] ),
+            (glm_ica,             data_sink,       [('out_res'        ,
+                                                                 'denoised.ica_glm')] ),
+            (glm_only,            data_sink,       [('out_res'        ,
+                                                                     'denoised.glm')] ),
+        ])
+    else:
+        preproc.connect([
+            # Apply temporal filtering (data after wm + csf extraction)
+            (glm_only,            temp_filt_glm,   [('out_res'       , 'in_file'       )] ),
+            (temp_filt_glm,       data_sink,       [('out_file'       ,
+                                                                        'temp_filt.glm')] ),
+            # Add mean to the dataset
+            (temp_filt_glm,      final_mean_smooth,[('out_file'       , 'in_file'      )] ),
+            (mean_iso_smooth,    final_mean_smooth,[('out_file'       , 'operand_file' )] ),
+            (final_mean_smooth,  data_sink,        [('out_file'       ,
+                                                                'final_image.glm')] ),
+            # ICA-AROMA only
+            # Apply temporal filtering (data directly from ICA-aroma)
+            (ica_aroma,           temp_filt_ica,   [('output_file'    ,  'in_file'     )] ),
+            (temp_filt_ica,       data_sink,       [('out_file'       ,
+                                                                        'temp_filt.ica')] ),
+            (temp_filt_ica,       final_ica,       [('out_file'       , 'in_file'      )] ),
+            (mean_ica,            final_ica,       [('out_file'       , 'operand_file' )] ),
+            (final_ica,           data_sink,       [('out_file'       ,
+                                                                    'final_image.aroma')] ),
+            # ICA-AROMA + GLM
+            # Apply temporal filtering (data after wm + csf extraction)
+            (glm_ica,             temp_filt_ica_glm,[('out_res'       , 'in_file'      )] ),
+            (temp_filt_ica_glm,   data_sink,       [('out_file'       ,
+                                                                   'temp_filt.ica_glm' )] ),
+            # Add mean to the dataset
+            (temp_filt_ica_glm,   final_glm_ica,  [('out_file'       , 'in_file'      )] ),
+            (mean_ica,            final_glm_ica,  [('out_file'       , 'operand_file' )] ),
+            (final_glm_ica,      data_sink,       [('out_file'       ,
+                                                                'final_image.aroma_glm')] ),
+        ])
+
     # save graph of the workflow into the workflow_graph folder
     # preproc.write_graph(os.path.join(data_out_dir, 'preprocessing_out', 'workflow_graph',
     #     'workflow_graph.dot'))
-    preproc.run()
-    # preproc.run(plugin = 'SGEGraph', plugin_args = '-q short.q')
-    # preproc.run('MultiProc', plugin_args={'n_procs': 8})
+    run_workflow(preproc, plugin, n_procs, memory_gb, plugin_args)
 
 if __name__ == '__main__':
 
@@ -499,7 +717,32 @@ if __name__ == '__main__':
             action='store_true',
             help='Perform extraction of CSF and WM'
     )
+    parser.add_argument(
+            '--plugin', dest='plugin', default='Linear',
+            choices=preprocessing_plugins,
+            help='Execution backend. Choose from: ' + ', '.join(preprocessing_plugins)
+            )
+    parser.add_argument(
+            '--n-procs', dest='n_procs', type=int, default=None,
+            help='Number of processors used by MultiProc (default: all)'
+            )
+    parser.add_argument(
+            '--memory-gb', dest='memory_gb', type=float, default=None,
+            help='Memory (GB) used by MultiProc (default: 90%% of the total)'
+            )
+    parser.add_argument(
+            '--sbatch-args', dest='sbatch_args', default='',
+            help='Extra arguments passed to sbatch for every job (e.g. partition)'
+            )
+    parser.add_argument(
+            '--filter-on-roi', dest='filter_on_roi',
+            action='store_true',
+            help='Save unfiltered denoised images and filter the ROI time series instead'
+            )
 
     args = parser.parse_args()
     # Call preproecessing function
-    preprocessing_pipeline(args.subject, args.base_path, args.preprocessing_type)
+    preprocessing_pipeline(args.subject, args.base_path, args.preprocessing_type,
+                           plugin=args.plugin, n_procs=args.n_procs, memory_gb=args.memory_gb,
+                           plugin_args={'sbatch_args': args.sbatch_args} if args.plugin == 'SLURM' else None,
+                           filter_on_roi=args.filter_on_roi)
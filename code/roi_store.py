@@ -0,0 +1,294 @@
+import os
+import json
+import time
+import numpy as np
+
+from filesystem import file_lock
+
+
+def roi_timeseries_exists(basename):
+    """ Check if the ROI time series were saved, either in the binary format or
+    in the legacy text format. """
+    return os.path.exists(basename + '.npy') or os.path.exists(basename + '.txt')
+
+
+def save_roi_timeseries(basename, avg, regions, provenance=None):
+    """ Save a (regions x time) matrix of ROI time series. The data are saved
+    in full precision as a .npy file, which can be memory-mapped to read only
+    some of the regions. A .json sidecar stores the region labels and the
+    provenance of the data (input image, atlas, parameters).
+
+    The files are written to temporary names and renamed, so that readers
+    never see partially written files. """
+    avg = np.asarray(avg, dtype=np.float64)
+    if len(regions) != avg.shape[0]:
+        raise ValueError('Inconsistent number of regions: %d labels for %d time series.' %
+                         (len(regions), avg.shape[0]))
+    metadata = {
+        'timestamp': time.strftime("%Y%m%d%H%M%S"),
+        'shape': list(avg.shape),
+        'regions': [str(region) for region in regions],
+        'provenance': provenance if provenance is not None else {}
+    }
+    with open(basename + '.npy.tmp', 'wb') as f:
+        np.save(f, avg)
+    with open(basename + '.json.tmp', 'w') as json_file:
+        json.dump(metadata, json_file, indent=4)
+    os.rename(basename + '.json.tmp', basename + '.json')
+    os.rename(basename + '.npy.tmp', basename + '.npy')
+
+
+def load_roi_timeseries(basename, regions=None, mmap_mode='r'):
+    """ Load a (regions x time) matrix of ROI time series saved with
+    save_roi_timeseries. If regions (a list of row indices) is passed, only
+    those regions are read. Outputs saved in the legacy %5e text format are
+    read as well. """
+    if os.path.exists(basename + '.npy'):
+        data = np.load(basename + '.npy', mmap_mode=mmap_mode)
+    else:
+        data = np.genfromtxt(basename + '.txt')
+    if regions is not None:
+        data = data[regions]
+    return np.array(data)
+
+
+def load_roi_metadata(basename):
+    """ Load the region labels and the provenance of saved ROI time series """
+    with open(basename + '.json') as json_file:
+        return json.load(json_file)
+
+
+def roi_analysis_path(subject, ica_aroma_type, glm_denoise):
+    """ Folder (relative to the ROI extraction output) where the ROI time series
+    of a subject are saved, according to the type of ica_aroma and GLM
+    denoising. """
+    if (ica_aroma_type in ['aggr', 'nonaggr']) and (glm_denoise is False):
+        return os.path.join('ica', subject, ''.join(['icaroma_', ica_aroma_type]))
+    elif (ica_aroma_type in ['aggr', 'nonaggr']) and (glm_denoise is True):
+        return os.path.join('ica_glm', subject, ''.join(['icaroma_', ica_aroma_type]))
+    elif (ica_aroma_type == 'no_ica') and (glm_denoise is True):
+        return os.path.join('glm', subject)
+    raise ValueError('Unrecognised ica_aroma_type/glm_denoise combination: %s/%s.' %
+                     (ica_aroma_type, glm_denoise))
+
+
+def roi_subject_path(basepath, subject, ica_aroma_type, glm_denoise, band=None):
+    """ Folder of the ROI time series of a subject (see roi_analysis_path),
+    or of its band folder for the time series filtered on the ROI with band
+    (see extract_roi.save_filtered_subject_roi) """
+    subject_path = os.path.join(basepath, roi_analysis_path(subject, ica_aroma_type, glm_denoise))
+    if band is not None:
+        subject_path = os.path.join(subject_path, band)
+    return subject_path
+
+
+def roi_nnetworks(subject_path):
+    """ Number of within_network ROI time series saved in subject_path. It
+    is read from the .json sidecar of the first network (see
+    extract_roi.save_subject_roi); the time series saved without it (e.g. in
+    the legacy text format) are counted. """
+    basename = os.path.join(subject_path, 'within_network_0')
+    if os.path.exists(basename + '.json'):
+        nnetworks = load_roi_metadata(basename)['provenance'].get('nnetworks')
+        if nnetworks is not None:
+            return nnetworks
+    nnetworks = 0
+    while roi_timeseries_exists(os.path.join(subject_path, 'within_network_%d' % nnetworks)):
+        nnetworks += 1
+    return nnetworks
+
+
+def roi_timeseries_names(network_type, nnetworks=None):
+    """ Names of the ROI time series saved for a network type """
+    if network_type == 'within_network':
+        return ['within_network_%d' % network for network in range(nnetworks)]
+    elif network_type in ['full_network', 'between_network']:
+        return [network_type]
+    raise ValueError('Unrecognised network type: %s' % (network_type))
+
+
+def cohort_store_path(basepath, ica_aroma_type, glm_denoise, name, band=None):
+    """ Path of the cohort store of the ROI time series called name. There is
+    one store per preprocessing variant (and per band of the ROI time series
+    filtered on the ROI, see extract_roi.save_filtered_subject_roi), which
+    lives next to the subject folders. """
+    store_path = os.path.join(basepath, roi_analysis_path('cohort', ica_aroma_type, glm_denoise))
+    if band is not None:
+        store_path = os.path.join(store_path, band)
+    return os.path.join(store_path, name)
+
+
+def load_cohort_index(basename):
+    """ Load the index of a cohort store: the list of subjects (the position
+    in the list is the subject's row), the shape (regions x time) of each row
+    and the region labels. Returns None if the store does not exist. """
+    if not os.path.exists(basename + '.json'):
+        return None
+    with open(basename + '.json') as json_file:
+        return json.load(json_file)
+
+
+def roi_timeseries_signature(basename):
+    """ Signature (modification time and size) of the .npy file of saved ROI
+    time series, or None if there is no such file. The signature is kept in
+    the cohort index, to check that a row of the store still matches the
+    subject's own file (see load_subject_roi_timeseries). """
+    if not os.path.exists(basename + '.npy'):
+        return None
+    stat = os.stat(basename + '.npy')
+    return [int(stat.st_mtime), stat.st_size]
+
+
+def cohort_row_is_current(index, subject, basename):
+    """ Check if the row of a subject in a cohort store (whose index is index)
+    holds the ROI time series currently saved in basename, i.e. if the
+    signature of the file (see roi_timeseries_signature) is the one saved in
+    the index. A subject without its own file is never trusted, so that a
+    store whose subject folders are missing (e.g. after a partial stage-in)
+    does not serve stale rows. """
+    if index is None or subject not in index['subjects']:
+        return False
+    signature = roi_timeseries_signature(basename)
+    if signature is None:
+        return False
+    return index.get('signatures', {}).get(subject) == signature
+
+
+def cohort_store_lock(basename):
+    """ Hold an exclusive lock on a cohort store, so that several extraction
+    jobs (e.g. one per subject on the cluster) can update the same store. The
+    lock is an flock on a .lock file next to the store (see
+    filesystem.file_lock). """
+    return file_lock(basename + '.lock')
+
+
+def append_cohort_timeseries(basename, subject, avg, regions=None, source=None):
+    """ Add the (regions x time) matrix of a subject to a cohort store. The
+    store keeps the matrices of all subjects in a single (subjects x regions x
+    time) float64 file, plus a .json index mapping each subject to its row.
+    New subjects are appended and subjects already in the store are
+    overwritten. If source (the basename of the subject's own ROI time series)
+    is passed, its signature is saved in the index (see
+    roi_timeseries_signature).
+
+    The whole update holds the lock of the store (see cohort_store_lock), so
+    that concurrent jobs never get the same row. """
+    avg = np.ascontiguousarray(avg, dtype='<f8')
+    with cohort_store_lock(basename):
+        index = load_cohort_index(basename)
+        if index is None:
+            index = {'subjects': [],
+                     'shape': list(avg.shape),
+                     'regions': [str(region) for region in regions] if regions is not None else None,
+                     'signatures': {}}
+        if list(avg.shape) != index['shape']:
+            raise ValueError('Inconsistent shape for subject %s. In store: %s. Passed: %s.' %
+                             (subject, index['shape'], list(avg.shape)))
+
+        if subject in index['subjects']:
+            row = index['subjects'].index(subject)
+        else:
+            row = len(index['subjects'])
+        # Rows are written at their offset rather than appended, so that a row
+        # left behind by an interrupted append is simply overwritten.
+        mode = 'r+b' if os.path.exists(basename + '.dat') else 'wb'
+        with open(basename + '.dat', mode) as f:
+            f.seek(row * avg.nbytes)
+            f.write(avg.tobytes())
+
+        if row == len(index['subjects']):
+            index['subjects'].append(subject)
+        signatures = index.setdefault('signatures', {})
+        signatures.pop(subject, None)
+        if source is not None:
+            signatures[subject] = roi_timeseries_signature(source)
+        with open(basename + '.json.tmp', 'w') as json_file:
+            json.dump(index, json_file, indent=4)
+        os.rename(basename + '.json.tmp', basename + '.json')
+
+
+def open_cohort_timeseries(basename, mmap_mode='r'):
+    """ Memory-map a cohort store. Returns the (subjects x regions x time)
+    array, a dictionary mapping each subject to its row and the index of the
+    store, or None if the store does not exist. """
+    index = load_cohort_index(basename)
+    if index is None or not index['subjects']:
+        return None
+    shape = tuple([len(index['subjects'])] + index['shape'])
+    data = np.memmap(basename + '.dat', dtype='<f8', mode=mmap_mode, shape=shape)
+    rows = {subject: row for row, subject in enumerate(index['subjects'])}
+    return data, rows, index
+
+
+def load_subject_roi_timeseries(basepath, subject, name, ica_aroma_type, glm_denoise, cohorts=None, band=None):
+    """ Load the ROI time series called name of a subject. They are read from
+    the cohort store when it contains the subject and its row matches the
+    subject's own file (see cohort_row_is_current), otherwise from the
+    subject's own file. If band is passed, the time series filtered on the ROI
+    with that band are loaded (see extract_roi.save_filtered_subject_roi). The
+    cohorts dictionary keeps the opened stores, so that each store is opened
+    only once when loading several subjects. """
+    if cohorts is None:
+        cohorts = {}
+    key = (band, name)
+    if key not in cohorts:
+        cohorts[key] = open_cohort_timeseries(cohort_store_path(basepath, ica_aroma_type,
+                                                                glm_denoise, name, band))
+    basename = os.path.join(roi_subject_path(basepath, subject, ica_aroma_type, glm_denoise, band), name)
+    if cohorts[key] is not None:
+        data, rows, index = cohorts[key]
+        if cohort_row_is_current(index, subject, basename):
+            return np.array(data[rows[subject]])
+    return load_roi_timeseries(basename)
+
+
+# Preprocessing variants (ica_aroma_type, glm_denoise) from which ROI time
+# series can be extracted.
+ROI_VARIANTS = [('aggr', False), ('nonaggr', False), ('aggr', True), ('nonaggr', True), ('no_ica', True)]
+
+
+def denoised_image_filename(ica_aroma_type, glm_denoise, filtered=True):
+    """ Name of the temporally filtered image (or, if filtered is False, of the
+    denoised image before temporal filtering) written by the preprocessing for
+    a preprocessing variant """
+    if (ica_aroma_type in ['aggr', 'nonaggr']) and (glm_denoise is False):
+        if not filtered:
+            return 'denoised_func_data_%s.nii.gz' % ica_aroma_type
+        return 'denoised_func_data_%s_filt.nii.gz' % ica_aroma_type
+    elif (ica_aroma_type in ['aggr', 'nonaggr']) and (glm_denoise is True):
+        if not filtered:
+            return 'denoised_func_data_filt_wm_csf_extracted.nii'
+        return 'denoised_func_data_filt_wm_csf_extracted_filt.nii.gz'
+    elif (ica_aroma_type == 'no_ica') and (glm_denoise is True):
+        if not filtered:
+            return 'func_data_filt_wm_csf_extracted.nii'
+        return 'func_data_filt_wm_csf_extracted_filt.nii.gz'
+    raise ValueError('Unrecognised ica_aroma_type/glm_denoise combination: %s/%s.' %
+                     (ica_aroma_type, glm_denoise))
+
+
+def discover_roi_variants(input_basepath, subject, filtered=True):
+    """ Find all the filtered images of a subject under input_basepath (the
+    temp_filt folder of the preprocessing), or the unfiltered ones (in the
+    denoised folder) if filtered is False. Images inside sub-folders (e.g. one
+    per temporal filter band) are found as well.
+
+    Returns a list of dictionaries with the ica_aroma_type, glm_denoise, the
+    path of the image and the analysis_path, i.e. the folder of the image
+    relative to input_basepath, which is mirrored in the ROI output. """
+    variants = []
+    for ica_aroma_type, glm_denoise in ROI_VARIANTS:
+        analysis_path = roi_analysis_path(subject, ica_aroma_type, glm_denoise)
+        filename = denoised_image_filename(ica_aroma_type, glm_denoise, filtered)
+        variant_path = os.path.join(input_basepath, analysis_path)
+        for root, dirs, files in os.walk(variant_path):
+            dirs.sort()
+            if filename in files:
+                variants.append({
+                    'ica_aroma_type': ica_aroma_type,
+                    'glm_denoise': glm_denoise,
+                    'input_file': os.path.join(root, filename),
+                    'analysis_path': os.path.normpath(os.path.join(analysis_path,
+                                                                   os.path.relpath(root, variant_path)))
+                })
+    return variants
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+""" Run the stages of the analysis (pre-processing, ROI extraction, data and
+group analysis) as jobs of a bounded worker pool.
+
+The status of every job is recorded in a state file. Jobs that fail are
+retried, and when the scheduler is started again with the same state file the
+jobs that already completed are skipped, so an interrupted batch resumes where
+it stopped. """
+import os
+import sys
+import json
+import time
+import logging
+import subprocess
+from multiprocessing.pool import ThreadPool
+from argparse import ArgumentParser
+
+from subjects import load_subjects
+
+
+stages = ['preprocess', 'extract_roi', 'analyse_data_golden', 'analyse_data', 'analyse_data_group']
+network_types = ['between_network', 'within_network', 'full_network']
+data_analysis_types = ['BOLD', 'synchrony', 'graph_analysis']
+
+# Folder of the analysis scripts, from where the jobs are run.
+code_path = os.path.dirname(os.path.abspath(__file__))
+
+
+def stage_jobs(stage, subjects, args):
+    """ Return the jobs of a stage as a list of (job id, command) pairs. The
+    pre-processing has one job per subject, the other stages one job per
+    network type: all the window types, data analysis types and numbers of
+    clusters of a network type are run by one call of main_analysis.py, as a
+    parameter sweep (see sweep.py).
+
+    The golden pass (analyse_data_golden) extracts the ROIs of the golden
+    subjects and computes the optimal thresholds used by the data analysis of
+    the other subjects, so it runs before analyse_data. """
+    python = sys.executable
+    if stage == 'preprocess':
+        return [('preprocess/%s' % subject,
+                 [python, 'preprocessing_workflow.py', '-s', subject, '-p', args.base_path,
+                  '-t', args.analysis_type])
+                for subject in subjects]
+
+    # Options shared by all calls of main_analysis.py.
+    common = ['--analysis-type', args.analysis_type,
+              '--subjects-file', os.path.join(code_path, args.subjects_filename),
+              '-j', str(args.job_workers)]
+    if args.nsubjects is not None:
+        common += ['-n', str(args.nsubjects)]
+    if args.ica_aroma_type is not None:
+        common += ['--ica_aroma-type', args.ica_aroma_type]
+    if args.glm_denoise:
+        common += ['--glm_denoise']
+
+    jobs = []
+    if stage == 'extract_roi':
+        for network_type in args.network_types:
+            jobs.append(('extract_roi/%s' % network_type,
+                         [python, 'main_analysis.py', '-r', '--network-type', network_type] + common))
+    elif stage in ['analyse_data_golden', 'analyse_data', 'analyse_data_group']:
+        if stage == 'analyse_data_golden':
+            flags = ['-r', '-a', '-c']
+        elif stage == 'analyse_data':
+            flags = ['-a']
+        else:
+            flags = ['-g', '--group-analysis-type', args.group_analysis_type]
+        for network_type in args.network_types:
+            # The BOLD data analysis only works with full_network networks.
+            data_analysis_types = [data_analysis_type for data_analysis_type in args.data_analysis_types
+                                   if data_analysis_type != 'BOLD' or network_type == 'full_network']
+            if not data_analysis_types:
+                continue
+            command = [python, 'main_analysis.py'] + flags + \
+                      ['--network-type', network_type,
+                       '--window-type'] + args.window_types + \
+                      ['--data-analysis-type'] + data_analysis_types + \
+                      ['--nclusters'] + [str(nclusters) for nclusters in args.nclusters] + \
+                      ['--rand-ind', str(args.rand_ind)] + common
+            if args.window_sizes is not None:
+                command += ['--window-size'] + [str(window_size) for window_size in args.window_sizes]
+            jobs.append(('%s/%s' % (stage, network_type), command))
+    else:
+        raise ValueError('Unrecognised stage: %s.' % (stage))
+    return jobs
+
+
+def load_state(filename):
+    """ Load the state file. Returns a dictionary mapping each job id to its
+    status: the command, the number of attempts, the return code of the last
+    attempt and whether the job is pending, running, done or failed. """
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save_state(filename, state):
+    """ Write the state file to a temporary file and rename it, so that an
+    interruption never leaves a partially written state. """
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(state, f, indent=4, sort_keys=True)
+    os.rename(filename + '.tmp', filename)
+
+
+def run_job(job):
+    """ Run the command of a job, appending its output to the job's log file.
+    Returns the job id and the return code. """
+    job_id, command, log_filename = job
+    log_dir = os.path.dirname(log_filename)
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+    with open(log_filename, 'a') as log_file:
+        log_file.write('# %s %s\n' % (time.strftime("%Y%m%d%H%M%S"), ' '.join(command)))
+        log_file.flush()
+        try:
+            returncode = subprocess.call(command, cwd=code_path, stdout=log_file, stderr=subprocess.STDOUT)
+        except OSError as error:
+            log_file.write('%s\n' % (error))
+            returncode = -1
+    return job_id, returncode
+
+
+def run_stage(jobs, state, state_filename, log_path, workers=1, retries=1):
+    """ Run the jobs of a stage with at most workers jobs at a time. Each job
+    is attempted up to retries + 1 times. Jobs already done according to the
+    state are skipped, unless their command changed.
+
+    Returns the ids of the jobs that failed. """
+    pending = []
+    for job_id, command in jobs:
+        status = state.get(job_id)
+        if status is None or status['command'] != command:
+            status = state[job_id] = {'command': command, 'attempts': 0, 'returncode': None,
+                                      'status': 'pending'}
+        if status['status'] == 'done':
+            logging.info('%-60s done' % (job_id))
+            continue
+        # Jobs that were running when the scheduler was interrupted, or that
+        # failed in a previous run, are attempted again.
+        status['status'] = 'pending'
+        status['attempts'] = 0
+        pending.append(job_id)
+
+    pool = ThreadPool(max(1, workers))
+    try:
+        while pending:
+            for job_id in pending:
+                state[job_id]['status'] = 'running'
+                state[job_id]['attempts'] += 1
+            save_state(state_filename, state)
+
+            log_filenames = [os.path.join(log_path, job_id.replace('/', '_') + '.log') for job_id in pending]
+            retry = []
+            for job_id, returncode in pool.imap_unordered(run_job, [(job_id, state[job_id]['command'], log_filename)
+                                                                   for job_id, log_filename
+                                                                   in zip(pending, log_filenames)]):
+                status = state[job_id]
+                status['returncode'] = returncode
+                if returncode == 0:
+                    status['status'] = 'done'
+                elif status['attempts'] <= retries:
+                    status['status'] = 'pending'
+                    retry.append(job_id)
+                else:
+                    status['status'] = 'failed'
+                logging.info('%-60s %s (attempt %d, return code %d)' %
+                             (job_id, status['status'], status['attempts'], returncode))
+                save_state(state_filename, state)
+            pending = retry
+    finally:
+        pool.close()
+        pool.join()
+
+    return [job_id for job_id, _ in jobs if state[job_id]['status'] == 'failed']
+
+
+def schedule(args):
+    """ Run the requested stages in order. A stage only starts when all the
+    jobs of the previous stage completed. """
+    subjects = load_subjects(os.path.join(code_path, args.subjects_filename), False, args.nsubjects)
+    state = load_state(args.state_filename)
+    for stage in stages:
+        if stage not in args.stages:
+            continue
+        logging.info('')
+        logging.info('* STAGE: %s' % (stage))
+        failed = run_stage(stage_jobs(stage, subjects, args), state, args.state_filename,
+                           args.log_path, args.workers, args.retries)
+        if failed:
+            logging.info('%d jobs failed, stopping: %s' % (len(failed), ', '.join(failed)))
+            return False
+    return True
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(
+            description='Run the analysis stages for all subjects with a bounded pool of workers'
+            )
+    parser.add_argument(
+            '--analysis-type', dest='analysis_type', required=True,
+            choices=['rest', 'task'],
+            help='Type of analysis to be performed'
+            )
+    parser.add_argument(
+            '--stages', dest='stages', nargs='+', default=stages,
+            choices=stages,
+            help='Stages to run. Choose from: ' + ', '.join(stages)
+            )
+    parser.add_argument(
+            '-p', '--base-path', dest='base_path',
+            default=os.path.join(os.path.sep, 'group', 'dynamics', 'scz_dynamics', 'ucla-la5'),
+            help='Data base path'
+            )
+    parser.add_argument(
+            '--subjects-file', dest='subjects_filename', default='subjects.json',
+            help='JSON file with the list of subjects'
+            )
+    parser.add_argument(
+            '-n', '--nsubjects', dest='nsubjects', type=int, default=None,
+            help='Number of healthy and schizophrenic subjects.'
+            )
+    parser.add_argument(
+            '--network-types', dest='network_types', nargs='+', default=['full_network'],
+            choices=network_types,
+            help='Network types. Choose from: ' + ', '.join(network_types)
+            )
+    parser.add_argument(
+            '--data-analysis-types', dest='data_analysis_types', nargs='+', default=['graph_analysis'],
+            choices=data_analysis_types,
+            help='Data analysis types. Choose from: ' + ', '.join(data_analysis_types)
+            )
+    parser.add_argument(
+            '--window-types', dest='window_types', nargs='+', default=['sliding'],
+            choices=['non-sliding', 'sliding'],
+            help='Window types'
+            )
+    parser.add_argument(
+            '--window-sizes', dest='window_sizes', type=int, nargs='+', default=None,
+            help='Sizes of the sliding window in time points (default: the size of main_analysis.py).'
+            )
+    parser.add_argument(
+            '--nclusters', dest='nclusters', type=int, nargs='+', default=[10],
+            help='Numbers of clusters to use in data analysis.'
+            )
+    parser.add_argument(
+            '--rand-ind', dest='rand_ind', type=int, default=20,
+            help='Random index to use in data analysis (graph_analysis only).'
+            )
+    parser.add_argument(
+            '--group-analysis-type', dest='group_analysis_type', default='ttest',
+            choices=['hutchenson', 'ttest', '1ANOVA'],
+            help='Group analysis type'
+            )
+    parser.add_argument(
+            '--ica_aroma-type', dest='ica_aroma_type', default='nonaggr',
+            choices=['aggr', 'nonaggr', 'no_ica'],
+            help='ICA aroma type'
+            )
+    parser.add_argument(
+            '--glm_denoise', dest='glm_denoise',
+            action='store_true',
+            help='Use the data denoised with GLM'
+            )
+    parser.add_argument(
+            '-j', '--workers', dest='workers', type=int, default=1,
+            help='Maximum number of jobs running at the same time'
+            )
+    parser.add_argument(
+            '--job-workers', dest='job_workers', type=int, default=1,
+            help='Number of subjects or sweep steps processed in parallel by each job (-j of main_analysis.py)'
+            )
+    parser.add_argument(
+            '--retries', dest='retries', type=int, default=1,
+            help='Number of times a failed job is retried'
+            )
+    parser.add_argument(
+            '--state-file', dest='state_filename', default='scheduler_state.json',
+            help='File where the status of the jobs is recorded'
+            )
+    parser.add_argument(
+            '--log-path', dest='log_path', default='scheduler_logs',
+            help='Folder of the log files of the jobs'
+            )
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stdout)
+    sys.exit(0 if schedule(args) else 1)
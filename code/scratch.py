@@ -0,0 +1,81 @@
+import os
+import shutil
+import logging
+import tempfile
+
+from filesystem import makedirs
+
+
+def same_size_and_mtime(source, target):
+    """ Check if target is a copy of source made with shutil.copy2, i.e. has
+    the same size and (whole seconds of) modification time """
+    if not os.path.exists(target):
+        return False
+    source_stat = os.stat(source)
+    target_stat = os.stat(target)
+    return target_stat.st_size == source_stat.st_size and \
+        int(target_stat.st_mtime) == int(source_stat.st_mtime)
+
+
+def sync_file(source, target):
+    """ Copy source to target unless target already has the same size and
+    modification time. The copy is written to a temporary file in the target
+    folder and renamed, so that readers (or concurrent jobs syncing the same
+    file) never see a partially written file.
+
+    Returns True if the file was copied. """
+    if same_size_and_mtime(source, target):
+        return False
+    target_dir = os.path.dirname(target)
+    makedirs(target_dir)
+    fd, tmp_target = tempfile.mkstemp(dir=target_dir, prefix='.%s.' % os.path.basename(target))
+    os.close(fd)
+    try:
+        shutil.copy2(source, tmp_target)
+        os.rename(tmp_target, target)
+    except Exception:
+        os.remove(tmp_target)
+        raise
+    return True
+
+
+def sync_tree(source, target, relpaths=None):
+    """ Copy the files under source (or only under the relpaths inside source)
+    that are missing or changed to the same location under target (see
+    sync_file). Paths that do not exist in source are ignored.
+
+    Returns the number of files copied. """
+    if relpaths is None:
+        relpaths = ['']
+    ncopied = 0
+    for relpath in relpaths:
+        source_path = os.path.join(source, relpath)
+        if os.path.isfile(source_path):
+            ncopied += sync_file(source_path, os.path.join(target, relpath))
+            continue
+        for root, dirs, files in os.walk(source_path):
+            for filename in files:
+                filepath = os.path.join(root, filename)
+                ncopied += sync_file(filepath, os.path.join(target, os.path.relpath(filepath, source)))
+    return ncopied
+
+
+def scratch_to_shared(path, scratch_base_path, shared_base_path):
+    """ Return the location on the shared filesystem of a scratch path """
+    return os.path.join(shared_base_path, os.path.relpath(path, scratch_base_path))
+
+
+def stage_in(path, scratch_base_path, shared_base_path, relpaths=None):
+    """ Copy the inputs of a job, path (or only relpaths inside it) on the
+    scratch folder, from the shared filesystem. Files already on scratch and
+    unchanged are not copied again, so the jobs running on the same node share
+    them. """
+    ncopied = sync_tree(scratch_to_shared(path, scratch_base_path, shared_base_path), path, relpaths)
+    logging.info('Staged in %d files: %s' % (ncopied, path))
+
+
+def stage_out(path, scratch_base_path, shared_base_path, relpaths=None):
+    """ Copy the outputs of a job, path (or only relpaths inside it) on the
+    scratch folder, back to the shared filesystem """
+    ncopied = sync_tree(path, scratch_to_shared(path, scratch_base_path, shared_base_path), relpaths)
+    logging.info('Synced back %d files: %s' % (ncopied, path))
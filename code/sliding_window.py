@@ -0,0 +1,82 @@
+from __future__ import division
+
+import numpy as np
+from scipy.signal import fftconvolve, get_window
+
+
+# Tapers of the sliding window. The boxcar (flat) window is computed with
+# prefix sums; the other tapers (any window of scipy.signal.get_window) with an
+# FFT convolution.
+window_tapers = ['boxcar', 'triang', 'hann', 'hamming', 'blackman']
+
+# Size (in time points) of the sliding window.
+sliding_window_size = 5
+
+
+def window_name(window_type, window_size=sliding_window_size, window_stride=1, window_taper='boxcar'):
+    """ Name of the folder of the results of a window. The default sliding
+    window (sliding_window_size, stride 1, boxcar) keeps the plain 'sliding'
+    name, other sizes, strides and tapers are appended to it, e.g.
+    'sliding_size_7_stride_2_hann'. """
+    if window_type != 'sliding':
+        return window_type
+    name = window_type
+    if window_size != sliding_window_size:
+        name += '_size_%d' % window_size
+    if window_stride != 1:
+        name += '_stride_%d' % window_stride
+    if window_taper != 'boxcar':
+        name += '_%s' % window_taper
+    return name
+
+
+def window_weights(window_size, taper='boxcar'):
+    """ Return the weights of a window of window_size samples, normalised to
+    sum 1 """
+    weights = get_window(taper, window_size, fftbins=False)
+    return weights / np.sum(weights)
+
+
+def prefix_sums(data):
+    """ Return the cumulative sums of a (regions x time) matrix along time,
+    with a leading column of zeros, so that the sum of the samples start:stop
+    of each region is sums[:, stop] - sums[:, start] """
+    sums = np.zeros((data.shape[0], data.shape[1] + 1), dtype=np.result_type(data.dtype, np.float64))
+    np.cumsum(data, axis=1, out=sums[:, 1:])
+    return sums
+
+
+def sliding_window_averages(data, window_sizes, stride=1, taper='boxcar'):
+    """ Average the (regions x time) data over sliding windows of each of the
+    window_sizes, moved by stride samples, for all regions at once. As with
+    np.convolve in 'valid' mode, only windows fully inside the data are kept:
+    window i covers the samples i * stride to i * stride + window_size.
+
+    With the boxcar taper every window size is computed from a single pass of
+    prefix sums (see prefix_sums), so sweeping the window size costs about the
+    same as one size.
+
+    Returns a dictionary mapping each window size to the (regions x windows)
+    averages. """
+    data = np.asarray(data)
+    if stride < 1:
+        raise ValueError('Invalid window stride: %d.' % (stride))
+    if taper == 'boxcar':
+        sums = prefix_sums(data)
+    averages = {}
+    for window_size in window_sizes:
+        if window_size < 1 or window_size > data.shape[1]:
+            raise ValueError('Invalid window size: %d for %d time points.' % (window_size, data.shape[1]))
+        if taper == 'boxcar':
+            average = (sums[:, window_size:] - sums[:, :-window_size]) / window_size
+        else:
+            # The windows are symmetric, so the convolution is a correlation.
+            average = fftconvolve(data, window_weights(window_size, taper)[np.newaxis, :], mode='valid', axes=1)
+        averages[window_size] = average[:, ::stride]
+    return averages
+
+
+def sliding_window_average(data, window_size, stride=1, taper='boxcar'):
+    """ Average the (regions x time) data over sliding windows of window_size
+    samples (see sliding_window_averages) """
+    return sliding_window_averages(data, [window_size], stride, taper)[window_size]
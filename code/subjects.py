@@ -2,7 +2,11 @@ import json
 import logging
 
 
-def load_subjects(filename, golden_subjects, nsubjects=None):
+def load_subjects(filename, golden_subjects, nsubjects=None, index=None, tasks=()):
+    """ Return a balanced list of healthy and schizophrenic subjects, or the
+    golden subjects. The healthy and schizophrenic subjects are read from
+    filename or, if a dataset index is passed (see dataset_index), queried from
+    the index among the subjects with a run of all tasks. """
     logging.info('')
     logging.info('--------------------------------------------------------------------')
     logging.info(' Subjects')
@@ -14,6 +18,10 @@ def load_subjects(filename, golden_subjects, nsubjects=None):
         dct = json.load(f)
     subjects_healthy = dct['subjects']['healthy']
     subjects_schizo = dct['subjects']['schizo']
+    if index is not None:
+        from dataset_index import index_subjects
+        subjects_healthy = index_subjects(index, 'healthy', tasks)
+        subjects_schizo = index_subjects(index, 'schizo', tasks)
     subjects_golden = dct['subjects']['golden']
 
     # Return a balanced amount of healthy and schizophrenic patients.
@@ -0,0 +1,366 @@
+""" Parameter sweep of the data and group analyses.
+
+Sweeping the window type and size, the data analysis type and the number of
+clusters with one main_analysis.py call per combination recomputes, for every
+combination, results that do not depend on it. The sweep is instead planned as
+a dependency graph:
+
+    dynamic measures (per subject and window type, for all window sizes)
+        -> optimal threshold from the golden subjects (per window)
+        -> thresholded synchrony (per subject and window)
+        -> graph measures (per subject and window, graph_analysis only)
+        -> k-means clustering (per subject, data analysis type and nclusters)
+        -> group statistics (per data analysis type and nclusters)
+
+where each node is computed exactly once, and the nodes are run by a pool of
+workers as soon as their dependencies complete. The shared results are saved
+in data_analysis_shared_basepath, the results of each combination in the usual
+folders (see data_analysis_subject_basepath), so the group analysis reads them
+as if they were computed one combination at a time. Each window has its own
+folder (see window_name). """
+import os
+import json
+import pickle
+import logging
+import traceback
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from data_analysis import (check_number_networks, subject_window_dynamic_measures, subjects_optimal_k,
+                           dump_optimal_k, dump_golden_subjects_json, threshold_synchrony, synchrony_shannon_entropy,
+                           calculate_graph_measures, graph_measures_shannon_entropy, dump_graph_measures,
+                           bold_analysis, data_analysis_subject_basepath, data_analysis_shared_basepath,
+                           dump_dynamic_measures, sliding_window_size, window_name)
+from roi_store import load_subject_roi_timeseries
+from group_analysis_pairwise import group_analysis_pairwise
+from filesystem import makedirs
+
+
+def load_pickle(path, filename):
+    with open(os.path.join(path, filename), 'rb') as f:
+        return pickle.load(f)
+
+
+def dump_pickle(path, filename, data):
+    makedirs(path)
+    with open(os.path.join(path, filename), 'wb') as f:
+        pickle.dump(data, f)
+
+
+################################################################################
+# Nodes
+################################################################################
+def sweep_dynamic_measures(input_basepath, output_basepath, subject, network_type, nnetwork_keys, window_type,
+                           window_sizes, window_stride, window_taper, ica_aroma_type, glm_denoise, band=None):
+    """ Compute the dynamic measures of a subject for all window_sizes at once
+    (see subject_window_dynamic_measures), and save them in the folder of each
+    window """
+    window_dynamic_measures = subject_window_dynamic_measures(input_basepath, subject, network_type, nnetwork_keys,
+                                                              window_sizes, window_type, ica_aroma_type,
+                                                              glm_denoise, window_stride=window_stride,
+                                                              window_taper=window_taper, band=band)
+    for window_size in window_sizes:
+        window_path = window_name(window_type, window_size, window_stride, window_taper)
+        subject_path = data_analysis_shared_basepath(output_basepath, network_type, window_path, subject)
+        makedirs(subject_path)
+        dump_dynamic_measures(subject_path, window_dynamic_measures[window_size])
+
+
+def sweep_optimal_k(output_basepath, golden_subjects, network_type, nnetwork_keys, window_type, window_size,
+                    data_analysis_types):
+    """ Compute the optimal threshold of each network from the golden subjects
+    (see calculate_healthy_optimal_k) """
+    shared_path = data_analysis_shared_basepath(output_basepath, network_type, window_type)
+    healthy_k_optima = subjects_optimal_k(golden_subjects,
+                                          [data_analysis_shared_basepath(output_basepath, network_type,
+                                                                         window_type, subject)
+                                           for subject in golden_subjects],
+                                          nnetwork_keys)
+    dump_optimal_k(shared_path, healthy_k_optima)
+    dump_golden_subjects_json(shared_path, network_type, golden_subjects, window_size,
+                              data_analysis_types)
+
+
+def sweep_threshold(output_basepath, subject, network_type, window_type):
+    """ Binarise the synchrony of a subject with the optimal threshold (see
+    threshold_synchrony) """
+    shared_path = data_analysis_shared_basepath(output_basepath, network_type, window_type)
+    subject_path = os.path.join(shared_path, subject)
+    dynamic_measures = load_pickle(subject_path, 'dynamic_measures.pickle')
+    synchrony = dict((network, dynamic_measures[network]['synchrony']) for network in dynamic_measures)
+    with open(os.path.join(shared_path, 'optimal_k.json')) as f:
+        k_optima = json.load(f)
+    synchrony_bins = threshold_synchrony(synchrony, k_optima)
+    dump_pickle(subject_path, 'synchrony_bins.pickle', synchrony_bins)
+
+
+def load_synchrony_bins(subject_path):
+    return load_pickle(subject_path, 'synchrony_bins.pickle')
+
+
+def sweep_graph_measures(output_basepath, subject, network_type, window_type):
+    """ Compute the graph measures of a subject (see
+    calculate_graph_measures) """
+    subject_path = data_analysis_shared_basepath(output_basepath, network_type, window_type, subject)
+    dynamic_measures = load_pickle(subject_path, 'dynamic_measures.pickle')
+    synchrony = dict((network, dynamic_measures[network]['synchrony']) for network in dynamic_measures)
+    graph_theory_measures, networks_global_efficiency = \
+        calculate_graph_measures(synchrony, load_synchrony_bins(subject_path))
+    dump_graph_measures(subject_path, graph_theory_measures, networks_global_efficiency)
+
+
+def sweep_cluster(input_basepath, output_basepath, subject, network_type, window_type, data_analysis_type,
+                  nclusters, rand_ind, ica_aroma_type, glm_denoise, band=None):
+    """ Cluster the measures of a subject with nclusters clusters and save the
+    Shannon entropy measures where data_analysis saves them """
+    subject_path = data_analysis_subject_basepath(output_basepath, network_type, window_type,
+                                                  data_analysis_type, nclusters, rand_ind, subject)
+    shared_path = data_analysis_shared_basepath(output_basepath, network_type, window_type, subject)
+    makedirs(subject_path)
+    if data_analysis_type == 'BOLD':
+        data = load_subject_roi_timeseries(input_basepath, subject, 'full_network', ica_aroma_type, glm_denoise,
+                                           band=band)
+        bold_analysis(subject_path, data, nclusters)
+    elif data_analysis_type == 'synchrony':
+        dump_pickle(subject_path, 'synchrony_shannon_entropy_measures.pickle',
+                    synchrony_shannon_entropy(load_synchrony_bins(shared_path), nclusters))
+    elif data_analysis_type == 'graph_analysis':
+        graph_theory_measures = load_pickle(shared_path, 'graph_analysis_measures.pickle')
+        # The group analysis reads the graph measures next to the entropy.
+        dump_graph_measures(subject_path, graph_theory_measures,
+                            load_pickle(shared_path, 'global_efficiency.pickle'))
+        dump_pickle(subject_path, 'graph_analysis_shannon_entropy_measures.pickle',
+                    graph_measures_shannon_entropy(graph_theory_measures, nclusters))
+    else:
+        raise ValueError('Unrecognised data analysis type: %s' % (data_analysis_type))
+
+
+################################################################################
+# Graph
+################################################################################
+def sweep_windows(window_types, window_sizes, window_stride=1, window_taper='boxcar'):
+    """ Return the windows of the sweep as (window type, window size, folder
+    name) tuples (see window_name). The window size only applies to the
+    sliding window, so the other window types have a single window. """
+    windows = []
+    for window_type in window_types:
+        if window_type == 'sliding':
+            sizes = window_sizes
+        else:
+            sizes = [sliding_window_size]
+        for window_size in sizes:
+            windows.append((window_type, window_size,
+                            window_name(window_type, window_size, window_stride, window_taper)))
+    return windows
+
+
+def sweep_graph(subjects,
+                golden_subjects,
+                input_basepath,
+                output_basepath,
+                group_output_basepath,
+                network_type,
+                window_types,
+                data_analysis_types,
+                nclusters_list,
+                rand_ind,
+                ica_aroma_type,
+                glm_denoise,
+                analyse_data=True,
+                group_analysis_type=None,
+                groups=None,
+                window_sizes=None,
+                window_stride=1,
+                window_taper='boxcar',
+                band=None,
+                golden_pass=False,
+                compute_optimal_k=True):
+    """ Plan the sweep over all combinations of window_types, window_sizes
+    (of the sliding window only, sliding_window_size by default),
+    data_analysis_types and nclusters_list. If band is passed, the ROI time
+    series filtered on the ROI with that band are analysed (see
+    roi_store.load_subject_roi_timeseries).
+
+    Returns the nodes of the graph as a list of (node id, function, keyword
+    arguments, ids of the dependencies), where every node comes after its
+    dependencies. Without analyse_data, only the group analysis nodes are
+    planned, from the results of a previous sweep.
+
+    With golden_pass, only the dynamic measures of the golden subjects and the
+    optimal threshold of each window are planned, as data_analysis does with
+    golden_subjects. Without compute_optimal_k, the thresholds saved by a
+    previous golden pass are used instead of being computed again. """
+    if 'BOLD' in data_analysis_types and network_type != 'full_network':
+        raise ValueError('The BOLD data analysis only works with ' +
+                         'full_network networks.')
+    if window_sizes is None:
+        window_sizes = [sliding_window_size]
+    windows = sweep_windows(window_types, window_sizes, window_stride, window_taper)
+    nodes = []
+    if analyse_data:
+        nnetwork_keys = check_number_networks(subjects or golden_subjects, input_basepath, network_type,
+                                              ica_aroma_type, glm_denoise, band)
+        if golden_pass:
+            subjects = []
+        elif not compute_optimal_k:
+            golden_subjects = []
+        # Subjects in both lists are only computed once.
+        all_subjects = subjects + [subject for subject in golden_subjects if subject not in subjects]
+        dynamic_types = [data_analysis_type for data_analysis_type in data_analysis_types
+                         if data_analysis_type != 'BOLD']
+        for window_type in window_types:
+            if not dynamic_types:
+                break
+            # All the window sizes are computed by a single node per subject.
+            for subject in all_subjects:
+                nodes.append(('dynamic_measures/%s/%s' % (window_type, subject), sweep_dynamic_measures,
+                              {'input_basepath': input_basepath, 'output_basepath': output_basepath,
+                               'subject': subject, 'network_type': network_type,
+                               'nnetwork_keys': nnetwork_keys, 'window_type': window_type,
+                               'window_sizes': [window_size for sweep_window_type, window_size, _ in windows
+                                                if sweep_window_type == window_type],
+                               'window_stride': window_stride, 'window_taper': window_taper,
+                               'ica_aroma_type': ica_aroma_type, 'glm_denoise': glm_denoise, 'band': band},
+                              []))
+        for window_type, window_size, window_path in windows:
+            if not dynamic_types:
+                break
+            # The nodes below only use the folder of the window.
+            optimal_k_ids = []
+            if compute_optimal_k:
+                optimal_k_ids.append('optimal_k/%s' % window_path)
+                nodes.append((optimal_k_ids[-1], sweep_optimal_k,
+                              {'output_basepath': output_basepath, 'golden_subjects': golden_subjects,
+                               'network_type': network_type, 'nnetwork_keys': nnetwork_keys,
+                               'window_type': window_path, 'window_size': window_size,
+                               'data_analysis_types': dynamic_types},
+                              ['dynamic_measures/%s/%s' % (window_type, subject) for subject in golden_subjects]))
+            for subject in subjects:
+                nodes.append(('threshold/%s/%s' % (window_path, subject), sweep_threshold,
+                              {'output_basepath': output_basepath, 'subject': subject,
+                               'network_type': network_type, 'window_type': window_path},
+                              ['dynamic_measures/%s/%s' % (window_type, subject)] + optimal_k_ids))
+                if 'graph_analysis' in dynamic_types:
+                    nodes.append(('graph_measures/%s/%s' % (window_path, subject), sweep_graph_measures,
+                                  {'output_basepath': output_basepath, 'subject': subject,
+                                   'network_type': network_type, 'window_type': window_path},
+                                  ['threshold/%s/%s' % (window_path, subject)]))
+        if golden_pass:
+            return nodes
+
+    for _, _, window_path in windows:
+        for data_analysis_type in data_analysis_types:
+            for nclusters in nclusters_list:
+                combination = '%s/%s/nclusters_%d' % (window_path, data_analysis_type, nclusters)
+                cluster_ids = []
+                if analyse_data:
+                    if data_analysis_type == 'BOLD':
+                        dependencies = []
+                    elif data_analysis_type == 'synchrony':
+                        dependencies = ['threshold/%s/%%s' % window_path]
+                    else:
+                        dependencies = ['graph_measures/%s/%%s' % window_path]
+                    for subject in subjects:
+                        cluster_ids.append('cluster/%s/%s' % (combination, subject))
+                        nodes.append((cluster_ids[-1], sweep_cluster,
+                                      {'input_basepath': input_basepath, 'output_basepath': output_basepath,
+                                       'subject': subject, 'network_type': network_type,
+                                       'window_type': window_path, 'data_analysis_type': data_analysis_type,
+                                       'nclusters': nclusters, 'rand_ind': rand_ind,
+                                       'ica_aroma_type': ica_aroma_type, 'glm_denoise': glm_denoise,
+                                       'band': band},
+                                      [dependency % subject for dependency in dependencies]))
+                if group_analysis_type is not None:
+                    nodes.append(('group/%s' % combination, group_analysis_pairwise,
+                                  {'subjects': subjects, 'input_basepath': output_basepath,
+                                   'output_basepath': group_output_basepath, 'network_type': network_type,
+                                   'window_type': window_path, 'data_analysis_type': data_analysis_type,
+                                   'group_analysis_type': group_analysis_type, 'nclusters': nclusters,
+                                   'rand_ind': rand_ind, 'groups': groups},
+                                  cluster_ids))
+    return nodes
+
+
+def run_node(node):
+    """ Run the function of a node. Returns the node id and whether it
+    succeeded; errors are logged instead of raised, so that the other nodes
+    keep running. """
+    node_id, function, kwargs = node
+    try:
+        function(**kwargs)
+        return node_id, True
+    except Exception:
+        logging.info('%s failed:\n%s' % (node_id, traceback.format_exc()))
+        return node_id, False
+
+
+def run_graph(nodes, workers=1):
+    """ Run the nodes (see sweep_graph), at most workers at a time. A node is
+    started as soon as all its dependencies completed. The nodes that depend
+    on a node that failed are not run. A node also fails when its task or its
+    result cannot be pickled, or when its worker dies (e.g. killed when out of
+    memory); the worker pool is then started again for the other nodes. As
+    the nodes running when a worker dies all fail, they are run once more
+    before being counted as failed.
+
+    Returns the ids of the nodes that failed or were not run. """
+    dependencies = dict((node_id, set(node_dependencies)) for node_id, _, _, node_dependencies in nodes)
+    nodes_by_id = dict((node[0], node) for node in nodes)
+    retried = set()
+    pending = [node for node in nodes]
+    done = set()
+    failed = set()
+    running = {}
+    executor = ProcessPoolExecutor(workers) if workers > 1 else None
+    try:
+        while pending or running:
+            # Start the nodes whose dependencies completed and drop the ones
+            # whose dependencies failed.
+            still_pending = []
+            finished = []
+            for node_id, function, kwargs, _ in pending:
+                if dependencies[node_id] & failed:
+                    logging.info('%-60s skipped' % (node_id))
+                    failed.add(node_id)
+                elif dependencies[node_id] <= done:
+                    if executor is None:
+                        finished.append(run_node((node_id, function, kwargs)))
+                        continue
+                    try:
+                        future = executor.submit(run_node, (node_id, function, kwargs))
+                    except RuntimeError:
+                        # The pool is broken by a worker that died.
+                        executor.shutdown(wait=False)
+                        executor = ProcessPoolExecutor(workers)
+                        future = executor.submit(run_node, (node_id, function, kwargs))
+                    running[future] = node_id
+                else:
+                    still_pending.append((node_id, function, kwargs, dependencies[node_id]))
+            pending = still_pending
+
+            if running:
+                completed, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in completed:
+                    node_id = running.pop(future)
+                    try:
+                        finished.append(future.result())
+                    except BrokenProcessPool:
+                        if node_id in retried:
+                            logging.info('%s failed: its worker died' % (node_id))
+                            finished.append((node_id, False))
+                        else:
+                            logging.info('%-60s retried (a worker died)' % (node_id))
+                            retried.add(node_id)
+                            pending.append(nodes_by_id[node_id])
+                    except Exception:
+                        logging.info('%s failed:\n%s' % (node_id, traceback.format_exc()))
+                        finished.append((node_id, False))
+            elif pending and not finished:
+                raise ValueError('Unsatisfiable dependencies: %s.' % (', '.join(node[0] for node in pending)))
+            for node_id, success in finished:
+                (done if success else failed).add(node_id)
+                logging.info('%-60s %s' % (node_id, 'done' if success else 'failed'))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return [node_id for node_id, _, _, _ in nodes if node_id in failed]
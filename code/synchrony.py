@@ -0,0 +1,218 @@
+from __future__ import division
+
+import numpy as np
+
+
+def condensed_pairs(nregions):
+    """ Return the (rows, columns) of the pairs of regions of the condensed
+    representation of a symmetric matrix: the upper triangle without the
+    diagonal, pair-major (row by row, as scipy's squareform). Each edge is
+    stored once, so a (regions x regions x time) tensor is condensed into an
+    (edges x time) matrix. """
+    return np.triu_indices(nregions, 1)
+
+
+def condense(matrices):
+    """ Condense a (regions x regions x time) tensor of symmetric matrices into
+    an (edges x time) matrix (see condensed_pairs) """
+    rows, columns = condensed_pairs(matrices.shape[0])
+    return matrices[rows, columns]
+
+
+def expand(condensed, nregions, diagonal=0):
+    """ Expand an (edges x time) condensed matrix (see condensed_pairs) into
+    the (regions x regions x time) tensor of symmetric matrices, with the
+    given value on the diagonal """
+    rows, columns = condensed_pairs(nregions)
+    matrices = np.zeros((nregions, nregions) + condensed.shape[1:], dtype=condensed.dtype)
+    matrices[rows, columns] = condensed
+    matrices[columns, rows] = condensed
+    matrices[np.arange(nregions), np.arange(nregions)] = diagonal
+    return matrices
+
+
+class PackedGraphs(object):
+    """ Binary graphs (regions x regions x time) stored condensed (see
+    condensed_pairs) and bit-packed: 8 edges per byte, i.e. 64 times less
+    memory than float64 square matrices. The edges of each time point are
+    packed along the first axis of an (ceil(edges / 8) x time) uint8 array.
+
+    The graphs are unpacked (and expanded into square matrices) one block of
+    time points at a time, where they are needed. """
+
+    def __init__(self, packed, nregions):
+        self.packed = packed
+        self.nregions = nregions
+
+    @classmethod
+    def from_condensed(cls, condensed, nregions):
+        """ Pack an (edges x time) condensed matrix of zeros and ones """
+        return cls(np.packbits(np.asarray(condensed) != 0, axis=0), nregions)
+
+    @property
+    def nedges(self):
+        return self.nregions * (self.nregions - 1) // 2
+
+    @property
+    def ntpoints(self):
+        return self.packed.shape[1]
+
+    @property
+    def shape(self):
+        return (self.nedges, self.ntpoints)
+
+    def condensed(self, start=0, stop=None, dtype=np.float64):
+        """ Return the (edges x time) condensed graphs of the time points
+        start:stop, unpacked """
+        return np.unpackbits(self.packed[:, start:stop], axis=0)[:self.nedges].astype(dtype)
+
+    def iter_expanded_time_blocks(self, diagonal=1, block_mb=64, dtype=np.float64):
+        """ Yield (start, stop, matrices) where matrices are the (regions x
+        regions x (stop - start)) square graphs of the time points start:stop
+        (see expand). Only one block of square matrices is in memory at a
+        time. """
+        length = max(1, int(block_mb * 2 ** 20 // (self.nregions * self.nregions * np.dtype(dtype).itemsize)))
+        for start in range(0, self.ntpoints, length):
+            stop = min(start + length, self.ntpoints)
+            yield start, stop, expand(self.condensed(start, stop, dtype), self.nregions, diagonal)
+
+
+class PhaseSynchrony(object):
+    """ Pairwise synchrony (the order parameter |(z_i + z_j) / 2| of each
+    pair of regions i, j, where z are the unit phase vectors of the regions)
+    at each time point, computed on demand.
+
+    Only the (regions x time) phase vectors are kept, so the memory used is
+    O(regions * time) plus one block, instead of the O(regions^2 * time) of
+    the full synchrony tensor. Blocks of regions (rows) or of time points are
+    computed when needed, and the mean synchrony, the metastability and the
+    thresholded graphs are streamed over the blocks. The values of every block
+    are identical to the corresponding part of the full tensor, which
+    np.asarray(synchrony) still builds. """
+
+    def __init__(self, phase_vectors, block_mb=64):
+        self.phase_vectors = np.asarray(phase_vectors)
+        self.block_mb = block_mb
+
+    @classmethod
+    def from_phase_angle(cls, phase_angle, block_mb=64):
+        return cls(np.exp(phase_angle * 1j), block_mb)
+
+    @property
+    def shape(self):
+        nregions, ntpoints = self.phase_vectors.shape
+        return (nregions, nregions, ntpoints)
+
+    @property
+    def ndim(self):
+        return 3
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float64)
+
+    def block_length(self, length):
+        """ Number of items of a block, where each item takes length complex
+        values, so that a block fits in block_mb """
+        return max(1, int(self.block_mb * 2 ** 20 // (length * np.dtype(np.complex128).itemsize)))
+
+    def row_block(self, start, stop):
+        """ Return the synchrony of the regions start:stop with all regions at
+        all time points, as a ((stop - start) x regions x time) array """
+        return np.abs((self.phase_vectors[start:stop, np.newaxis, :] +
+                       self.phase_vectors[np.newaxis, :, :]) / 2)
+
+    def time_block(self, start, stop):
+        """ Return the synchrony of all pairs of regions at the time points
+        start:stop, as a (regions x regions x (stop - start)) array """
+        phase_vectors = self.phase_vectors[:, start:stop]
+        return np.abs((phase_vectors[:, np.newaxis, :] + phase_vectors[np.newaxis, :, :]) / 2)
+
+    def pair_block(self, start, stop):
+        """ Return the synchrony of the condensed pairs of regions start:stop
+        (see condensed_pairs) at all time points, as a ((stop - start) x time)
+        array """
+        rows, columns = condensed_pairs(self.shape[0])
+        return np.abs((self.phase_vectors[rows[start:stop]] + self.phase_vectors[columns[start:stop]]) / 2)
+
+    def iter_row_blocks(self):
+        """ Yield (start, stop, row_block(start, stop)) covering all regions """
+        nregions, _, ntpoints = self.shape
+        length = self.block_length(nregions * ntpoints)
+        for start in range(0, nregions, length):
+            stop = min(start + length, nregions)
+            yield start, stop, self.row_block(start, stop)
+
+    def iter_pair_blocks(self):
+        """ Yield (start, stop, pair_block(start, stop)) covering all the
+        condensed pairs of regions """
+        nregions, _, ntpoints = self.shape
+        nedges = nregions * (nregions - 1) // 2
+        # Blocks of whole bytes of packed edges (see PackedGraphs).
+        length = max(8, self.block_length(ntpoints) // 8 * 8)
+        for start in range(0, nedges, length):
+            stop = min(start + length, nedges)
+            yield start, stop, self.pair_block(start, stop)
+
+    def iter_time_blocks(self):
+        """ Yield (start, stop, time_block(start, stop)) covering all time
+        points """
+        nregions, _, ntpoints = self.shape
+        length = self.block_length(nregions * nregions)
+        for start in range(0, ntpoints, length):
+            stop = min(start + length, ntpoints)
+            yield start, stop, self.time_block(start, stop)
+
+    def mean(self):
+        """ Mean synchrony of each pair of regions over time """
+        nregions = self.shape[0]
+        mean_synchrony = np.zeros((nregions, nregions))
+        for start, stop, block in self.iter_row_blocks():
+            mean_synchrony[start:stop] = np.mean(block, axis=2)
+        return mean_synchrony
+
+    def std(self):
+        """ Standard deviation of the synchrony of each pair of regions over
+        time (pair metastability) """
+        nregions = self.shape[0]
+        pair_metastability = np.zeros((nregions, nregions))
+        for start, stop, block in self.iter_row_blocks():
+            pair_metastability[start:stop] = np.std(block, axis=2)
+        return pair_metastability
+
+    def threshold(self, threshold):
+        """ Return the binary graphs of the pairs of regions whose synchrony is
+        at least threshold, as PackedGraphs. Each block of pairs is compared
+        at once and packed. """
+        nregions, _, ntpoints = self.shape
+        packed = np.zeros(((nregions * (nregions - 1) // 2 + 7) // 8, ntpoints), dtype=np.uint8)
+        for start, stop, block in self.iter_pair_blocks():
+            packed[start // 8:(stop + 7) // 8] = np.packbits(block >= threshold, axis=0)
+        return PackedGraphs(packed, nregions)
+
+    def __array__(self, dtype=None, copy=None):
+        synchrony = np.zeros(self.shape)
+        for start, stop, block in self.iter_time_blocks():
+            synchrony[:, :, start:stop] = block
+        if dtype is not None:
+            synchrony = synchrony.astype(dtype)
+        return synchrony
+
+    def __getitem__(self, key):
+        """ Index the synchrony as the full tensor. Only the requested time
+        points are computed. """
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+        phase_vectors = self.phase_vectors[:, key[2]]
+        return np.abs((phase_vectors[:, np.newaxis] + phase_vectors[np.newaxis, :]) / 2)[key[0], key[1]]
+
+
+def threshold_graphs(synchrony, threshold):
+    """ Return the binary graphs (see PhaseSynchrony.threshold) of a synchrony
+    tensor, either a PhaseSynchrony or a (regions x regions x time) array (as
+    saved in the dynamic measures by older versions of calculate_phi) """
+    if isinstance(synchrony, PhaseSynchrony):
+        return synchrony.threshold(threshold)
+    return PackedGraphs.from_condensed(condense(synchrony) >= threshold, synchrony.shape[0])
+
@@ -0,0 +1,71 @@
+from __future__ import division
+
+import numpy as np
+
+
+# Temporal filter bands (high pass and low pass frequencies in Hz) used in the
+# preprocessing. Because we don't know the best filtering band we perform the
+# analysis with 4 different filters.
+highpass_hz = [0.04, 0.04, 0.01, 0.01]
+lowpass_hz = [0.1, 0.07, 0.07, 0.1]
+# Note: TR for this experiment is 2.
+TR = 2
+
+
+def filter_sigma(hz, TR=TR):
+    """ Convert a cut-off frequency into the sigma (in volumes) expected by
+    fslmaths -bptf. E.g. 0.5 Hz/0.01 Hz = 50 volumes; the function requires
+    half of this value. """
+    return round((1 / TR) / (hz * 2), 2)
+
+
+def filter_bands(highpass_hz=highpass_hz, lowpass_hz=lowpass_hz, TR=TR):
+    """ Return the filter bands as a list of (name, highpass_sigma,
+    lowpass_sigma). The name is the folder where the ROI time series filtered
+    with the band are saved. """
+    return [('band_%s_%s' % (highpass, lowpass), filter_sigma(highpass, TR), filter_sigma(lowpass, TR))
+            for highpass, lowpass in zip(highpass_hz, lowpass_hz)]
+
+
+def bandpass_matrix(ntime, highpass_sigma, lowpass_sigma):
+    """ Return the (time x time) matrix of the band pass filter of fslmaths
+    -bptf (FSL >= 5.0.7). A sigma <= 0 disables the corresponding filter.
+        - high pass: subtract from each time point the value at that point of
+          the line fitted with Gaussian weights (sigma highpass_sigma,
+          truncated at 3 sigma). This also removes the mean.
+        - low pass: Gaussian smoothing (sigma lowpass_sigma, truncated at 20
+          sigma + 2 points), renormalised at the edges.
+    """
+    times = np.arange(ntime)
+    dt = times[np.newaxis, :] - times[:, np.newaxis]
+    filter_matrix = np.eye(ntime)
+
+    if highpass_sigma > 0:
+        half_width = int(highpass_sigma * 3)
+        w = np.where(np.abs(dt) <= half_width, np.exp(-0.5 * dt ** 2 / highpass_sigma ** 2), 0)
+        A = (w * dt).sum(axis=1)
+        C = (w * dt ** 2).sum(axis=1)
+        N = w.sum(axis=1)
+        denominator = C * N - A ** 2
+        valid = denominator != 0
+        # The intercept of the weighted line fit is linear in the data.
+        intercept = w * (C[:, np.newaxis] - A[:, np.newaxis] * dt)
+        intercept[valid] /= denominator[valid, np.newaxis]
+        intercept[~valid] = 0
+        filter_matrix = filter_matrix - intercept
+
+    if lowpass_sigma > 0:
+        half_width = int(lowpass_sigma * 20) + 2
+        w = np.where(np.abs(dt) <= half_width, np.exp(-0.5 * dt ** 2 / lowpass_sigma ** 2), 0)
+        w /= w.sum(axis=1)[:, np.newaxis]
+        filter_matrix = np.dot(w, filter_matrix)
+
+    return filter_matrix
+
+
+def bandpass_filter(timeseries, highpass_sigma, lowpass_sigma):
+    """ Apply the band pass filter of fslmaths -bptf (see bandpass_matrix) to
+    a (regions x time) matrix of time series. Since the filter is linear, the
+    average of filtered voxels equals the filtered average of the voxels. """
+    timeseries = np.asarray(timeseries, dtype=np.float64)
+    return np.dot(timeseries, bandpass_matrix(timeseries.shape[-1], highpass_sigma, lowpass_sigma).T)
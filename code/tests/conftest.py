@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of the pipeline are scripts in the code folder, imported by name.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
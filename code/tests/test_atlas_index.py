@@ -0,0 +1,122 @@
+from __future__ import division
+
+import os
+import numpy as np
+import nibabel as nib
+
+import atlas_index
+from extract_roi import most_likely_roi_network, roi_voxel_index
+from atlas_index import (build_atlas_index, load_atlas_index, atlas_networks, atlas_mask, cached_file_hash,
+                         file_hash)
+
+
+def loop_networks(segmented_image_data, intensities, boolean_ntw):
+    """ The original region -> network assignment (a running maximum over
+    the networks of the fraction of network voxels inside each region) and
+    the voxels of each network kept for between_network """
+    networks = dict((network, []) for network in range(boolean_ntw.shape[3]))
+    ntw_filter = np.zeros(boolean_ntw.shape)
+    for region, intensity in enumerate(intensities):
+        boolean_mask = segmented_image_data == intensity
+        p_network = 0
+        for network in range(boolean_ntw.shape[3]):
+            filtered_mask = np.multiply(boolean_ntw[:, :, :, network], boolean_mask)
+            with np.errstate(invalid='ignore'):
+                tmp = np.sum(filtered_mask) / float(np.sum(boolean_ntw[:, :, :, network]))
+            if tmp > p_network:
+                networks[network].append(region)
+                ntw_filter[:, :, :, network] = np.add(filtered_mask, ntw_filter[:, :, :, network])
+                p_network = tmp
+    return networks, ntw_filter
+
+
+def write_atlas(path, seed=0):
+    rng = np.random.RandomState(seed)
+    shape = (8, 7, 6)
+    segmented_image = os.path.join(path, 'atlas.nii.gz')
+    network_mask = os.path.join(path, 'networks.nii')
+    nib.Nifti1Image(rng.randint(0, 7, shape).astype(np.float32), np.eye(4)).to_filename(segmented_image)
+    nib.Nifti1Image(rng.normal(1.5, 1, shape + (4,)).astype(np.float32), np.eye(4)).to_filename(network_mask)
+    lookuptable = np.array([(i, ('region%d' % i).encode('ascii'), intensity)
+                            for i, intensity in enumerate(range(1, 7))],
+                           dtype=[('numbers', '<i8'), ('regions', 'S31'), ('intensity', '<i8')])
+    return segmented_image, network_mask, lookuptable
+
+
+def test_build_atlas_index_regions(tmpdir):
+    segmented_image, network_mask, lookuptable = write_atlas(str(tmpdir))
+    index = build_atlas_index(segmented_image, lookuptable, network_mask)
+    segmented_image_data = nib.load(segmented_image).get_fdata()
+
+    for region, intensity in enumerate(lookuptable['intensity']):
+        region_voxels = index['voxels'][index['offsets'][region]:index['offsets'][region + 1]]
+        assert list(region_voxels) == list(np.flatnonzero(segmented_image_data == intensity))
+    np.testing.assert_array_equal(atlas_mask(index), np.isin(segmented_image_data, lookuptable['intensity']))
+
+
+def test_most_likely_roi_network_matches_loop():
+    rng = np.random.RandomState(3)
+    shape = (6, 5, 4)
+    segmented_image_data = rng.randint(0, 6, shape)
+    boolean_ntw = rng.normal(1.5, 1, shape + (5,)) > 1.64
+    # A network without voxels (0 / 0) never gets a region.
+    boolean_ntw[..., 2] = False
+    # Region 7 has no voxels.
+    intensities = [1, 2, 3, 7, 4, 5]
+    voxels, offsets = roi_voxel_index([segmented_image_data == intensity for intensity in intensities])
+    networks, assignment = most_likely_roi_network(voxels, offsets, boolean_ntw)
+    expected, _ = loop_networks(segmented_image_data, intensities, boolean_ntw)
+    assert networks == expected
+    assert networks[2] == []
+    assert [region for region in range(len(intensities)) if assignment[region].any()] == \
+        sorted(set(region for network in expected for region in expected[network]))
+
+
+def test_build_atlas_index_networks_match_loop(tmpdir):
+    segmented_image, network_mask, lookuptable = write_atlas(str(tmpdir))
+    index = build_atlas_index(segmented_image, lookuptable, network_mask)
+    segmented_image_data = nib.load(segmented_image).get_fdata()
+    boolean_ntw = nib.load(network_mask).get_fdata() > 1.64
+
+    networks, ntw_filter = loop_networks(segmented_image_data, lookuptable['intensity'], boolean_ntw)
+    assert atlas_networks(index) == networks
+    offsets = index['between_offsets']
+    for network in range(boolean_ntw.shape[3]):
+        assert list(index['between_voxels'][offsets[network]:offsets[network + 1]]) == \
+            list(np.flatnonzero(ntw_filter[:, :, :, network] > 0))
+
+
+def test_load_atlas_index_is_cached(tmpdir, monkeypatch):
+    segmented_image, network_mask, lookuptable = write_atlas(str(tmpdir))
+    cache_dir = os.path.join(str(tmpdir), 'cache')
+    index = load_atlas_index(segmented_image, lookuptable, network_mask, cache_dir)
+
+    def fail(*args):
+        raise AssertionError('The atlas index was built again')
+    monkeypatch.setattr(atlas_index, 'build_atlas_index', fail)
+    cached = load_atlas_index(segmented_image, lookuptable, network_mask, cache_dir)
+    for name in atlas_index.ATLAS_INDEX_ARRAYS:
+        np.testing.assert_array_equal(cached[name], index[name])
+
+
+def test_cached_file_hash(tmpdir, monkeypatch):
+    filename = os.path.join(str(tmpdir), 'image.bin')
+    with open(filename, 'wb') as f:
+        f.write(b'atlas' * 1000)
+    calls = []
+
+    def counted_file_hash(name, *args):
+        calls.append(name)
+        return file_hash(name, *args)
+    monkeypatch.setattr(atlas_index, 'file_hash', counted_file_hash)
+
+    sha1 = cached_file_hash(filename, str(tmpdir))
+    assert sha1 == file_hash(filename)
+    assert cached_file_hash(filename, str(tmpdir)) == sha1
+    assert len(calls) == 1
+
+    # A new modification time invalidates the cached hash.
+    stat = os.stat(filename)
+    os.utime(filename, (stat.st_atime, stat.st_mtime + 10))
+    assert cached_file_hash(filename, str(tmpdir)) == sha1
+    assert len(calls) == 2
@@ -0,0 +1,47 @@
+import os
+import socket
+
+from bash_reconall import reconall_jobs, reconall_lock_is_stale
+
+
+def write_lock(subjects_dir, subject, host, pid):
+    scripts_path = os.path.join(subjects_dir, subject, 'scripts')
+    if not os.path.isdir(scripts_path):
+        os.makedirs(scripts_path)
+    lock_filename = os.path.join(scripts_path, 'IsRunning.lh+rh')
+    with open(lock_filename, 'w') as f:
+        f.write('------------------------------\n')
+        f.write('SUBJECT %s\n' % subject)
+        f.write('HOST %s\n' % host)
+        f.write('PROCESSID %d\n' % pid)
+    return lock_filename
+
+
+def test_reconall_jobs_keep_live_locks(tmpdir):
+    subjects_dir = str(tmpdir)
+    host = socket.gethostname()
+    # No process can have this id (above the largest pid_max).
+    dead_pid = 2 ** 22 + 1
+    os.makedirs(os.path.join(subjects_dir, 'sub-1', 'scripts'))
+    open(os.path.join(subjects_dir, 'sub-1', 'scripts', 'recon-all.done'), 'w').close()
+    dead_lock = write_lock(subjects_dir, 'sub-2', host, dead_pid)
+    live_lock = write_lock(subjects_dir, 'sub-3', host, os.getpid())
+    other_host_lock = write_lock(subjects_dir, 'sub-4', 'another-node', dead_pid)
+
+    state = {}
+    jobs = dict(reconall_jobs('/dataset', subjects_dir, ['sub-1', 'sub-2', 'sub-3', 'sub-4', 'sub-5'], state))
+    assert sorted(jobs) == ['reconall/sub-2', 'reconall/sub-5']
+    assert state['reconall/sub-1']['status'] == 'done'
+    # The folder left behind is resumed, a new subject starts from its T1.
+    assert jobs['reconall/sub-2'] == ['recon-all', '-all', '-subjid', 'sub-2', '-sd', subjects_dir]
+    assert jobs['reconall/sub-5'][:4] == ['recon-all', '-all', '-i',
+                                          os.path.join('/dataset', 'sub-5', 'anat', 'sub-5_T1w.nii.gz')]
+    assert not os.path.exists(dead_lock)
+    assert os.path.exists(live_lock) and os.path.exists(other_host_lock)
+
+
+def test_reconall_lock_of_failed_job_is_stale(tmpdir):
+    lock_filename = write_lock(str(tmpdir), 'sub-1', 'another-node', 123)
+    assert not reconall_lock_is_stale(lock_filename)
+    assert not reconall_lock_is_stale(lock_filename, {'status': 'running', 'returncode': None})
+    assert reconall_lock_is_stale(lock_filename, {'status': 'failed', 'returncode': 1})
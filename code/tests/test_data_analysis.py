@@ -0,0 +1,121 @@
+from __future__ import division
+
+import os
+import pickle
+import numpy as np
+import pytest
+
+pytest.importorskip('bct')
+pytest.importorskip('sklearn')
+pytest.importorskip('matplotlib')
+
+from scipy.signal import hilbert
+
+from data_analysis import (calculate_phi, mirror_array, network_dynamic_measures, dump_dynamic_measures,
+                           threshold_synchrony, apply_sliding_window, apply_sliding_windows)
+from synchrony import expand
+
+
+def loop_phi(hiltrans):
+    """ calculate_phi before it was vectorised: one Python iteration per pair
+    of regions of the lower triangle, then mirrored at each time point """
+    n_regions = hiltrans.shape[0]
+    indices = np.tril_indices(n_regions)
+    indices = list(zip(indices[0], indices[1]))
+    phi = np.zeros((n_regions, n_regions, hiltrans.shape[1]), dtype=complex)
+    mean_synchrony = np.zeros((n_regions, n_regions))
+    pair_metastability = np.zeros((n_regions, n_regions))
+    phase_angle = np.angle(hiltrans)
+    for index in indices:
+        phi[index[0], index[1], :] += np.exp(phase_angle[index[0]] * 1j)
+        phi[index[0], index[1], :] += np.exp(phase_angle[index[1]] * 1j)
+        phi[index[0], index[1], :] /= 2
+        mean_synchrony[index[0], index[1]] = np.mean(abs(phi[index[0], index[1], :]))
+        pair_metastability[index[0], index[1]] = np.std(abs(phi[index[0], index[1], :]))
+    synchrony = abs(phi)
+    for time_p in range(synchrony.shape[2]):
+        synchrony[:, :, time_p] = mirror_array(synchrony[:, :, time_p])
+    mean_synchrony = mirror_array(mean_synchrony)
+    pair_metastability = mirror_array(pair_metastability)
+    global_synchrony = np.mean(np.tril(mean_synchrony), -1)
+    global_metastability = np.std(global_synchrony)
+    return synchrony, mean_synchrony, pair_metastability, global_synchrony, global_metastability
+
+
+def loop_threshold_synchrony(synchrony, k_optima):
+    """ threshold_synchrony before it was vectorised: the lower triangle of
+    each time point is compared with the threshold, then mirrored """
+    synchrony_bins = {}
+    for network in synchrony:
+        nregions = synchrony[network].shape[0]
+        ntpoints = synchrony[network].shape[2]
+        indices = np.tril_indices(nregions)
+        indices = list(zip(indices[0], indices[1]))
+        synchrony_bin = np.zeros((nregions, nregions, ntpoints))
+        for t in range(ntpoints):
+            for index in indices:
+                if synchrony[network][index[0], index[1], t] >= np.mean(k_optima[str(network)]):
+                    synchrony_bin[index[0], index[1], t] = 1
+            synchrony_bin[:, :, t] = mirror_array(synchrony_bin[:, :, t])
+        synchrony_bins[network] = synchrony_bin
+    return synchrony_bins
+
+
+def random_hilbert_transform(nregions, ntpoints, seed=0):
+    rng = np.random.RandomState(seed)
+    return hilbert(rng.randn(nregions, ntpoints + 20))[:, 10:-10]
+
+
+@pytest.mark.parametrize('nregions,ntpoints', [(2, 1), (7, 30), (20, 50)])
+def test_calculate_phi(nregions, ntpoints):
+    hiltrans = random_hilbert_transform(nregions, ntpoints)
+    expected = loop_phi(hiltrans)
+    measures = calculate_phi(hiltrans)
+    assert np.asarray(measures[0]).shape == (nregions, nregions, ntpoints)
+    for value, expected_value in zip(measures, expected):
+        np.testing.assert_allclose(np.asarray(value), expected_value, rtol=1e-12, atol=1e-15)
+
+
+def test_dump_dynamic_measures(tmpdir):
+    hiltrans = random_hilbert_transform(6, 12)
+    dynamic_measures = {0: network_dynamic_measures(hiltrans), 1: network_dynamic_measures(hiltrans[:3])}
+    dump_dynamic_measures(str(tmpdir), dynamic_measures)
+    with open(os.path.join(str(tmpdir), 'dynamic_measures.pickle'), 'rb') as f:
+        saved = pickle.load(f)
+    for network, nregions in [(0, 6), (1, 3)]:
+        # The synchrony is saved as the full tensor, as by the loop.
+        assert type(saved[network]['synchrony']) is np.ndarray
+        expected = loop_phi(hiltrans[:nregions])
+        np.testing.assert_allclose(saved[network]['synchrony'], expected[0], rtol=1e-12)
+        np.testing.assert_allclose(saved[network]['mean_synchrony'], expected[1], rtol=1e-12)
+    # The in-memory measures are not modified.
+    assert dynamic_measures[0]['synchrony'] is not saved[0]['synchrony']
+    assert not isinstance(dynamic_measures[0]['synchrony'], np.ndarray)
+
+
+def test_threshold_synchrony():
+    synchrony = {0: calculate_phi(random_hilbert_transform(9, 20))[0],
+                 1: calculate_phi(random_hilbert_transform(4, 20, seed=1))[0]}
+    full_synchrony = dict((network, np.asarray(synchrony[network])) for network in synchrony)
+    # Thresholds as saved in optimal_k.json, one per golden subject.
+    k_optima = {'0': [0.6, 0.8], '1': [0.75]}
+    expected = loop_threshold_synchrony(full_synchrony, k_optima)
+    # Both the synchrony computed on demand and the full tensor (as saved by
+    # older versions) are thresholded alike.
+    for synchrony_input in [synchrony, full_synchrony]:
+        synchrony_bins = threshold_synchrony(synchrony_input, k_optima)
+        for network, nregions in [(0, 9), (1, 4)]:
+            condensed = synchrony_bins[network].condensed()
+            assert condensed.shape == (nregions * (nregions - 1) // 2, 20)
+            np.testing.assert_array_equal(expand(condensed, nregions, diagonal=1), expected[network])
+
+
+def test_apply_sliding_windows():
+    hiltrans = random_hilbert_transform(4, 30)
+    slided = apply_sliding_windows(hiltrans, [3, 5])
+    for window_size in [3, 5]:
+        # As the convolution of each region before the prefix sums.
+        expected = np.array([np.convolve(hiltrans[roi], np.ones(window_size) / float(window_size), 'valid')
+                             for roi in range(4)])
+        np.testing.assert_allclose(slided[window_size], expected, rtol=1e-10, atol=1e-12)
+        np.testing.assert_allclose(apply_sliding_window(hiltrans, window_size), expected, rtol=1e-10, atol=1e-12)
@@ -0,0 +1,106 @@
+import os
+import json
+import pytest
+
+import dataset_index
+from dataset_index import (build_dataset_index, load_dataset_index, index_subjects, subject_groups,
+                           diagnosis_group, subject_variants)
+from roi_store import roi_analysis_path, denoised_image_filename, discover_roi_variants
+
+
+def touch(path):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    open(path, 'w').close()
+
+
+def write_dataset(path):
+    """ Write a small ds000030-like tree with a healthy subject (with a T1 and
+    two runs), a schizophrenic patient (rest only, no T1), a bipolar patient
+    and a subject missing from participants.tsv. """
+    dataset_path = os.path.join(path, 'ds')
+    for subject, tasks, t1 in [('sub-10001', ['rest', 'bart'], True), ('sub-50001', ['rest'], False),
+                               ('sub-60001', ['rest'], True), ('sub-70001', [], True)]:
+        if t1:
+            touch(os.path.join(dataset_path, subject, 'anat', '%s_T1w.nii.gz' % subject))
+        for task in tasks:
+            touch(os.path.join(dataset_path, subject, 'func', '%s_task-%s_bold.nii.gz' % (subject, task)))
+            touch(os.path.join(dataset_path, subject, 'func', '%s_task-%s_bold.json' % (subject, task)))
+    os.makedirs(os.path.join(dataset_path, 'derivatives'))
+    with open(os.path.join(dataset_path, 'participants.tsv'), 'w') as f:
+        f.write('participant_id\tdiagnosis\tage\n')
+        f.write('sub-10001\tCONTROL\t30\nsub-50001\tSCHZ\t40\nsub-60001\tBIPOLAR\t35\n')
+
+    # Filtered images of the healthy subject: GLM only, in one band folder.
+    temp_filt = os.path.join(path, 'temp_filt')
+    touch(os.path.join(temp_filt, roi_analysis_path('sub-10001', 'no_ica', True), 'band_0',
+                       denoised_image_filename('no_ica', True)))
+    return dataset_path, temp_filt
+
+
+def test_build_dataset_index(tmpdir):
+    dataset_path, temp_filt = write_dataset(str(tmpdir))
+    index = build_dataset_index(dataset_path, [temp_filt])
+
+    assert sorted(index['subjects']) == ['sub-10001', 'sub-50001', 'sub-60001', 'sub-70001']
+    assert index['subjects']['sub-10001'] == {
+        'diagnosis': 'CONTROL', 'group': 'healthy', 't1': True,
+        'runs': {'bart': os.path.join('func', 'sub-10001_task-bart_bold.nii.gz'),
+                 'rest': os.path.join('func', 'sub-10001_task-rest_bold.nii.gz')}}
+    assert index['subjects']['sub-50001']['group'] == 'schizo'
+    assert index['subjects']['sub-50001']['t1'] is False
+    assert index['subjects']['sub-60001']['group'] is None
+    assert index['subjects']['sub-70001']['diagnosis'] is None
+    assert index['subjects']['sub-70001']['runs'] == {}
+
+    # The indexed variants are those found by probing the filesystem.
+    for subject in index['subjects']:
+        assert subject_variants(index, temp_filt, subject) == discover_roi_variants(temp_filt, subject)
+    assert len(subject_variants(index, temp_filt, 'sub-10001')) == 1
+    assert subject_variants(index, os.path.join(str(tmpdir), 'denoised'), 'sub-10001') is None
+    assert subject_variants(None, temp_filt, 'sub-10001') is None
+
+
+def test_index_subjects(tmpdir):
+    dataset_path, _ = write_dataset(str(tmpdir))
+    index = build_dataset_index(dataset_path)
+    assert index_subjects(index) == ['sub-10001', 'sub-50001', 'sub-60001', 'sub-70001']
+    assert index_subjects(index, group='healthy') == ['sub-10001']
+    assert index_subjects(index, tasks=['rest']) == ['sub-10001', 'sub-50001', 'sub-60001']
+    assert index_subjects(index, tasks=['rest', 'bart']) == ['sub-10001']
+    assert index_subjects(index, tasks=['rest'], t1=True) == ['sub-10001', 'sub-60001']
+
+
+def test_diagnosis_group(tmpdir):
+    dataset_path, _ = write_dataset(str(tmpdir))
+    groups = subject_groups(build_dataset_index(dataset_path))
+    assert diagnosis_group('sub-10001', groups) == 'healthy'
+    assert diagnosis_group('sub-50001', groups) == 'schizo'
+    assert diagnosis_group('sub-60001', groups) is None
+    assert diagnosis_group('sub-99999', groups) is None
+    # Without the index, the group is inferred from the subject ID as before.
+    assert [diagnosis_group(subject) for subject in ['sub-10001', 'sub-45000', 'sub-50001']] == \
+        ['healthy', None, 'schizo']
+
+
+def test_load_dataset_index_is_cached(tmpdir, monkeypatch):
+    dataset_path, temp_filt = write_dataset(str(tmpdir))
+    filename = os.path.join(str(tmpdir), 'dataset_index.json')
+    with pytest.raises(ValueError):
+        load_dataset_index(filename)
+
+    index = load_dataset_index(filename, dataset_path, [temp_filt])
+    with open(filename) as f:
+        assert json.load(f) == index
+    assert not os.path.exists(filename + '.tmp')
+
+    def build(*args):
+        raise AssertionError('The index is rebuilt')
+    monkeypatch.setattr(dataset_index, 'build_dataset_index', build)
+    assert load_dataset_index(filename, dataset_path, [temp_filt]) == index
+    monkeypatch.undo()
+
+    # New subjects are only indexed when rebuilding.
+    touch(os.path.join(dataset_path, 'sub-10002', 'func', 'sub-10002_task-rest_bold.nii.gz'))
+    assert 'sub-10002' not in load_dataset_index(filename, dataset_path)['subjects']
+    assert 'sub-10002' in load_dataset_index(filename, dataset_path, rebuild=True)['subjects']
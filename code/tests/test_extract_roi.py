@@ -0,0 +1,279 @@
+from __future__ import division
+
+import os
+import json
+import warnings
+import numpy as np
+import nibabel as nib
+import pytest
+
+from extract_roi import (roi_voxel_index, average_roi_timeseries, extract_roi_timeseries, iter_image_chunks,
+                         extract_roi, build_design_matrix, expand_design_matrix)
+from roi_store import roi_subject_path, load_roi_timeseries, denoised_image_filename
+from temporal_filter import filter_bands, bandpass_filter
+from scratch import stage_out
+
+
+def loop_roi_timeseries(image_data, segmented_image_data, intensities):
+    """ Average of every region at every time point, one region and one time
+    point at a time (the original extract_roi loop) """
+    avg = np.zeros((len(intensities), image_data.shape[3]))
+    for region, intensity in enumerate(intensities):
+        boolean_mask = np.where(np.isclose(segmented_image_data, intensity, atol=.0))
+        for t in range(image_data.shape[3]):
+            data = image_data[:, :, :, t]
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                avg[region, t] = data[boolean_mask[0], boolean_mask[1], boolean_mask[2]].mean()
+    return avg
+
+
+def random_atlas(shape=(6, 7, 5), ntpoints=12, seed=0):
+    rng = np.random.RandomState(seed)
+    image_data = rng.randn(*(shape + (ntpoints,))) + 100
+    segmented_image_data = rng.randint(0, 6, shape).astype(np.float64)
+    # Region 9 has no voxel.
+    intensities = [1, 2, 3, 9, 4, 5]
+    voxels, offsets = roi_voxel_index([np.isclose(segmented_image_data, intensity, atol=.0)
+                                       for intensity in intensities])
+    return image_data, segmented_image_data, intensities, voxels, offsets
+
+
+def test_roi_voxel_index():
+    masks = [np.array([[True, False], [False, True]]), np.zeros((2, 2), dtype=bool), np.ones((2, 2), dtype=bool)]
+    voxels, offsets = roi_voxel_index(masks)
+    assert list(offsets) == [0, 2, 2, 6]
+    assert list(voxels) == [0, 3, 0, 1, 2, 3]
+
+
+def test_average_roi_timeseries_matches_loop():
+    image_data, segmented_image_data, intensities, voxels, offsets = random_atlas()
+    expected = loop_roi_timeseries(image_data, segmented_image_data, intensities)
+    avg = average_roi_timeseries(image_data, voxels, offsets)
+    assert avg.shape == expected.shape
+    assert np.all(np.isnan(avg[3]))
+    np.testing.assert_allclose(avg, expected, rtol=1e-12, equal_nan=True)
+
+
+def test_average_roi_timeseries_float32():
+    image_data, segmented_image_data, intensities, voxels, offsets = random_atlas()
+    expected = loop_roi_timeseries(image_data, segmented_image_data, intensities)
+    avg = average_roi_timeseries(image_data, voxels, offsets, dtype=np.float32)
+    assert avg.dtype == np.float32
+    np.testing.assert_allclose(avg, expected, rtol=1e-5, equal_nan=True)
+
+
+def test_extract_roi_timeseries_chunks_match_loop():
+    image_data, segmented_image_data, intensities, voxels, offsets = random_atlas()
+    image = nib.Nifti1Image(image_data, np.eye(4))
+    expected = loop_roi_timeseries(image_data, segmented_image_data, intensities)
+    # About two time points per chunk.
+    chunk_mb = 2 * image_data[..., 0].nbytes / 2 ** 20
+    np.testing.assert_allclose(extract_roi_timeseries(image, voxels, offsets, chunk_mb), expected,
+                               rtol=1e-12, equal_nan=True)
+
+
+@pytest.mark.parametrize('extension', ['.nii', '.nii.gz'])
+@pytest.mark.parametrize('scaled', [False, True])
+def test_iter_image_chunks_matches_full_image(tmpdir, extension, scaled):
+    rng = np.random.RandomState(1)
+    if scaled:
+        data = (rng.randn(5, 4, 3, 23) * 100).astype(np.int16)
+    else:
+        data = rng.randn(5, 4, 3, 23).astype(np.float32)
+    image = nib.Nifti1Image(data, np.eye(4))
+    if scaled:
+        image.header.set_slope_inter(0.5, 3.0)
+    filename = os.path.join(str(tmpdir), 'image' + extension)
+    image.to_filename(filename)
+    image = nib.load(filename)
+
+    # Three time points per chunk.
+    chunk_mb = 3 * 5 * 4 * 3 * 8 / 2 ** 20
+    chunks = list(iter_image_chunks(image, chunk_mb))
+    assert [start for start, _ in chunks] == list(range(0, 23, 3))
+    assert [chunk.shape[3] for _, chunk in chunks] == [3] * 7 + [2]
+    np.testing.assert_array_equal(np.concatenate([chunk for _, chunk in chunks], axis=3), image.get_fdata())
+
+
+def test_extract_roi_timeseries_compressed_image(tmpdir):
+    image_data, segmented_image_data, intensities, voxels, offsets = random_atlas()
+    filename = os.path.join(str(tmpdir), 'image.nii.gz')
+    nib.Nifti1Image(image_data, np.eye(4)).to_filename(filename)
+    expected = loop_roi_timeseries(image_data, segmented_image_data, intensities)
+    np.testing.assert_allclose(extract_roi_timeseries(nib.load(filename), voxels, offsets, 0.001), expected,
+                               rtol=1e-12, equal_nan=True)
+
+
+def write_extract_roi_inputs(path, subjects, variants=(('no_ica', True),), seed=2, filtered=True):
+    """ Write an atlas and the filtered (or denoised, if filtered is False)
+    images of the subjects for each (ica_aroma_type, glm_denoise) variant
+    under path/in. Returns the atlas,
+    its data, the lookup table and the image data of each (subject, variant). """
+    rng = np.random.RandomState(seed)
+    shape = (6, 7, 5)
+    segmented_image_data = rng.randint(0, 5, shape).astype(np.float32)
+    segmented_image = os.path.join(path, 'atlas.nii.gz')
+    nib.Nifti1Image(segmented_image_data, np.eye(4)).to_filename(segmented_image)
+    lookuptable = np.array([(i, ('region%d' % i).encode('ascii'), i + 1) for i in range(4)],
+                           dtype=[('numbers', '<i8'), ('regions', 'S31'), ('intensity', '<i8')])
+    images = {}
+    for subject in subjects:
+        for variant in variants:
+            images[subject, variant] = rng.randn(*(shape + (15,))).astype(np.float32)
+            subject_path = roi_subject_path(os.path.join(path, 'in'), subject, *variant)
+            os.makedirs(subject_path)
+            nib.Nifti1Image(images[subject, variant], np.eye(4)).to_filename(
+                os.path.join(subject_path, denoised_image_filename(variant[0], variant[1], filtered)))
+    return segmented_image, segmented_image_data, lookuptable, images
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_extract_roi_subjects_match_loop(tmpdir, jobs):
+    path = str(tmpdir)
+    subjects = ['sub-10001', 'sub-10002', 'sub-50001']
+    segmented_image, segmented_image_data, lookuptable, images = write_extract_roi_inputs(path, subjects)
+
+    output_basepath = os.path.join(path, 'out')
+    extract_roi(subjects, 'full_network', False, True, os.path.join(path, 'in'), segmented_image, lookuptable,
+                output_basepath, 'no_ica', atlas_cache_dir=os.path.join(path, 'cache'), jobs=jobs)
+    for subject in subjects:
+        expected = loop_roi_timeseries(images[subject, ('no_ica', True)], segmented_image_data,
+                                       lookuptable['intensity'])
+        avg = load_roi_timeseries(os.path.join(roi_subject_path(output_basepath, subject, 'no_ica', True),
+                                               'full_network'))
+        np.testing.assert_allclose(avg, expected, rtol=1e-6, atol=1e-6, equal_nan=True)
+
+
+def test_extract_roi_skips_unchanged_inputs(tmpdir):
+    path = str(tmpdir)
+    subjects = ['sub-10001', 'sub-10002']
+    segmented_image, segmented_image_data, lookuptable, images = write_extract_roi_inputs(path, subjects)
+    output_basepath = os.path.join(path, 'out')
+
+    def run():
+        extract_roi(subjects, 'full_network', False, True, os.path.join(path, 'in'), segmented_image, lookuptable,
+                    output_basepath, 'no_ica', atlas_cache_dir=os.path.join(path, 'cache'))
+        # The outputs are renamed into place when written.
+        return dict((subject, os.stat(os.path.join(roi_subject_path(output_basepath, subject, 'no_ica', True),
+                                                   'full_network.npy')).st_ino)
+                    for subject in subjects)
+
+    first = run()
+    assert run() == first
+
+    # A new image of the first subject is extracted again.
+    image_data = images['sub-10001', ('no_ica', True)] * 2
+    input_file = os.path.join(roi_subject_path(os.path.join(path, 'in'), 'sub-10001', 'no_ica', True),
+                              denoised_image_filename('no_ica', True))
+    nib.Nifti1Image(image_data, np.eye(4)).to_filename(input_file)
+    stat = os.stat(input_file)
+    os.utime(input_file, (stat.st_atime, stat.st_mtime + 10))
+    third = run()
+    assert third['sub-10001'] != first['sub-10001']
+    assert third['sub-10002'] == first['sub-10002']
+    avg = load_roi_timeseries(os.path.join(roi_subject_path(output_basepath, 'sub-10001', 'no_ica', True),
+                                           'full_network'))
+    np.testing.assert_allclose(avg, loop_roi_timeseries(image_data, segmented_image_data, lookuptable['intensity']),
+                               rtol=1e-6, atol=1e-6, equal_nan=True)
+
+
+@pytest.mark.parametrize('ica_aroma_type', ['no_ica', 'aggr'])
+def test_build_design_matrix_matches_loop(tmpdir, ica_aroma_type):
+    path = str(tmpdir)
+    segmented_image, segmented_image_data, lookuptable, images = write_extract_roi_inputs(path, ['sub-10001'])
+    image_data = images['sub-10001', ('no_ica', True)]
+    input_file = os.path.join(roi_subject_path(os.path.join(path, 'in'), 'sub-10001', 'no_ica', True),
+                              denoised_image_filename('no_ica', True))
+    design_file = build_design_matrix('sub-10001', input_file, segmented_image, lookuptable,
+                                      os.path.join(path, 'design'), ica_aroma_type,
+                                      atlas_cache_dir=os.path.join(path, 'cache'))
+    subject_path = os.path.join(path, 'design', 'sub-10001')
+    if ica_aroma_type == 'aggr':
+        subject_path = os.path.join(subject_path, 'icaroma_aggr')
+    assert design_file == os.path.join(subject_path, 'wm_csf_time_course.txt')
+    # FSL's GLM design matrix is (time x regressor).
+    expected = np.transpose(loop_roi_timeseries(image_data, segmented_image_data, lookuptable['intensity']))
+    np.testing.assert_allclose(np.loadtxt(design_file), expected, rtol=1e-5, atol=1e-6)
+
+
+def test_expand_design_matrix():
+    design = np.array([[1., 2.], [3., 5.], [4., 9.]])
+    derivative = np.array([[0., 0.], [2., 3.], [1., 4.]])
+    np.testing.assert_array_equal(expand_design_matrix(design), design)
+    np.testing.assert_array_equal(expand_design_matrix(design, derivatives=True), np.hstack([design, derivative]))
+    np.testing.assert_array_equal(expand_design_matrix(design, derivatives=True, squares=True),
+                                  np.hstack([design, derivative, design ** 2, derivative ** 2]))
+
+
+def test_extract_roi_all_variants_match_single_variants(tmpdir):
+    path = str(tmpdir)
+    subjects = ['sub-10001', 'sub-50001']
+    variants = (('no_ica', True), ('aggr', False), ('nonaggr', True))
+    segmented_image, segmented_image_data, lookuptable, images = write_extract_roi_inputs(path, subjects, variants)
+
+    extract_roi(subjects, 'full_network', False, None, os.path.join(path, 'in'), segmented_image, lookuptable,
+                os.path.join(path, 'all'), None, atlas_cache_dir=os.path.join(path, 'cache'), all_variants=True)
+    for variant in variants:
+        extract_roi(subjects, 'full_network', False, variant[1], os.path.join(path, 'in'), segmented_image,
+                    lookuptable, os.path.join(path, 'single'), variant[0],
+                    atlas_cache_dir=os.path.join(path, 'cache'))
+    for subject in subjects:
+        for variant in variants:
+            avg = load_roi_timeseries(os.path.join(roi_subject_path(os.path.join(path, 'all'), subject, *variant),
+                                                   'full_network'))
+            single = load_roi_timeseries(os.path.join(roi_subject_path(os.path.join(path, 'single'), subject,
+                                                                       *variant), 'full_network'))
+            np.testing.assert_array_equal(avg, single)
+            np.testing.assert_allclose(avg, loop_roi_timeseries(images[subject, variant], segmented_image_data,
+                                                                lookuptable['intensity']),
+                                       rtol=1e-6, atol=1e-6, equal_nan=True)
+
+
+def test_extract_roi_filter_on_roi_matches_filtered_images(tmpdir):
+    path = str(tmpdir)
+    segmented_image, segmented_image_data, lookuptable, images = write_extract_roi_inputs(path, ['sub-10001'],
+                                                                                        filtered=False)
+    bands = filter_bands()
+    output_basepath = os.path.join(path, 'out')
+    extract_roi(['sub-10001'], 'full_network', False, True, os.path.join(path, 'in'), segmented_image, lookuptable,
+                output_basepath, 'no_ica', atlas_cache_dir=os.path.join(path, 'cache'), bands=bands)
+    image_data = images['sub-10001', ('no_ica', True)].astype(np.float64)
+    for band, highpass_sigma, lowpass_sigma in bands:
+        # Filtering the voxels, then averaging them.
+        filtered = bandpass_filter(image_data.reshape(-1, image_data.shape[3]), highpass_sigma, lowpass_sigma)
+        expected = loop_roi_timeseries(filtered.reshape(image_data.shape), segmented_image_data,
+                                       lookuptable['intensity'])
+        avg = load_roi_timeseries(os.path.join(roi_subject_path(output_basepath, 'sub-10001', 'no_ica', True, band),
+                                               'full_network'))
+        np.testing.assert_allclose(avg, expected, rtol=1e-6, atol=1e-6, equal_nan=True)
+
+
+def test_extract_roi_on_scratch_records_shared_paths(tmpdir):
+    scratch = os.path.join(str(tmpdir), 'scratch')
+    shared = os.path.join(str(tmpdir), 'shared')
+    os.makedirs(scratch)
+    segmented_image, _, lookuptable, _ = write_extract_roi_inputs(scratch, ['sub-10001'])
+    output_basepath = os.path.join(scratch, 'out')
+
+    def run():
+        extract_roi(['sub-10001'], 'full_network', False, True, os.path.join(scratch, 'in'), segmented_image,
+                    lookuptable, output_basepath, 'no_ica', atlas_cache_dir=os.path.join(scratch, 'cache'),
+                    cohort_stores=False, shared_paths=(scratch, shared))
+        return os.stat(os.path.join(roi_subject_path(output_basepath, 'sub-10001', 'no_ica', True),
+                                    'full_network.npy')).st_ino
+
+    first = run()
+    assert run() == first
+    stage_out(output_basepath, scratch, shared, [os.path.join('glm', 'sub-10001'), 'extract_roi.json'])
+
+    subject_path = roi_subject_path(os.path.join(shared, 'out'), 'sub-10001', 'no_ica', True)
+    input_image = os.path.join(shared, 'in', 'glm', 'sub-10001', denoised_image_filename('no_ica', True))
+    with open(os.path.join(subject_path, 'full_network.json')) as f:
+        provenance = json.load(f)['provenance']
+    assert provenance['input_image'] == input_image
+    assert provenance['segmentation_image'] == os.path.join(shared, 'atlas.nii.gz')
+    with open(os.path.join(subject_path, 'extract_roi_manifest.json')) as f:
+        assert json.load(f)['full_network']['input_image'] == input_image
+    with open(os.path.join(shared, 'out', 'extract_roi.json')) as f:
+        assert json.load(f)['segmentation_image'] == os.path.join(shared, 'atlas.nii.gz')
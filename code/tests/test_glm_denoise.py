@@ -0,0 +1,69 @@
+from __future__ import division
+
+import os
+import numpy as np
+import nibabel as nib
+import pytest
+
+from glm_denoise import residual_forming_matrix, iter_image_slabs, glm_nuisance_regression
+
+
+def fsl_glm_residuals(data, design, demean=True):
+    """ Residuals of fsl_glm --demean: the (time x voxels) data and the
+    regressors are demeaned and the betas fitted by least squares """
+    design = np.asarray(design, dtype=np.float64)
+    if demean:
+        design = design - design.mean(axis=0)
+        data = data - data.mean(axis=0)
+    betas = np.linalg.lstsq(design, data, rcond=None)[0]
+    return data - np.dot(design, betas)
+
+
+def test_residual_forming_matrix_matches_least_squares():
+    rng = np.random.RandomState(0)
+    design = rng.randn(30, 4)
+    data = rng.randn(30, 50) + 10
+    residual_matrix = residual_forming_matrix(design)
+    np.testing.assert_allclose(np.dot(residual_matrix, data - data.mean(axis=0)), fsl_glm_residuals(data, design),
+                               atol=1e-10)
+    # A single regressor can be passed as a vector.
+    np.testing.assert_allclose(residual_forming_matrix(design[:, 0]), residual_forming_matrix(design[:, :1]))
+
+
+def test_iter_image_slabs():
+    data = np.random.RandomState(1).randn(4, 3, 7, 5)
+    image = nib.Nifti1Image(data, np.eye(4))
+    # Two slices per slab.
+    slabs = list(iter_image_slabs(image, 2 * 4 * 3 * 5 * 8 / 2 ** 20))
+    assert [start for start, _ in slabs] == [0, 2, 4, 6]
+    np.testing.assert_array_equal(np.concatenate([slab for _, slab in slabs], axis=2), data)
+
+
+@pytest.mark.parametrize('extension', ['.nii', '.nii.gz'])
+def test_glm_nuisance_regression(tmpdir, extension):
+    rng = np.random.RandomState(2)
+    data = (rng.randn(7, 6, 9, 40) * 10 + 100).astype(np.float32)
+    affine = np.diag([2., 2., 2., 1.])
+    affine[:3, 3] = [-10, 5, 3]
+    in_file = os.path.join(str(tmpdir), 'in' + extension)
+    nib.Nifti1Image(data, affine).to_filename(in_file)
+    design = rng.randn(40, 3)
+    design_file = os.path.join(str(tmpdir), 'design.txt')
+    np.savetxt(design_file, design)
+
+    cwd = os.getcwd()
+    os.chdir(str(tmpdir))
+    try:
+        out_res = glm_nuisance_regression(in_file, design_file, 'res.nii.gz', True, 0.01)
+    finally:
+        os.chdir(cwd)
+    assert out_res == os.path.join(str(tmpdir), 'res.nii')
+    # The temporary decompressed input is removed.
+    assert sorted(os.listdir(str(tmpdir))) == sorted(['design.txt', 'in' + extension, 'res.nii'])
+
+    residuals = nib.load(out_res)
+    assert residuals.shape == data.shape
+    assert residuals.get_data_dtype() == np.float32
+    np.testing.assert_allclose(residuals.affine, affine)
+    expected = fsl_glm_residuals(data.reshape(-1, 40).T.astype(np.float64), design).T.reshape(data.shape)
+    np.testing.assert_allclose(residuals.get_fdata(), expected, atol=1e-3)
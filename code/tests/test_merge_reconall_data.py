@@ -0,0 +1,52 @@
+import os
+
+from merge_reconall_data import staging_manifest, stage, stage_file
+
+
+def write_dataset(dataset_path):
+    files = [os.path.join('sub-1', 'anat', 'sub-1_T1w.nii.gz'),
+             os.path.join('sub-1', 'func', 'sub-1_task-rest_bold.nii.gz'),
+             os.path.join('sub-1', 'func', 'sub-1_task-rest_bold.json'),
+             os.path.join('sub-2', 'anat', 'sub-2_T1w.nii.gz'),
+             # Not staged: not in the staged folders or subjects.
+             os.path.join('sub-2', 'fmap', 'sub-2_phasediff.nii.gz'),
+             os.path.join('sub-3', 'anat', 'sub-3_T1w.nii.gz')]
+    for filename in files:
+        path = os.path.join(dataset_path, filename)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(filename)
+    return files
+
+
+def test_stage_hardlinks_and_is_idempotent(tmpdir):
+    dataset_path = os.path.join(str(tmpdir), 'ds')
+    subjects_dir = os.path.join(str(tmpdir), 'reconall_data')
+    write_dataset(dataset_path)
+    manifest = staging_manifest(dataset_path, subjects_dir, ['sub-1', 'sub-2'])
+    assert [os.path.relpath(target, subjects_dir) for _, target in manifest] == \
+        [os.path.join('sub-1', 'anat', 'sub-1_T1w.nii.gz'),
+         os.path.join('sub-1', 'func', 'sub-1_task-rest_bold.json'),
+         os.path.join('sub-1', 'func', 'sub-1_task-rest_bold.nii.gz'),
+         os.path.join('sub-2', 'anat', 'sub-2_T1w.nii.gz')]
+
+    assert stage(manifest, jobs=2) == {'hardlink': 4}
+    for source, target in manifest:
+        assert os.path.samefile(source, target)
+    # Staging again does not touch the files.
+    assert stage(manifest, jobs=2) == {'exists': 4}
+
+
+def test_stage_file_modes(tmpdir):
+    source = os.path.join(str(tmpdir), 'source.txt')
+    with open(source, 'w') as f:
+        f.write('data')
+    target = os.path.join(str(tmpdir), 'out', 'target.txt')
+    assert stage_file(source, target, 'copy') == 'copy'
+    assert not os.path.samefile(source, target)
+    # A copy with the same size and modification time is kept.
+    assert stage_file(source, target, 'copy') == 'exists'
+    assert stage_file(source, target, 'symlink') == 'symlink'
+    assert os.path.islink(target) and os.path.samefile(source, target)
+    assert stage_file(source, target, 'symlink') == 'exists'
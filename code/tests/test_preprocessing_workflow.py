@@ -0,0 +1,98 @@
+import os
+import pytest
+
+pytest.importorskip('nipype')
+pytest.importorskip('nipypext')
+import preprocessing_workflow
+from preprocessing_workflow import (run_workflow, anatomical_pipeline, anatomical_stage, anatomical_outputs,
+                                    anatomical_done_filename)
+
+
+class RecordingNode(object):
+    def __init__(self, n_procs, mem_gb):
+        self.n_procs = n_procs
+        self.mem_gb = mem_gb
+        self.plugin_args = None
+
+
+class RecordingWorkflow(object):
+    """ Workflow that records how it is run """
+    def __init__(self, nodes=None):
+        self.nodes = nodes if nodes is not None else {}
+        self.runs = []
+
+    def list_node_names(self):
+        return sorted(self.nodes)
+
+    def get_node(self, name):
+        return self.nodes[name]
+
+    def run(self, plugin=None, plugin_args=None):
+        self.runs.append((plugin, plugin_args))
+
+
+def test_run_workflow_linear():
+    workflow = RecordingWorkflow()
+    run_workflow(workflow)
+    assert workflow.runs == [(None, None)]
+
+
+def test_run_workflow_multiproc():
+    workflow = RecordingWorkflow()
+    run_workflow(workflow, 'MultiProc', n_procs=4, memory_gb=16)
+    assert workflow.runs == [('MultiProc', {'n_procs': 4, 'memory_gb': 16})]
+
+
+def test_run_workflow_slurm(monkeypatch):
+    monkeypatch.setattr(preprocessing_workflow, 'which', lambda name: '/usr/bin/' + name)
+    workflow = RecordingWorkflow({'antsreg': RecordingNode(8, 4), 'bet': RecordingNode(1, 0.5)})
+    run_workflow(workflow, 'SLURM', plugin_args={'sbatch_args': '-p short'})
+    assert workflow.runs == [('SLURM', {'sbatch_args': '-p short'})]
+    assert workflow.get_node('antsreg').plugin_args['sbatch_args'] == '-p short --cpus-per-task=8 --mem=4096M'
+    assert workflow.get_node('bet').plugin_args['sbatch_args'] == '-p short --cpus-per-task=1 --mem=512M'
+
+
+def test_run_workflow_slurm_without_sbatch(monkeypatch):
+    monkeypatch.setattr(preprocessing_workflow, 'which', lambda name: None)
+    workflow = RecordingWorkflow()
+    run_workflow(workflow, 'SLURM', n_procs=2)
+    assert workflow.runs == [('MultiProc', {'n_procs': 2})]
+
+
+def test_run_workflow_unknown_plugin():
+    with pytest.raises(ValueError):
+        run_workflow(RecordingWorkflow(), 'PBS')
+
+
+def fake_anatomical_workflow(runs):
+    """ Replacement of run_anatomical_workflow that writes one file per
+    anatomical output, as the DataSink would """
+    def run_anatomical_workflow(subject, base_path, *args):
+        runs.append(subject)
+        anat_dir = os.path.join(base_path, 'data_out', 'anatomical', 'anatomical_out', subject)
+        for name in ['t1', 'transform', 'inverse_transform', 'warped_image', 'aseg']:
+            os.makedirs(os.path.join(anat_dir, name))
+            open(os.path.join(anat_dir, name, name + '.nii.gz'), 'w').close()
+    return run_anatomical_workflow
+
+
+def test_anatomical_stage_runs_once(tmpdir, monkeypatch):
+    runs = []
+    monkeypatch.setattr(preprocessing_workflow, 'run_anatomical_workflow', fake_anatomical_workflow(runs))
+    base_path = str(tmpdir)
+    t1, transform, aseg = anatomical_stage('sub-1', base_path)
+    assert os.path.exists(anatomical_done_filename('sub-1', base_path))
+    assert os.path.basename(t1) == 't1.nii.gz'
+    assert os.path.basename(transform) == 'transform.nii.gz'
+    assert os.path.basename(aseg) == 'aseg.nii.gz'
+    # The outputs are reused by the other runs of the subject.
+    assert anatomical_pipeline('sub-1', base_path) == anatomical_outputs('sub-1', base_path)
+    assert runs == ['sub-1']
+
+
+def test_anatomical_stage_without_outputs(tmpdir, monkeypatch):
+    monkeypatch.setattr(preprocessing_workflow, 'run_anatomical_workflow', lambda *args: None)
+    base_path = str(tmpdir)
+    with pytest.raises(RuntimeError):
+        anatomical_stage('sub-1', base_path)
+    assert not os.path.exists(anatomical_done_filename('sub-1', base_path))
@@ -0,0 +1,93 @@
+from __future__ import division
+
+import os
+import numpy as np
+import pytest
+
+from roi_store import (save_roi_timeseries, load_roi_timeseries, load_roi_metadata, roi_timeseries_exists,
+                       roi_nnetworks, roi_subject_path, cohort_store_path, append_cohort_timeseries,
+                       open_cohort_timeseries, load_subject_roi_timeseries)
+
+
+def test_save_load_roi_timeseries(tmpdir):
+    basename = os.path.join(str(tmpdir), 'full_network')
+    avg = np.random.RandomState(0).randn(4, 10)
+    save_roi_timeseries(basename, avg, ['a', 'b', 'c', 'd'], {'input': 'image.nii.gz'})
+    assert roi_timeseries_exists(basename)
+    assert sorted(os.listdir(str(tmpdir))) == ['full_network.json', 'full_network.npy']
+    # Full precision, unlike the legacy %5e text files.
+    np.testing.assert_array_equal(load_roi_timeseries(basename), avg)
+    np.testing.assert_array_equal(load_roi_timeseries(basename, [3, 1]), avg[[3, 1]])
+    metadata = load_roi_metadata(basename)
+    assert metadata['regions'] == ['a', 'b', 'c', 'd']
+    assert metadata['shape'] == [4, 10]
+    assert metadata['provenance'] == {'input': 'image.nii.gz'}
+
+    with pytest.raises(ValueError):
+        save_roi_timeseries(basename, avg, ['a', 'b'])
+
+
+def test_load_legacy_text_roi_timeseries(tmpdir):
+    basename = os.path.join(str(tmpdir), 'between_network')
+    avg = np.random.RandomState(1).randn(3, 8)
+    np.savetxt(basename + '.txt', avg, delimiter=' ', fmt='%5e')
+    assert roi_timeseries_exists(basename)
+    np.testing.assert_allclose(load_roi_timeseries(basename), avg, rtol=1e-5)
+
+
+def test_roi_nnetworks(tmpdir):
+    path = str(tmpdir)
+    avg = np.zeros((2, 5))
+    # Legacy text files are counted.
+    for network in range(3):
+        np.savetxt(os.path.join(path, 'within_network_%d.txt' % network), avg)
+    assert roi_nnetworks(path) == 3
+    # The sidecar of the first network holds the number of networks.
+    save_roi_timeseries(os.path.join(path, 'within_network_0'), avg, ['a', 'b'], {'nnetworks': 10})
+    assert roi_nnetworks(path) == 10
+    assert roi_nnetworks(os.path.join(path, 'missing')) == 0
+
+
+def test_append_cohort_timeseries(tmpdir):
+    basename = os.path.join(str(tmpdir), 'full_network')
+    rng = np.random.RandomState(2)
+    matrices = dict((subject, rng.randn(3, 6)) for subject in ['sub-1', 'sub-2', 'sub-3'])
+    for subject in sorted(matrices):
+        append_cohort_timeseries(basename, subject, matrices[subject], ['a', 'b', 'c'])
+    # Subjects already in the store are overwritten in place.
+    matrices['sub-2'] = rng.randn(3, 6)
+    append_cohort_timeseries(basename, 'sub-2', matrices['sub-2'])
+
+    data, rows, index = open_cohort_timeseries(basename)
+    assert data.shape == (3, 3, 6)
+    assert index['subjects'] == ['sub-1', 'sub-2', 'sub-3']
+    assert index['regions'] == ['a', 'b', 'c']
+    for subject in matrices:
+        np.testing.assert_array_equal(data[rows[subject]], matrices[subject])
+    assert os.path.getsize(basename + '.dat') == 3 * 3 * 6 * 8
+
+    with pytest.raises(ValueError):
+        append_cohort_timeseries(basename, 'sub-4', np.zeros((3, 7)))
+
+
+def test_load_subject_roi_timeseries_checks_cohort_rows(tmpdir):
+    basepath = str(tmpdir)
+    subject_path = roi_subject_path(basepath, 'sub-1', 'no_ica', True)
+    os.makedirs(subject_path)
+    source = os.path.join(subject_path, 'full_network')
+    avg = np.random.RandomState(3).randn(3, 6)
+    save_roi_timeseries(source, avg, ['a', 'b', 'c'])
+    store = cohort_store_path(basepath, 'no_ica', True, 'full_network')
+    os.makedirs(os.path.dirname(store))
+    append_cohort_timeseries(store, 'sub-1', avg + 1, source=source)
+
+    # The row matches the signature of the subject's file: it is read from the
+    # store.
+    np.testing.assert_array_equal(load_subject_roi_timeseries(basepath, 'sub-1', 'full_network', 'no_ica', True),
+                                  avg + 1)
+    # The subject's file changed: the stale row is ignored.
+    save_roi_timeseries(source, avg * 2, ['a', 'b', 'c'])
+    stat = os.stat(source + '.npy')
+    os.utime(source + '.npy', (stat.st_atime, stat.st_mtime + 10))
+    np.testing.assert_array_equal(load_subject_roi_timeseries(basepath, 'sub-1', 'full_network', 'no_ica', True),
+                                  avg * 2)
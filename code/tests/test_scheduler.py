@@ -0,0 +1,67 @@
+import os
+import sys
+from argparse import Namespace
+
+from scheduler import stage_jobs, run_stage, load_state
+
+
+def scheduler_args(**kwargs):
+    args = Namespace(base_path='/data', analysis_type='task', subjects_filename='subjects.json', job_workers=2,
+                     nsubjects=None, ica_aroma_type=None, glm_denoise=False,
+                     network_types=['full_network', 'within_network'],
+                     data_analysis_types=['BOLD', 'synchrony'], window_types=['sliding', 'non-sliding'],
+                     window_sizes=None, nclusters=[5, 10], rand_ind=20, group_analysis_type='ttest')
+    for name, value in kwargs.items():
+        setattr(args, name, value)
+    return args
+
+
+def test_stage_jobs_one_job_per_network_type():
+    args = scheduler_args()
+    jobs = dict(stage_jobs('analyse_data', ['sub-1', 'sub-2'], args))
+    assert sorted(jobs) == ['analyse_data/full_network', 'analyse_data/within_network']
+    command = jobs['analyse_data/full_network']
+    assert command[1:4] == ['main_analysis.py', '-a', '--network-type']
+    data_analysis_types = command[command.index('--data-analysis-type') + 1:command.index('--nclusters')]
+    assert data_analysis_types == ['BOLD', 'synchrony']
+    # BOLD only runs on the full network.
+    command = jobs['analyse_data/within_network']
+    assert command[command.index('--data-analysis-type') + 1:command.index('--nclusters')] == ['synchrony']
+    assert '--subjects-file' in command
+
+
+def test_stage_jobs_golden_and_extraction_flags():
+    args = scheduler_args(window_sizes=[5, 7])
+    golden = dict(stage_jobs('analyse_data_golden', [], args))['analyse_data_golden/full_network']
+    assert golden[2:5] == ['-r', '-a', '-c']
+    assert golden[golden.index('--window-size') + 1:] == ['5', '7']
+    extraction = dict(stage_jobs('extract_roi', [], args))['extract_roi/full_network']
+    assert '--data-analysis-type' not in extraction and '--nclusters' not in extraction
+    preprocess = stage_jobs('preprocess', ['sub-1', 'sub-2'], args)
+    assert [job_id for job_id, _ in preprocess] == ['preprocess/sub-1', 'preprocess/sub-2']
+
+
+def test_run_stage_retries_and_resumes(tmpdir):
+    state_filename = os.path.join(str(tmpdir), 'state.json')
+    marker = os.path.join(str(tmpdir), 'second_attempt')
+    # Fails the first time it is run, succeeds the second time.
+    flaky = [sys.executable, '-c',
+             'import os, sys\n'
+             'if not os.path.exists(%r):\n'
+             '    open(%r, "w").close()\n'
+             '    sys.exit(1)\n' % (marker, marker)]
+    jobs = [('stage/ok', [sys.executable, '-c', 'pass']),
+            ('stage/flaky', flaky),
+            ('stage/bad', [sys.executable, '-c', 'import sys; sys.exit(3)'])]
+    state = {}
+    failed = run_stage(jobs, state, state_filename, str(tmpdir), workers=2, retries=1)
+    assert failed == ['stage/bad']
+    saved = load_state(state_filename)
+    assert saved['stage/ok']['status'] == 'done'
+    assert saved['stage/flaky']['status'] == 'done' and saved['stage/flaky']['attempts'] == 2
+    assert saved['stage/bad']['status'] == 'failed' and saved['stage/bad']['returncode'] == 3
+
+    # Resuming only runs the failed job again.
+    failed = run_stage(jobs, saved, state_filename, str(tmpdir), workers=2, retries=0)
+    assert failed == ['stage/bad']
+    assert load_state(state_filename)['stage/ok']['attempts'] == 1
@@ -0,0 +1,44 @@
+import os
+
+from scratch import stage_in, stage_out, scratch_to_shared, sync_file
+from extract_roi import recorded_path
+
+
+def write(filename, content):
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    with open(filename, 'w') as f:
+        f.write(content)
+
+
+def test_stage_in_and_out(tmpdir):
+    shared = os.path.join(str(tmpdir), 'shared')
+    scratch = os.path.join(str(tmpdir), 'scratch')
+    write(os.path.join(shared, 'in', 'a', 'image.nii'), 'a')
+    write(os.path.join(shared, 'in', 'b', 'image.nii'), 'b')
+
+    path = os.path.join(scratch, 'in')
+    stage_in(path, scratch, shared, ['a', 'missing'])
+    assert os.listdir(path) == ['a']
+    with open(os.path.join(path, 'a', 'image.nii')) as f:
+        assert f.read() == 'a'
+    # Unchanged files are not copied again.
+    assert not sync_file(os.path.join(shared, 'in', 'a', 'image.nii'), os.path.join(path, 'a', 'image.nii'))
+
+    out = os.path.join(scratch, 'out')
+    write(os.path.join(out, 'sub-1', 'full_network.npy'), 'roi')
+    write(os.path.join(out, 'extract_roi.json'), '{}')
+    write(os.path.join(out, 'sub-2', 'full_network.npy'), 'other job')
+    stage_out(out, scratch, shared, ['sub-1', 'extract_roi.json'])
+    assert sorted(os.listdir(os.path.join(shared, 'out'))) == ['extract_roi.json', 'sub-1']
+    assert scratch_to_shared(os.path.join(out, 'sub-1'), scratch, shared) == os.path.join(shared, 'out', 'sub-1')
+
+
+def test_recorded_path():
+    shared_paths = ('/scratch/job/ucla-la5', '/group/ucla-la5')
+    assert recorded_path('/scratch/job/ucla-la5/data_in/atlas.nii.gz', shared_paths) == \
+        '/group/ucla-la5/data_in/atlas.nii.gz'
+    # Paths outside the scratch folder are kept.
+    assert recorded_path('/other/atlas.nii.gz', shared_paths) == '/other/atlas.nii.gz'
+    assert recorded_path('/scratch/job/ucla-la5/atlas.nii.gz') == '/scratch/job/ucla-la5/atlas.nii.gz'
+    assert recorded_path(None, shared_paths) is None
@@ -0,0 +1,70 @@
+from __future__ import division
+
+import numpy as np
+import pytest
+from scipy.signal import get_window
+
+from sliding_window import (sliding_window_averages, sliding_window_average, prefix_sums, window_weights,
+                            window_name, sliding_window_size)
+
+
+def loop_sliding_window(data, window_size):
+    """ apply_sliding_window before the prefix sums: one 'valid' convolution
+    per region """
+    slided = np.zeros((data.shape[0], data.shape[1] - window_size + 1), dtype=data.dtype)
+    for roi in range(data.shape[0]):
+        slided[roi, :] = np.convolve(data[roi, :], np.ones(int(window_size)) / float(window_size), 'valid')
+    return slided
+
+
+def random_hilbert_transform(nregions, ntpoints, seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.randn(nregions, ntpoints) + 1j * rng.randn(nregions, ntpoints)
+
+
+def test_prefix_sums():
+    data = np.arange(6.).reshape(2, 3)
+    np.testing.assert_array_equal(prefix_sums(data), [[0, 0, 1, 3], [0, 3, 7, 12]])
+
+
+def test_sliding_window_averages():
+    data = random_hilbert_transform(5, 40)
+    averages = sliding_window_averages(data, [1, 5, 7, 40])
+    assert sorted(averages) == [1, 5, 7, 40]
+    for window_size in averages:
+        np.testing.assert_allclose(averages[window_size], loop_sliding_window(data, window_size),
+                                   rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(sliding_window_average(data.real, 5), loop_sliding_window(data.real, 5),
+                               rtol=1e-10, atol=1e-12)
+
+
+def test_sliding_window_stride():
+    data = random_hilbert_transform(3, 23)
+    for stride in [2, 3, 30]:
+        average = sliding_window_average(data, 5, stride)
+        expected = loop_sliding_window(data, 5)[:, ::stride]
+        assert average.shape == expected.shape
+        np.testing.assert_allclose(average, expected, rtol=1e-10, atol=1e-12)
+    with pytest.raises(ValueError):
+        sliding_window_average(data, 5, 0)
+    for window_size in [0, 24]:
+        with pytest.raises(ValueError):
+            sliding_window_average(data, window_size)
+
+
+@pytest.mark.parametrize('taper', ['boxcar', 'triang', 'hann', 'hamming', 'blackman'])
+def test_sliding_window_tapers(taper):
+    data = random_hilbert_transform(4, 30)
+    weights = get_window(taper, 6, fftbins=False)
+    weights = weights / np.sum(weights)
+    np.testing.assert_allclose(window_weights(6, taper), weights)
+    expected = np.array([[np.sum(data[roi, i:i + 6] * weights) for i in range(0, 25, 2)] for roi in range(4)])
+    np.testing.assert_allclose(sliding_window_average(data, 6, 2, taper), expected, rtol=1e-10, atol=1e-12)
+
+
+def test_window_name():
+    assert window_name('sliding') == 'sliding'
+    assert window_name('sliding', sliding_window_size, 1, 'boxcar') == 'sliding'
+    assert window_name('sliding', 7, 2, 'hann') == 'sliding_size_7_stride_2_hann'
+    assert window_name('sliding', sliding_window_size, 3) == 'sliding_stride_3'
+    assert window_name('no_sliding', 7, 2, 'hann') == 'no_sliding'
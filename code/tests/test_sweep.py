@@ -0,0 +1,68 @@
+import os
+import signal
+import pytest
+
+pytest.importorskip('bct')
+pytest.importorskip('sklearn')
+pytest.importorskip('matplotlib')
+
+from sweep import run_graph, sweep_windows
+from data_analysis import sliding_window_size
+
+
+def record(path, node_id):
+    with open(os.path.join(path, node_id), 'w') as f:
+        f.write(str(os.getpid()))
+
+
+def fail(path, node_id):
+    raise ValueError('Failed: %s.' % (node_id))
+
+
+def kill(path, node_id):
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+def graph(path, function):
+    """ a -> b -> c and x -> y, where x runs function """
+    return [(node_id, node_function, {'path': path, 'node_id': node_id}, dependencies)
+            for node_id, node_function, dependencies in [('a', record, []), ('x', function, []),
+                                                         ('b', record, ['a']), ('y', record, ['x']),
+                                                         ('c', record, ['b'])]]
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_run_graph(tmpdir, workers):
+    path = str(tmpdir)
+    assert run_graph(graph(path, record), workers) == []
+    assert sorted(os.listdir(path)) == ['a', 'b', 'c', 'x', 'y']
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_run_graph_skips_dependents_of_failed_nodes(tmpdir, workers):
+    path = str(tmpdir)
+    assert run_graph(graph(path, fail), workers) == ['x', 'y']
+    assert sorted(os.listdir(path)) == ['a', 'b', 'c']
+
+
+def test_run_graph_survives_killed_worker(tmpdir):
+    path = str(tmpdir)
+    assert run_graph(graph(path, kill), 2) == ['x', 'y']
+    assert sorted(os.listdir(path)) == ['a', 'b', 'c']
+
+
+def test_run_graph_unpicklable_task(tmpdir):
+    path = str(tmpdir)
+    assert run_graph(graph(path, lambda path, node_id: record(path, node_id)), 2) == ['x', 'y']
+    assert sorted(os.listdir(path)) == ['a', 'b', 'c']
+
+
+def test_run_graph_unsatisfiable_dependencies(tmpdir):
+    with pytest.raises(ValueError):
+        run_graph([('a', record, {'path': str(tmpdir), 'node_id': 'a'}, ['missing'])])
+
+
+def test_sweep_windows():
+    windows = sweep_windows(['sliding', 'tukey'], [20, 40])
+    assert [window[:2] for window in windows] == [('sliding', 20), ('sliding', 40), ('tukey', sliding_window_size)]
+    assert len(set(window[2] for window in windows)) == 3
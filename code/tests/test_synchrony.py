@@ -0,0 +1,103 @@
+from __future__ import division
+
+import numpy as np
+import pytest
+
+from synchrony import PhaseSynchrony, PackedGraphs, condensed_pairs, condense, expand, threshold_graphs
+
+
+def loop_synchrony(phase_angle):
+    """ The full (regions x regions x time) synchrony tensor, one pair of
+    regions at a time """
+    nregions = phase_angle.shape[0]
+    synchrony = np.zeros((nregions, nregions, phase_angle.shape[1]))
+    for i in range(nregions):
+        for j in range(nregions):
+            synchrony[i, j] = abs((np.exp(phase_angle[i] * 1j) + np.exp(phase_angle[j] * 1j)) / 2)
+    return synchrony
+
+
+def random_phase_angle(nregions, ntpoints, seed=0):
+    return np.random.RandomState(seed).uniform(-np.pi, np.pi, (nregions, ntpoints))
+
+
+# A tiny block size splits the tensor in many blocks.
+@pytest.mark.parametrize('block_mb', [64, 1e-4])
+def test_phase_synchrony_blocks(block_mb):
+    phase_angle = random_phase_angle(9, 13)
+    expected = loop_synchrony(phase_angle)
+    synchrony = PhaseSynchrony.from_phase_angle(phase_angle, block_mb)
+    assert synchrony.shape == expected.shape
+
+    np.testing.assert_allclose(np.asarray(synchrony), expected, rtol=1e-12)
+    for iter_blocks, axis in [(synchrony.iter_row_blocks, 0), (synchrony.iter_time_blocks, 2)]:
+        stops = []
+        for start, stop, block in iter_blocks():
+            np.testing.assert_allclose(block, np.take(expected, range(start, stop), axis=axis), rtol=1e-12)
+            stops.append(stop)
+        assert stops[-1] == expected.shape[axis]
+        assert (len(stops) > 1) == (block_mb < 1)
+
+    rows, columns = np.triu_indices(9, 1)
+    for start, stop, block in synchrony.iter_pair_blocks():
+        assert start % 8 == 0
+        np.testing.assert_allclose(block, expected[rows[start:stop], columns[start:stop]], rtol=1e-12)
+    assert stop == len(rows)
+
+    np.testing.assert_allclose(synchrony.mean(), np.mean(expected, axis=2), rtol=1e-12)
+    np.testing.assert_allclose(synchrony.std(), np.std(expected, axis=2), rtol=1e-10, atol=1e-15)
+
+
+def test_phase_synchrony_getitem():
+    phase_angle = random_phase_angle(5, 8)
+    expected = loop_synchrony(phase_angle)
+    synchrony = PhaseSynchrony.from_phase_angle(phase_angle)
+    for key in [(slice(None), slice(None), 3), (slice(None), slice(None), slice(2, 5)), (1,), (2, 4), 0,
+                (slice(1, 3), 0, slice(None, None, 2))]:
+        np.testing.assert_allclose(synchrony[key], expected[key], rtol=1e-12)
+
+
+def test_condense_expand():
+    matrices = np.random.RandomState(0).uniform(size=(6, 6, 4))
+    matrices = matrices + np.transpose(matrices, (1, 0, 2))
+    matrices[np.arange(6), np.arange(6)] = 1
+    condensed = condense(matrices)
+    assert condensed.shape == (15, 4)
+    # Pair-major upper triangle, as scipy's squareform.
+    rows, columns = condensed_pairs(6)
+    assert list(zip(rows[:6], columns[:6])) == [(0, 1), (0, 2), (0, 3), (0, 4), (0, 5), (1, 2)]
+    for t in range(4):
+        np.testing.assert_array_equal(condensed[:, t], matrices[:, :, t][np.triu_indices(6, 1)])
+    np.testing.assert_array_equal(expand(condensed, 6, diagonal=1), matrices)
+    expanded = expand(condensed[:, 0], 6)
+    np.testing.assert_array_equal(expanded, matrices[:, :, 0] - np.eye(6))
+    np.testing.assert_array_equal(expand(np.zeros((0, 3)), 1, diagonal=1), np.ones((1, 1, 3)))
+
+
+def test_packed_graphs():
+    # 21 edges: the last byte of each time point is only partly used.
+    condensed = np.random.RandomState(0).uniform(size=(21, 10)) > 0.5
+    graphs = PackedGraphs.from_condensed(condensed, 7)
+    assert graphs.packed.shape == (3, 10)
+    assert graphs.packed.dtype == np.uint8
+    assert graphs.shape == (21, 10)
+    np.testing.assert_array_equal(graphs.condensed(), condensed.astype(np.float64))
+    np.testing.assert_array_equal(graphs.condensed(3, 7, dtype=bool), condensed[:, 3:7])
+
+    expected = expand(condensed.astype(np.float64), 7, diagonal=1)
+    for block_mb, nblocks in [(64, 1), (1e-5, 10)]:
+        blocks = list(graphs.iter_expanded_time_blocks(block_mb=block_mb))
+        assert len(blocks) == nblocks
+        assert blocks[-1][1] == 10
+        for start, stop, matrices in blocks:
+            np.testing.assert_array_equal(matrices, expected[:, :, start:stop])
+
+
+@pytest.mark.parametrize('block_mb', [64, 1e-4])
+def test_threshold_graphs(block_mb):
+    phase_angle = random_phase_angle(12, 15)
+    expected = loop_synchrony(phase_angle) >= 0.7
+    synchrony = PhaseSynchrony.from_phase_angle(phase_angle, block_mb)
+    graphs = synchrony.threshold(0.7)
+    np.testing.assert_array_equal(expand(graphs.condensed(dtype=bool), 12, diagonal=True), expected)
+    np.testing.assert_array_equal(threshold_graphs(np.asarray(synchrony), 0.7).packed, graphs.packed)
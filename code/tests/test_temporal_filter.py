@@ -0,0 +1,67 @@
+from __future__ import division
+
+import numpy as np
+
+from temporal_filter import bandpass_matrix, bandpass_filter, filter_bands, filter_sigma
+
+
+def fslmaths_bptf(x, highpass_sigma, lowpass_sigma):
+    """ The band pass filter of fslmaths -bptf, one time point at a time """
+    ntime = len(x)
+    x = np.asarray(x, dtype=np.float64)
+    if highpass_sigma > 0:
+        half_width = int(highpass_sigma * 3)
+        filtered = np.zeros(ntime)
+        for t in range(ntime):
+            A = B = C = D = N = 0
+            for tt in range(max(t - half_width, 0), min(t + half_width, ntime - 1) + 1):
+                dt = tt - t
+                w = np.exp(-0.5 * dt * dt / (highpass_sigma * highpass_sigma))
+                A += w * dt
+                B += w * x[tt]
+                C += w * dt * dt
+                D += w * dt * x[tt]
+                N += w
+            denominator = C * N - A * A
+            if denominator != 0:
+                filtered[t] = x[t] - (C * B - A * D) / denominator
+            else:
+                filtered[t] = x[t]
+        x = filtered
+    if lowpass_sigma > 0:
+        half_width = int(lowpass_sigma * 20) + 2
+        filtered = np.zeros(ntime)
+        for t in range(ntime):
+            total = weights = 0
+            for tt in range(max(t - half_width, 0), min(t + half_width, ntime - 1) + 1):
+                w = np.exp(-0.5 * (tt - t) ** 2 / (lowpass_sigma * lowpass_sigma))
+                total += w * x[tt]
+                weights += w
+            filtered[t] = total / weights
+        x = filtered
+    return x
+
+
+def test_bandpass_matrix_matches_loop():
+    x = np.random.RandomState(0).randn(60) + 5
+    for _, highpass_sigma, lowpass_sigma in filter_bands() + [('highpass', 6.25, -1), ('lowpass', -1, 2.5)]:
+        filtered = np.dot(bandpass_matrix(len(x), highpass_sigma, lowpass_sigma), x)
+        np.testing.assert_allclose(filtered, fslmaths_bptf(x, highpass_sigma, lowpass_sigma), atol=1e-10)
+
+
+def test_bandpass_filter():
+    timeseries = np.random.RandomState(1).randn(3, 50)
+    filtered = bandpass_filter(timeseries, 12.5, 2.5)
+    for region in range(3):
+        np.testing.assert_allclose(filtered[region], fslmaths_bptf(timeseries[region], 12.5, 2.5), atol=1e-10)
+    # The high pass filter removes linear trends.
+    np.testing.assert_allclose(bandpass_filter(np.arange(50.)[np.newaxis] * 3 + 2, 12.5, -1), 0, atol=1e-10)
+    # Disabled filters leave the time series unchanged.
+    np.testing.assert_array_equal(bandpass_matrix(10, -1, -1), np.eye(10))
+
+
+def test_filter_sigma():
+    # 0.5 Hz / 0.01 Hz = 50 volumes, halved.
+    assert filter_sigma(0.01) == 25
+    assert [name for name, _, _ in filter_bands()] == ['band_0.04_0.1', 'band_0.04_0.07', 'band_0.01_0.07',
+                                                       'band_0.01_0.1']